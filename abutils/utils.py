@@ -2,9 +2,10 @@
 import uuid
 import socket
 import sys
+import time
 from imp import find_module  # TODO: imp is deprecated
 from importlib import import_module
-from typing import Type
+from typing import Type, Dict, Tuple
 
 # Third Party
 from django.db.models import Model
@@ -47,9 +48,23 @@ def get_ip_address(request: HttpRequest) -> str:
     return ip
 
 
+# Maps hostnames to (ip, expiry) so that frequent checks don't each cost a DNS lookup.
+_resolved_hosts = {}  # type: Dict[str, Tuple[str, float]]
+RESOLVED_HOST_TTL = 5*60  # Seconds
+
+
+def resolve_host(hostname: str) -> str:
+    """Like socket.gethostbyname() but remembers the answer for RESOLVED_HOST_TTL seconds."""
+    ip, expiry = _resolved_hosts.get(hostname, (None, 0.0))
+    if time.monotonic() >= expiry:
+        ip = socket.gethostbyname(hostname)
+        _resolved_hosts[hostname] = ip, time.monotonic() + RESOLVED_HOST_TTL
+    return ip
+
+
 def request_is_from_host(request: HttpRequest, hostname: str) -> bool:
     req_ip = get_ip_address(request)
-    host_ip = socket.gethostbyname(hostname)
+    host_ip = resolve_host(hostname)
     return req_ip == host_ip
 
 
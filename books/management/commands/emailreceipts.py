@@ -1,5 +1,6 @@
 # Standard
 from datetime import date
+import logging
 
 # Third party
 from django.core.management.base import BaseCommand, CommandError
@@ -16,6 +17,7 @@ from books.mailviews import (
     CashDonationMailView,
     ReceivableInvoiceMailView,
 )
+from modelmailer.batch import MailBatch
 
 __author__ = 'adrian'
 
@@ -25,65 +27,93 @@ class Command(BaseCommand):
     help = "Email receipts queued up during the day."
 
     @staticmethod
-    def send_physical_donation_receipts():
+    def _queue(mv, obj, batch: MailBatch, on_sent, on_failed):
+        """Queue the email for obj. on_failed(e, retry) is called if it can't be built or if it can't be sent.
+        Retry is False if it can't be built, since trying again won't help until somebody fixes the problem.
+        """
+        try:
+            mv.queue(obj, batch, on_sent=on_sent, on_failed=lambda e: on_failed(e, True))
+        except RuntimeWarning as e:
+            on_failed(e, False)
+        except Exception as e:
+            # Leave the flag set so that it's tried again next time.
+            logging.getLogger("books").error("Couldn't build email for {} #{} because: {}".format(type(obj), obj.pk, str(e)))
+
+    @staticmethod
+    def send_physical_donation_receipts(batch: MailBatch):
         mv = PhysicalDonationMailView()
         for donation in Donation.objects.filter(send_receipt=True).all():
-            try:
-                sent = mv.send(donation)
-                if sent:
-                    donation.send_receipt = False
+
+            def sent(donation=donation):
+                donation.send_receipt = False
+                donation.save()
+                DonationNote.objects.create(donation=donation, author=None,
+                    content="Receipt for donated items emailed on {}.".format(date.today().isoformat())
+                )
+
+            def failed(e, retry, donation=donation):
+                if not retry:
+                    donation.send_receipt = False  # Don't want to try again until failure is addressed.
                     donation.save()
-                    DonationNote.objects.create(donation=donation, author=None,
-                        content="Receipt for donated items emailed on {}.".format(date.today().isoformat())
-                    )
-            except RuntimeWarning as e:
                 failure_msg = "Tried to email receipt on {} but failed because:\n{}."
                 DonationNote.objects.create(donation=donation, author=None,
                     content=failure_msg.format(date.today().isoformat(), str(e))
                 )
 
+            Command._queue(mv, donation, batch, sent, failed)
+
     @staticmethod
-    def send_monetary_donation_receipts():
+    def send_monetary_donation_receipts(batch: MailBatch):
         mv = CashDonationMailView()
         for sale in Sale.objects.filter(send_receipt=True).all():
-            try:
-                if sale.monetarydonation_set.count() == 0:
-                    # Protect against case where admin checked the "send DONATION receipt" box but there aren't any donations.
-                    continue
-                sent = mv.send(sale)
-                if sent:
-                    sale.send_receipt = False
+            if sale.monetarydonation_set.count() == 0:
+                # Protect against case where admin checked the "send DONATION receipt" box but there aren't any donations.
+                continue
+
+            def sent(sale=sale):
+                sale.send_receipt = False
+                sale.save()
+                SaleNote.objects.create(sale=sale, author=None,
+                    content="Receipt for donated cash emailed on {}.".format(date.today().isoformat())
+                )
+
+            def failed(e, retry, sale=sale):
+                if not retry:
+                    sale.send_receipt = False  # Don't want to try again until failure is addressed.
                     sale.save()
-                    SaleNote.objects.create(sale=sale, author=None,
-                        content="Receipt for donated cash emailed on {}.".format(date.today().isoformat())
-                    )
-            except RuntimeWarning as e:
-                sale.send_receipt = False  # Don't want to try again until failure is addressed.
                 failure_msg = "Tried to email receipt on {} but failed because:\n{}."
                 SaleNote.objects.create(sale=sale, author=None,
                     content=failure_msg.format(date.today().isoformat(), str(e))
                 )
 
+            Command._queue(mv, sale, batch, sent, failed)
+
     @staticmethod
-    def send_receivable_invoices():
+    def send_receivable_invoices(batch: MailBatch):
         mv = ReceivableInvoiceMailView()
         for rinv in ReceivableInvoice.objects.filter(send_invoice=True).all():
-            try:
-                sent = mv.send(rinv)
-                if sent:
-                    rinv.send_invoice = False
+
+            def sent(rinv=rinv):
+                rinv.send_invoice = False
+                rinv.save()
+                ReceivableInvoiceNote.objects.create(invoice=rinv, author=None,
+                    content="Receivable invoice emailed on {}.".format(date.today().isoformat())
+                )
+
+            def failed(e, retry, rinv=rinv):
+                if not retry:
+                    rinv.send_invoice = False  # Don't want to try again until failure is addressed.
                     rinv.save()
-                    ReceivableInvoiceNote.objects.create(invoice=rinv, author=None,
-                        content="Receivable invoice emailed on {}.".format(date.today().isoformat())
-                    )
-            except RuntimeWarning as e:
                 failure_msg = "Tried to email invoice on {} but failed because:\n{}."
                 ReceivableInvoiceNote.objects.create(invoice=rinv, author=None,
                     content=failure_msg.format(date.today().isoformat(), str(e))
                 )
 
-    def handle(self, *args, **options):
-        self.send_physical_donation_receipts()
-        self.send_monetary_donation_receipts()
-        self.send_receivable_invoices()
+            Command._queue(mv, rinv, batch, sent, failed)
 
+    def handle(self, *args, **options):
+        # All of the receipts and invoices go out over a single connection to the mail server.
+        with MailBatch() as batch:
+            self.send_physical_donation_receipts(batch)
+            self.send_monetary_donation_receipts(batch)
+            self.send_receivable_invoices(batch)
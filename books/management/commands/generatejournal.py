@@ -1,52 +1,99 @@
 # Standard
-from typing import List
+from collections import Counter
+from decimal import Decimal
+from functools import partial
+from multiprocessing import get_context
+from typing import Dict, List, Tuple
 
 # Third party
+from django.apps import apps
 from django.core.management.base import BaseCommand
 from django.conf import settings
 from django.contrib.sites.models import Site
+from django.db import connections
 
 # Local
 from books.models import (
-    JournalEntry,
-    Journaler, JournalLiner,
-    registered_journaler_classes,
+    JournalEntry, DirtyJournaler, JournalBatch, AccountBalance,
+    Journaler,
+    registered_journaler_classes, journal_dirty,
 )
 
 __author__ = 'adrian'
 
+# A shard is the label of a journaler class and the (inclusive) range of pks of the transactions to journal.
+Shard = Tuple[str, int, int]
+
+
+def shards_for(journaler_class, shard_size: int) -> List[Shard]:
+    label = journaler_class._meta.label
+    pks = list(journaler_class.objects.order_by('pk').values_list('pk', flat=True))
+    return [
+        (label, chunk[0], chunk[-1])
+        for chunk in (pks[i:i+shard_size] for i in range(0, len(pks), shard_size))
+    ]
+
+
+def journal_shard(shard: Shard, flush_size: int=None) -> Tuple[Decimal, Decimal, List[int], Dict[str, int]]:
+    """
+    Journals the transactions in the shard. Runs in a worker process, which has its own DB connection.
+    Returns the total debits and credits journaled, the pks of the entries that don't balance, and batch statistics.
+    """
+    label, first_pk, last_pk = shard
+    journaler_class = apps.get_model(label)
+
+    links = journaler_class.link_names_of_relevant_children()
+    journalers = journaler_class.objects\
+        .filter(pk__range=[first_pk, last_pk])\
+        .prefetch_related(*links)  # type: List[Journaler]
+    # The balances of all the accounts are rebuilt once all the shards are done.
+    with JournalBatch(flush_size, maintain_balances=False) as batch:
+        for journaler in journalers:
+            journaler.create_journalentry(batch)
+
+    unbalanced = [je.pk for je in batch.unbalanced]
+    return batch.total_debits, batch.total_credits, unbalanced, batch.stats()
+
 
 class Command(BaseCommand):
 
     help = "(Re)generates the journal from existing transactions."
 
+    def add_arguments(self, parser):
+        parser.add_argument('--incremental', action='store_true', default=False,
+            help="Only regenerate the journal entries of transactions that changed since the journal was generated.")
+        parser.add_argument('--jobs', type=int, default=1,
+            help="The number of worker processes that journal transactions in parallel.")
+        parser.add_argument('--shard-size', type=int, default=2000,
+            help="The number of transactions that a worker journals at a time, in parallel mode.")
+        parser.add_argument('--flush-size', type=int, default=None,
+            help="The number of journal entries that are accumulated before they're saved.")
+
     def handle(self, *args, **options):
 
+        if options['incremental']:
+            self.report(*self.generate_incremental(options['flush_size']))
+            return
+
         print("\nDeleting unfrozen journal entries... ", end="", flush=True)
         JournalEntry.objects.all().delete()
+        # Everything is about to be journaled, so nothing will be dirty.
+        DirtyJournaler.objects.all().delete()
         print("Done.\n")
 
-        for journaler_class in registered_journaler_classes:
-            # print("\rGenerating entries for {} transactions...".format(journaler_class.__name__))
-            count = 0  # type: int
-            total_count = journaler_class.objects.count()
-            print("{}s".format(journaler_class.__name__), flush=True)
-            print("   Loading data ... ", end="", flush=True)
-            links = journaler_class.link_names_of_relevant_children()
-            journalers = journaler_class.objects.all().prefetch_related(*links)  # type: List[Journaler]
-            for journaler in journalers:
-                if count==0:
-                    print("Done.", flush=True)
-                count += 1
-                progress = 1.0 * count / total_count
-                print("\r   Processed {:.0%} ... ".format(progress), end="")
-                journaler.create_journalentry()
-            print("Done.\n")
-
-        Journaler.save_je_batch()
-        JournalLiner.save_jeli_batch()
-
-        errors = Journaler.get_unbalanced_journal_entries()
+        if options['jobs'] > 1:
+            results = self.generate_parallel(options['jobs'], options['shard_size'], options['flush_size'])
+        else:
+            results = self.generate_serial(options['flush_size'])
+
+        print("Rebuilding daily account balances ... ", end="", flush=True)
+        AccountBalance.rebuild()
+        print("Done.\n")
+
+        self.report(*results)
+
+    def report(self, total_dr: Decimal, total_cr: Decimal, errors: List[JournalEntry], stats: Dict[str, int]) -> None:
+
         print("Found {} Errors:".format(len(errors)))
         for je in errors:
             url = je.source_url
@@ -57,12 +104,76 @@ class Command(BaseCommand):
             for li in je.journalentrylineitem_set.all():
                 print("      {}".format(str(li)))
 
-        total_dr = Journaler._grand_total_debits
-        total_cr = Journaler._grand_total_credits
         total_diff = total_cr - total_dr
         print("\nTotals")
         print("  debits:  {0:9.2f}".format(total_dr))
         print("  credits: {0:9.2f}".format(total_cr))
         print("  diff:    {0:9.2f}".format(total_diff))
 
+        print("\nStatistics")
+        for name, value in stats.items():
+            print("  {}: {}".format(name, value))
+
         print("\nDone.\n")
+
+    def generate_incremental(self, flush_size: int) -> Tuple[Decimal, Decimal, List[JournalEntry], Dict[str, int]]:
+
+        print("\nRegenerating entries for changed transactions ... ", end="", flush=True)
+        batch = JournalBatch(flush_size)
+        count = journal_dirty(batch)
+        print("Done. There were {}.\n".format(count))
+
+        return batch.total_debits, batch.total_credits, batch.unbalanced, batch.stats()
+
+    def generate_serial(self, flush_size: int) -> Tuple[Decimal, Decimal, List[JournalEntry], Dict[str, int]]:
+
+        with JournalBatch(flush_size, maintain_balances=False) as batch:
+            for journaler_class in registered_journaler_classes:
+                # print("\rGenerating entries for {} transactions...".format(journaler_class.__name__))
+                count = 0  # type: int
+                total_count = journaler_class.objects.count()
+                print("{}s".format(journaler_class.__name__), flush=True)
+                print("   Loading data ... ", end="", flush=True)
+                links = journaler_class.link_names_of_relevant_children()
+                journalers = journaler_class.objects.all().prefetch_related(*links)  # type: List[Journaler]
+                for journaler in journalers:
+                    if count==0:
+                        print("Done.", flush=True)
+                    count += 1
+                    progress = 1.0 * count / total_count
+                    print("\r   Processed {:.0%} ... ".format(progress), end="")
+                    journaler.create_journalentry(batch)
+                print("Done.\n")
+
+        return batch.total_debits, batch.total_credits, batch.unbalanced, batch.stats()
+
+    def generate_parallel(self, jobs: int, shard_size: int, flush_size: int)\
+            -> Tuple[Decimal, Decimal, List[JournalEntry], Dict[str, int]]:
+
+        shards = []  # type: List[Shard]
+        for journaler_class in registered_journaler_classes:
+            shards.extend(shards_for(journaler_class, shard_size))
+        print("Journaling {} shards in {} processes ... ".format(len(shards), jobs), flush=True)
+
+        # The workers are forked, so they mustn't inherit this process' connection. Each will open its own.
+        connections.close_all()
+
+        total_dr = Decimal(0.00)
+        total_cr = Decimal(0.00)
+        unbalanced = []  # type: List[int]
+        stats = Counter()  # type: Dict[str, int]
+        with get_context('fork').Pool(jobs) as pool:
+            # Results arrive in shard order, so the errors are reported in the same order as a serial run's.
+            results = pool.imap(partial(journal_shard, flush_size=flush_size), shards)
+            for count, (shard_dr, shard_cr, shard_unbalanced, shard_stats) in enumerate(results, 1):
+                total_dr += shard_dr
+                total_cr += shard_cr
+                unbalanced.extend(shard_unbalanced)
+                peak = max(stats['peak pending'], shard_stats['peak pending'])
+                stats.update(shard_stats)
+                stats['peak pending'] = peak  # It's the peak of any one process that matters.
+                print("\r   Processed {:.0%} ... ".format(1.0 * count / len(shards)), end="")
+        print("Done.\n")
+
+        errors_by_pk = JournalEntry.objects.in_bulk(unbalanced)
+        return total_dr, total_cr, [errors_by_pk[pk] for pk in unbalanced], dict(stats)
@@ -0,0 +1,18 @@
+# Standard
+
+# Third Party
+from django.core.management.base import BaseCommand
+
+# Local
+from books.models import AccountBalance
+
+__author__ = 'adrian'
+
+
+class Command(BaseCommand):
+
+    help = "Rederives the daily balances of all accounts from the journal, repairing any drift."
+
+    def handle(self, **options):
+        AccountBalance.rebuild()
+        self.stdout.write("Rebuilt {} daily account balance(s).".format(AccountBalance.objects.count()))
@@ -0,0 +1,29 @@
+# Generated by Django 2.0.3 on 2026-10-17 04:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('books', '0026_auto_20180611_1321'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DirtyJournaler',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField(help_text='The pk of the transaction.')),
+                ('marked', models.DateTimeField(default=django.utils.timezone.now, help_text='When the transaction was last found to be dirty.')),
+                ('content_type', models.ForeignKey(help_text='The type of the transaction.', on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='dirtyjournaler',
+            unique_together={('content_type', 'object_id')},
+        ),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 2.0.3 on 2026-10-17 04:36
+
+from collections import defaultdict
+from decimal import Decimal
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_balances(apps, schema_editor):
+    Account = apps.get_model('books', 'Account')
+    AccountBalance = apps.get_model('books', 'AccountBalance')
+    JournalEntryLineItem = apps.get_model('books', 'JournalEntryLineItem')
+    parents = dict(Account.objects.values_list('id', 'parent_id'))
+    own = defaultdict(lambda: [Decimal("0.00"), Decimal("0.00")])
+    sums = JournalEntryLineItem.objects\
+        .values_list('account_id', 'journal_entry__when', 'action')\
+        .annotate(total=models.Sum('amount'))\
+        .order_by()
+    for acct_id, day, action, total in sums:
+        own[acct_id, day][0 if action == ">" else 1] += total
+    rollup = defaultdict(Decimal)
+    for (acct_id, day), (increase, decrease) in own.items():
+        while acct_id is not None:
+            rollup[acct_id, day] += increase - decrease
+            acct_id = parents.get(acct_id)
+    balances = []
+    totals = defaultdict(lambda: [Decimal("0.00"), Decimal("0.00")])
+    for acct_id, day in sorted(rollup, key=lambda key: key[1]):
+        increase, decrease = own.get((acct_id, day), (Decimal("0.00"), Decimal("0.00")))
+        totals[acct_id][0] += increase - decrease
+        totals[acct_id][1] += rollup[acct_id, day]
+        balances.append(AccountBalance(
+            account_id=acct_id, when=day, increase=increase, decrease=decrease, balance=totals[acct_id][0],
+            rollup_change=rollup[acct_id, day], rollup_balance=totals[acct_id][1],
+        ))
+    AccountBalance.objects.bulk_create(balances, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0027_dirtyjournaler'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountBalance',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('when', models.DateField(help_text='The day.')),
+                ('increase', models.DecimalField(decimal_places=2, default=Decimal('0.00'), help_text="The total of the account's line items that increased its balance on this day.", max_digits=10)),
+                ('decrease', models.DecimalField(decimal_places=2, default=Decimal('0.00'), help_text="The total of the account's line items that decreased its balance on this day.", max_digits=10)),
+                ('balance', models.DecimalField(decimal_places=2, help_text="The account's balance at the end of this day, not including its subaccounts.", max_digits=10)),
+                ('rollup_change', models.DecimalField(decimal_places=2, help_text='The net change on this day in the balances of the account and all its subaccounts.', max_digits=10)),
+                ('rollup_balance', models.DecimalField(decimal_places=2, help_text='The total balance of the account and all its subaccounts at the end of this day.', max_digits=10)),
+                ('account', models.ForeignKey(help_text='The account.', on_delete=django.db.models.deletion.CASCADE, related_name='balances', to='books.Account')),
+            ],
+            options={
+                'ordering': ['account', 'when'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='accountbalance',
+            unique_together={('account', 'when')},
+        ),
+        migrations.RunPython(populate_balances, migrations.RunPython.noop),
+    ]
@@ -3,18 +3,20 @@
 # Standard
 from datetime import date
 from decimal import Decimal
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Set, Tuple
 from abc import abstractmethod, ABCMeta
 from logging import getLogger
-from collections import Counter
+from collections import Counter, defaultdict
+from io import StringIO
 
 # Third party
-from django.db import models
+from django.db import models, connection, transaction
 from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
 from nameparser import HumanName
@@ -31,6 +33,9 @@ ORG_NAME = settings.BZWOPS_CONFIG['ORG_NAME']
 DEC0 = Decimal("0.00")
 DEC1 = Decimal("1.00")
 
+# The number of journal entries that are accumulated before they (and their line items) are saved in bulk.
+JOURNAL_FLUSH_SIZE = settings.BZWOPS_BOOKS_CONFIG.get('JOURNAL_FLUSH_SIZE', 1000)
+
 ACCT_LIABILITY_PAYABLE = 39
 ACCT_LIABILITY_UNEARNED_MSHIP_REVENUE = 46
 ACCT_ASSET_RECEIVABLE = 40
@@ -251,17 +256,19 @@ class JournalEntry(models.Model):
         self.prebatched_lineitems.append(jeli)
         return jeli
 
-    def process_prebatch(self):
+    def process_prebatch(self) -> List['JournalEntryLineItem']:
+        """Simplifies the prebatched line items and returns them, linked to this (now saved) entry."""
         self._simplify_prebatched_lineitems()
         if len(self.prebatched_lineitems) == 0:
             url = self.source_url
             if settings.ISDEVHOST:
                 url = url.replace(PROD_HOST, DEV_HOST)
             print("Journal Entry for {} has no line items!".format(url))
-        for jeli in self.prebatched_lineitems:
+        lineitems = self.prebatched_lineitems
+        for jeli in lineitems:
             jeli.journal_entry_id = self.id
-            JournalLiner.batch_jeli(jeli)
         self.prebatched_lineitems = []
+        return lineitems
 
     def _simplify_prebatched_lineitems(self) -> None:
         """Merge line items that are identical except for amount."""
@@ -378,6 +385,38 @@ class JournalEntryLineItem(models.Model):
     def isdebit(self):
         return not self.iscredit()
 
+    @staticmethod
+    def copy_create(lineitems: List['JournalEntryLineItem']) -> None:
+        """
+        Saves the given line items like bulk_create, but streams them to PostgreSQL using COPY.
+        Falls back to bulk_create on other databases. Either way, the line items are NOT given pks.
+        """
+        if len(lineitems) == 0:
+            return
+        if connection.vendor != 'postgresql':
+            JournalEntryLineItem.objects.bulk_create(lineitems)
+            return
+
+        def copy_text(value) -> str:
+            if value is None:
+                return "\\N"
+            return str(value)\
+                .replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+        fields = [f for f in JournalEntryLineItem._meta.concrete_fields if not f.primary_key]
+        rows = StringIO()
+        for jeli in lineitems:
+            values = [f.get_db_prep_save(getattr(jeli, f.attname), connection) for f in fields]
+            rows.write("\t".join(copy_text(v) for v in values))
+            rows.write("\n")
+        rows.seek(0)
+        sql = "COPY {} ({}) FROM STDIN".format(
+            connection.ops.quote_name(JournalEntryLineItem._meta.db_table),
+            ", ".join(connection.ops.quote_name(f.column) for f in fields),
+        )
+        with connection.cursor() as cursor:
+            cursor.copy_expert(sql, rows)
+
     def __str__(self):
         actionstrs = dict(self.ACTION_CHOICES)
         dr_or_cr = "cr" if self.iscredit() else "dr"
@@ -390,15 +429,252 @@ class JournalEntryLineItem(models.Model):
         )
 
 
+class AccountBalance(models.Model):
+    """ An account's activity on one day and its resulting balance, with and without its subaccounts.
+        There's one for each day on which the account, or any of its subaccounts, has line items.
+        These are derived from the journal and kept current by JournalBatch, so that balances over time
+        can be read without scanning the line items.
+    """
+
+    account = models.ForeignKey(Account, null=False, blank=False, related_name='balances',
+        on_delete=models.CASCADE,  # These are derived from the journal and can be rebuilt.
+        help_text="The account.")
+
+    when = models.DateField(null=False, blank=False,
+        help_text="The day.")
+
+    increase = models.DecimalField(max_digits=10, decimal_places=2, null=False, blank=False, default=DEC0,
+        help_text="The total of the account's line items that increased its balance on this day.")
+
+    decrease = models.DecimalField(max_digits=10, decimal_places=2, null=False, blank=False, default=DEC0,
+        help_text="The total of the account's line items that decreased its balance on this day.")
+
+    balance = models.DecimalField(max_digits=10, decimal_places=2, null=False, blank=False,
+        help_text="The account's balance at the end of this day, not including its subaccounts.")
+
+    rollup_change = models.DecimalField(max_digits=10, decimal_places=2, null=False, blank=False,
+        help_text="The net change on this day in the balances of the account and all its subaccounts.")
+
+    rollup_balance = models.DecimalField(max_digits=10, decimal_places=2, null=False, blank=False,
+        help_text="The total balance of the account and all its subaccounts at the end of this day.")
+
+    @property
+    def change(self) -> Decimal:
+        return self.increase - self.decrease
+
+    @staticmethod
+    def refresh(changes: Dict[int, date]) -> None:
+        """
+        Rederives the balances of the given accounts, and the accounts above them, from the journal.
+        Changes maps the pk of each account whose line items changed to the earliest day on which they did.
+        """
+        if len(changes) == 0:
+            return
+
+        parents = dict(Account.objects.values_list('id', 'parent_id'))  # type: Dict[int, Optional[int]]
+        children = defaultdict(list)  # type: Dict[int, List[int]]
+        for acct_id, parent_id in parents.items():
+            if parent_id is not None:
+                children[parent_id].append(acct_id)
+
+        def ancestry(acct_id: int):
+            while acct_id is not None:
+                yield acct_id
+                acct_id = parents.get(acct_id)
+
+        def subtree(acct_id: int):
+            yield acct_id
+            for child_id in children[acct_id]:
+                yield from subtree(child_id)
+
+        # A change in an account also changes the rolled up balances of the accounts above it.
+        affected = {a for acct_id in changes for a in ancestry(acct_id)}
+        since = min(changes.values())
+        relevant = {a for acct_id in affected for a in subtree(acct_id)}
+
+        with transaction.atomic():
+            # Refreshes of overlapping accounts take turns. Everything is read once the lock is held,
+            # so a refresh can't write balances derived from line items that a concurrent one has since changed.
+            AccountBalance._lock_accounts(affected)
+
+            own = defaultdict(lambda: [DEC0, DEC0])  # Maps (acct pk, day) to [increase, decrease].
+            sums = JournalEntryLineItem.objects\
+                .filter(account_id__in=relevant, journal_entry__when__gte=since)\
+                .values_list('account_id', 'journal_entry__when', 'action')\
+                .annotate(total=models.Sum('amount'))\
+                .order_by()
+            for acct_id, day, action, total in sums:
+                own[acct_id, day][0 if action == JournalEntryLineItem.ACTION_BALANCE_INCREASE else 1] += total
+
+            rollup = defaultdict(Decimal)  # Maps (acct pk, day) to the net change in the account and its subaccounts.
+            days = defaultdict(set)  # Maps acct pk to the days that it needs a balance for.
+            for (acct_id, day), (increase, decrease) in own.items():
+                for a in ancestry(acct_id):
+                    if a in affected:
+                        rollup[a, day] += increase - decrease
+                        days[a].add(day)
+
+            latest = AccountBalance.objects\
+                .filter(account=models.OuterRef('account'), when__lt=since)\
+                .order_by('-when')\
+                .values('when')[:1]
+            start = {
+                b.account_id: (b.balance, b.rollup_balance)
+                for b in AccountBalance.objects.filter(account_id__in=affected, when=models.Subquery(latest))
+            }
+
+            balances = []  # type: List[AccountBalance]
+            for acct_id in affected:
+                balance, rollup_balance = start.get(acct_id, (DEC0, DEC0))
+                for day in sorted(days[acct_id]):
+                    increase, decrease = own.get((acct_id, day), (DEC0, DEC0))
+                    balance += increase - decrease
+                    rollup_balance += rollup[acct_id, day]
+                    balances.append(AccountBalance(
+                        account_id=acct_id, when=day,
+                        increase=increase, decrease=decrease, balance=balance,
+                        rollup_change=rollup[acct_id, day], rollup_balance=rollup_balance,
+                    ))
+
+            AccountBalance.objects.filter(account_id__in=affected, when__gte=since).delete()
+            AccountBalance.objects.bulk_create(balances, batch_size=1000)
+
+    @staticmethod
+    def _lock_accounts(acct_ids: Set[int]) -> None:
+        list(Account.objects.select_for_update().filter(pk__in=acct_ids).order_by('pk'))
+
+    @staticmethod
+    def rebuild() -> None:
+        """Rederives the balances of every account from the journal."""
+        AccountBalance.refresh({acct_id: date.min for acct_id in Account.objects.values_list('id', flat=True)})
+
+    @staticmethod
+    def balance_before(account: Account, day: date, rollup: bool=False) -> Decimal:
+        """The balance of the account (optionally with its subaccounts) at the start of the given day."""
+        latest = AccountBalance.objects.filter(account=account, when__lt=day).order_by('-when').first()
+        if latest is None:
+            return DEC0
+        return latest.rollup_balance if rollup else latest.balance
+
+    def __str__(self):
+        return "{} on {}: {}".format(self.account, self.when, self.balance)
+
+    class Meta:
+        unique_together = ('account', 'when')
+        ordering = ['account', 'when']
+
+
+class JournalBatch:
+    """Accumulates journal entries, along with their line items, and saves them in bulk.
+
+    Use it as a context manager. Entries added inside the "with" block are saved in batches
+    and any that are still pending are saved when the block exits normally:
+
+        with JournalBatch() as batch:
+            for journaler in journalers:
+                journaler.create_journalentry(batch)
+
+    All the state of a journaling run lives in its batch, so admin saves, rq jobs and generatejournal
+    can each journal at the same time. The batch also keeps the run's totals and statistics.
+    When the batch is closed, the AccountBalances of the accounts that it changed are refreshed,
+    unless maintain_balances is False (e.g. because they'll all be rebuilt, anyway).
+    """
+
+    def __init__(self, flush_size: int=None, maintain_balances: bool=True):
+        self.flush_size = flush_size if flush_size is not None else JOURNAL_FLUSH_SIZE
+        self.maintain_balances = maintain_balances
+        self.changed_accounts = {}  # type: Dict[int, date]  # Maps acct pk to the earliest day with changes.
+        self.total_debits = DEC0
+        self.total_credits = DEC0
+        self.unbalanced = []  # type: List[JournalEntry]
+        self.entry_count = 0
+        self.lineitem_count = 0
+        self.flush_count = 0
+        self.peak_pending = 0  # The most entries and line items that were waiting to be saved at once.
+        self._pending = []  # type: List[JournalEntry]
+        self._pending_lineitem_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+
+    def _note_change(self, acct_id: int, day: date) -> None:
+        if acct_id not in self.changed_accounts or day < self.changed_accounts[acct_id]:
+            self.changed_accounts[acct_id] = day
+
+    def delete(self, entries) -> None:
+        """Deletes the given queryset of journal entries, and their line items."""
+        changes = JournalEntryLineItem.objects\
+            .filter(journal_entry__in=entries)\
+            .values('account_id')\
+            .annotate(since=models.Min('journal_entry__when'))\
+            .values_list('account_id', 'since')
+        for acct_id, since in changes:
+            self._note_change(acct_id, since)
+        entries.delete()
+
+    def add(self, je: JournalEntry) -> JournalEntry:
+        """Adds a JournalEntry instance, with its prebatched line items, to the entries that are waiting to be saved."""
+        balance = DEC0
+        for jeli in je.prebatched_lineitems:
+            self._note_change(jeli.account_id, je.when)
+            if jeli.iscredit():
+                balance += jeli.amount
+                self.total_credits += jeli.amount
+            else:
+                balance -= jeli.amount
+                self.total_debits += jeli.amount
+        if abs(balance) > Decimal("0.05"):  # Don't report *small* errors due to rounding.
+            self.unbalanced.append(je)
+            je.unbalanced = True
+        self._pending.append(je)
+        self._pending_lineitem_count += len(je.prebatched_lineitems)
+        self.peak_pending = max(self.peak_pending, len(self._pending) + self._pending_lineitem_count)
+        if len(self._pending) >= self.flush_size:
+            self.flush()
+        return je
+
+    def flush(self) -> None:
+        """Saves the entries that are waiting, and then their line items."""
+        if len(self._pending) == 0:
+            return
+        pending, self._pending = self._pending, []
+        self._pending_lineitem_count = 0
+        # NOTE: As of 1/18/2016, this will only work in Django version 1.10 with Postgres
+        JournalEntry.objects.bulk_create(pending)
+        lineitems = []  # type: List[JournalEntryLineItem]
+        for je in pending:
+            lineitems.extend(je.process_prebatch())
+        JournalEntryLineItem.copy_create(lineitems)
+        self.entry_count += len(pending)
+        self.lineitem_count += len(lineitems)
+        self.flush_count += 1
+
+    def close(self) -> None:
+        """Saves the entries that are still waiting and brings the balances of the accounts involved up to date."""
+        self.flush()
+        if self.maintain_balances:
+            AccountBalance.refresh(self.changed_accounts)
+        self.changed_accounts = {}
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'entries': self.entry_count,
+            'line items': self.lineitem_count,
+            'unbalanced': len(self.unbalanced),
+            'flushes': self.flush_count,
+            'peak pending': self.peak_pending,
+        }
+
+
 class Journaler(models.Model):
 
     __metaclass__ = ABCMeta
 
-    _je_batch = list()  # type: List[JournalEntry]
     _link_names_of_relevant_children = None
-    _unbalanced_journal_entries = list()  # type: List[JournalEntry]
-    _grand_total_debits = Decimal(0.00)
-    _grand_total_credits = Decimal(0.00)
 
     frozen_in_journal = models.BooleanField(default=False,
         help_text="If true, the journal entries for this transaction are frozen and will not be modified.")
@@ -406,121 +682,86 @@ class Journaler(models.Model):
     class Meta:
         abstract = True
 
-    def create_journalentry(self):  # TODO: Name should be plural
+    def create_journalentry(self, batch: JournalBatch):  # TODO: Name should be plural
         """ This public method guards frozen transactions. """
         if self.frozen_in_journal:
             return
         else:
-            self._create_journalentries()
+            self._create_journalentries(batch)
 
     # Each journaler will have its own logic for creating a journal entry.
     @abstractmethod
-    def _create_journalentries(self):
+    def _create_journalentries(self, batch: JournalBatch):
         """
         Create JournalEntry instances associated with this Journaler.
         Do not use SomeModel.objects.create(...)!
-        Instead, create SomeModel(...) instances and stage them for batch_create using Journaler.batch(...).
+        Instead, create SomeModel(...) instances and stage them for bulk_create using batch.add(...).
         """
         raise NotImplementedError
 
+    @classmethod
+    def relations_to_relevant_children(cls):
+        related_objects = [
+            f for f in cls._meta.get_fields()
+              if (f.one_to_many or f.one_to_one)
+              and f.auto_created
+              and not f.concrete
+        ]
+        return [
+            rel for rel in related_objects
+              if (not hasattr(rel.field, 'is_not_parent'))  # Indicates that link is to a PEER transaction and not to a parent transaction.
+              and issubclass(rel.field.model, JournalLiner)
+            ]
+
     @classmethod
     def link_names_of_relevant_children(cls):
         if cls._link_names_of_relevant_children is None:
-            related_objects = [
-                f for f in cls._meta.get_fields()
-                  if (f.one_to_many or f.one_to_one)
-                  and f.auto_created
-                  and not f.concrete
-            ]
             cls._link_names_of_relevant_children = [
-                rel.get_accessor_name() for rel in related_objects
-                  if (not hasattr(rel.field, 'is_not_parent'))  # Indicates that link is to a PEER transaction and not to a parent transaction.
-                  and issubclass(rel.field.model, JournalLiner)
-                ]
+                rel.get_accessor_name() for rel in cls.relations_to_relevant_children()
+            ]
         return cls._link_names_of_relevant_children
 
-    def create_lineitems_for(self, je: JournalEntry):
+    def create_lineitems_for(self, je: JournalEntry, batch: JournalBatch):
         """Discovers the JournalLiner children of this Journaler and asks them to create_journalentry_lineitems."""
         link_names = self.link_names_of_relevant_children()
         for link_name in link_names:
             children = getattr(self, link_name).all()
             for child in children:
-                child.create_journalentry_lineitems(je)
+                child.create_journalentry_lineitems(je, batch)
 
-    def get_absolute_url(self):
-        content_type = ContentType.objects.get_for_model(self.__class__)
+    @staticmethod
+    def absolute_url_for(content_type: ContentType, pk: int) -> str:
+        """The URL of the transaction, which is also the source_url of its journal entries. It may no longer exist."""
         url_name = "admin:{}_{}_change".format(content_type.app_label, content_type.model)
-        relative_url = reverse(url_name, args=[str(self.id)])
+        relative_url = reverse(url_name, args=[str(pk)])
         return "https://{}{}".format(PROD_HOST, relative_url)
 
-    @classmethod
-    def save_je_batch(cls):
-        """
-        Save the currently batched JournalEntry instances using bulk_create,
-        and stage the associated pre-batched JournalEntryLineItems for batch creation.
-        """
-        # NOTE: As of 1/18/2016, this will only work in Django version 1.10 with Postgres
-        JournalEntry.objects.bulk_create(cls._je_batch)
-        for je in cls._je_batch:
-            je.process_prebatch()
-        cls._je_batch = []
-
-    @classmethod
-    def batch(cls, je: JournalEntry):
-        """Adds a JournalEntry instance to the batch that's accumulating for eventual bulk_create."""
-        balance = DEC0
-        for jeli in je.prebatched_lineitems:
-            if jeli.iscredit():
-                balance += jeli.amount
-                cls._grand_total_credits += jeli.amount
-            else:
-                balance -= jeli.amount
-                cls._grand_total_debits += jeli.amount
-        if abs(balance) > Decimal("0.05"):  # Don't report *small* errors due to rounding.
-            cls._unbalanced_journal_entries.append(je)
-            je.unbalanced = True
-        cls._je_batch.append(je)
-        if len(cls._je_batch) > 1000:
-            cls.save_je_batch()
-        return je
+    def get_absolute_url(self):
+        content_type = ContentType.objects.get_for_model(self.__class__)
+        return Journaler.absolute_url_for(content_type, self.id)
 
     def journal_one_transaction(self):
         """
         Create and save journal entries for this one transaction.
         Intended to be used after a transaction is created or updated in admin.
         """
-        JournalEntry.objects.filter(source_url=self.get_absolute_url()).delete()
-        self.create_journalentry()
-        Journaler.save_je_batch()
-        JournalLiner.save_jeli_batch()
-
-    @classmethod
-    def get_unbalanced_journal_entries(cls):
-        return cls._unbalanced_journal_entries
+        with JournalBatch() as batch:
+            batch.delete(JournalEntry.objects.filter(source_url=self.get_absolute_url()))
+            self.create_journalentry(batch)
+        # The transaction is up to date, so journal_dirty() needn't journal it again.
+        DirtyJournaler.objects.filter(
+            content_type=ContentType.objects.get_for_model(self), object_id=self.pk).delete()
 
 
 class JournalLiner(object):
     __metaclass__ = ABCMeta
 
-    _jeli_batch = list()  # type:List[JournalEntryLineItem]
-
     # Each journal liner will have its own logic for creating its line items in the specified entry.
+    # Any additional entries that it creates are added to the batch.
     @abstractmethod
-    def create_journalentry_lineitems(self, je: JournalEntry):
+    def create_journalentry_lineitems(self, je: JournalEntry, batch: JournalBatch):
         raise NotImplementedError
 
-    @classmethod
-    def save_jeli_batch(cls):
-        created = JournalEntryLineItem.objects.bulk_create(cls._jeli_batch)
-        cls._jeli_batch = []
-
-    @classmethod
-    def batch_jeli(cls, jeli: JournalEntryLineItem):
-        cls._jeli_batch.append(jeli)
-        if len(cls._jeli_batch) > 1000:
-            cls.save_jeli_batch()
-        return jeli
-
 
 registered_journaler_classes = []  # type: List[Journaler]
 
@@ -535,6 +776,74 @@ def register_journaler():
     return _decorator
 
 
+class DirtyJournaler(models.Model):
+    """ Identifies a transaction whose journal entries are out of date because it, or one of its JournalLiners, changed.
+        The transaction might have been deleted, in which case its journal entries are simply deleted.
+    """
+
+    content_type = models.ForeignKey(ContentType, null=False, blank=False,
+        on_delete=models.CASCADE,
+        help_text="The type of the transaction.")
+
+    object_id = models.PositiveIntegerField(null=False, blank=False,
+        help_text="The pk of the transaction.")
+
+    marked = models.DateTimeField(null=False, blank=False, default=timezone.now,
+        help_text="When the transaction was last found to be dirty.")
+
+    @staticmethod
+    def mark(journaler_class, pk: int) -> None:
+        content_type = ContentType.objects.get_for_model(journaler_class)
+        # If journal_dirty() has already claimed an earlier mark, this creates a new one to be processed next time.
+        DirtyJournaler.objects.update_or_create(
+            content_type=content_type, object_id=pk, defaults={'marked': timezone.now()})
+
+    def __str__(self):
+        return "{} #{}".format(self.content_type.model, self.object_id)
+
+    class Meta:
+        unique_together = ('content_type', 'object_id')
+
+
+def journal_dirty(batch: JournalBatch=None) -> int:
+    """
+    Regenerates the journal entries of all the transactions that are marked dirty, in bulk, and clears their marks.
+    Returns the number of transactions that were processed. Pass a batch to get the totals and statistics of the run.
+    """
+    if batch is None:
+        batch = JournalBatch()
+
+    # The marks are claimed, by deleting them, in a short transaction of their own so that they aren't locked
+    # while journaling. Transactions that are marked while this runs get new marks and are processed next time.
+    with transaction.atomic():
+        dirty = list(DirtyJournaler.objects.select_for_update(skip_locked=True))  # type: List[DirtyJournaler]
+        DirtyJournaler.objects.filter(pk__in=[mark.pk for mark in dirty]).delete()
+    if len(dirty) == 0:
+        return 0
+
+    pks_by_type = defaultdict(list)  # type: Dict[ContentType, List[int]]
+    for mark in dirty:
+        pks_by_type[ContentType.objects.get_for_id(mark.content_type_id)].append(mark.object_id)
+
+    try:
+        with transaction.atomic():
+            urls = [Journaler.absolute_url_for(ct, pk) for ct, pks in pks_by_type.items() for pk in pks]
+            batch.delete(JournalEntry.objects.filter(source_url__in=urls, frozen=False))
+            for content_type, pks in pks_by_type.items():
+                journaler_class = content_type.model_class()
+                links = journaler_class.link_names_of_relevant_children()
+                for journaler in journaler_class.objects.filter(pk__in=pks).prefetch_related(*links):
+                    journaler.create_journalentry(batch)
+            batch.close()
+    except Exception:
+        # Put the claimed marks back so that the transactions are retried.
+        for mark in dirty:
+            DirtyJournaler.objects.get_or_create(
+                content_type_id=mark.content_type_id, object_id=mark.object_id, defaults={'marked': mark.marked})
+        raise
+    return len(dirty)
+
+
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 # BUDGET
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
@@ -565,7 +874,7 @@ class Budget(Journaler):
         help_text="The amount budgeted for the year.",
         validators=[MinValueValidator(DEC0)])
 
-    def _create_journalentries(self):
+    def _create_journalentries(self, batch: JournalBatch):
         je = JournalEntry(
             when=date(self.year, 1, 1),
             source_url=self.get_absolute_url(),
@@ -582,7 +891,7 @@ class Budget(Journaler):
             amount=self.amount,
             description="Budget contribution"
         ))
-        Journaler.batch(je)
+        batch.add(je)
 
     def __str__(self):
         return self.name
@@ -628,7 +937,7 @@ class CashTransfer(Journaler):  # Started life as a cash xfer but is now a more
             )
             raise ValidationError(msg)
 
-    def _create_journalentries(self):
+    def _create_journalentries(self, batch: JournalBatch):
         je = JournalEntry(
             when=self.when,
             source_url=self.get_absolute_url(),
@@ -645,7 +954,7 @@ class CashTransfer(Journaler):  # Started life as a cash xfer but is now a more
             amount=self.amount,
             description = "Transfer from {}".format(self.from_acct.name)
         ))
-        Journaler.batch(je)
+        batch.add(je)
 
     class Meta:
         unique_together = ['from_acct', 'to_acct', 'when', 'why']
@@ -768,7 +1077,7 @@ class ReceivableInvoice(make_InvoiceBase(recv_invoice_help)):
             self.name(),
             self.invoice_date)
 
-    def _create_journalentries(self):
+    def _create_journalentries(self, batch: JournalBatch):
         je = JournalEntry(
             when=self.invoice_date,
             source_url=self.get_absolute_url(),
@@ -779,8 +1088,8 @@ class ReceivableInvoice(make_InvoiceBase(recv_invoice_help)):
             amount=self.amount,
             description="We invoiced [{}]".format(self.name())
         ))
-        self.create_lineitems_for(je)
-        Journaler.batch(je)
+        self.create_lineitems_for(je, batch)
+        batch.add(je)
 
 
 class ReceivableInvoiceNote(Note):
@@ -825,7 +1134,7 @@ class PayableInvoice(make_InvoiceBase(payable_invoice_help)):
             self.name(),
             self.invoice_date)
 
-    def _create_journalentries(self):
+    def _create_journalentries(self, batch: JournalBatch):
         je = JournalEntry(
             when=self.invoice_date,
             source_url=self.get_absolute_url(),
@@ -845,7 +1154,7 @@ class PayableInvoice(make_InvoiceBase(payable_invoice_help)):
                 description=pili.description
             ))
 
-        Journaler.batch(je)
+        batch.add(je)
 
 
 class PayableInvoiceNote(Note):
@@ -893,7 +1202,7 @@ class ReceivableInvoiceLineItem(InvoiceLineItem, JournalLiner):
             if self.account.type is not Account.TYPE_CREDIT:
                 raise ValidationError(_("Account chosen must have type CREDIT."))
 
-    def create_journalentry_lineitems(self, je: JournalEntry):
+    def create_journalentry_lineitems(self, je: JournalEntry, batch: JournalBatch):
         je.prebatch(JournalEntryLineItem(
             account=self.account,
             action=JournalEntryLineItem.ACTION_BALANCE_INCREASE,
@@ -916,7 +1225,7 @@ class PayableInvoiceLineItem(InvoiceLineItem, JournalLiner):
             if self.account.type is not Account.TYPE_DEBIT:
                 raise ValidationError(_("Account chosen must have type DEBIT."))
 
-    def create_journalentry_lineitems(self, je: JournalEntry):
+    def create_journalentry_lineitems(self, je: JournalEntry, batch: JournalBatch):
         je.prebatch(JournalEntryLineItem(
             account=self.account,
             action=JournalEntryLineItem.ACTION_BALANCE_INCREASE,
@@ -1131,7 +1440,7 @@ class Sale(Journaler):
         item_share_of_fee = item_fraction * self.processing_fee
         return item_price - item_share_of_fee
 
-    def _create_journalentries(self):
+    def _create_journalentries(self, batch: JournalBatch):
         je = JournalEntry(
             when=self.sale_date,
             source_url=self.get_absolute_url(),
@@ -1151,8 +1460,8 @@ class Sale(Journaler):
                     description="Payment processing fee"
                 ))
 
-        self.create_lineitems_for(je)
-        Journaler.batch(je)
+        self.create_lineitems_for(je, batch)
+        batch.add(je)
 
 
 class SaleLineItem (models.Model):
@@ -1233,7 +1542,7 @@ class OtherItem(models.Model, JournalLiner):
     def __str__(self):
         return self.type.name
 
-    def create_journalentry_lineitems(self, je: JournalEntry):
+    def create_journalentry_lineitems(self, je: JournalEntry, batch: JournalBatch):
         je.prebatch(JournalEntryLineItem(
             account=self.type.revenue_acct,
             action=JournalEntryLineItem.ACTION_BALANCE_INCREASE,
@@ -1326,7 +1635,7 @@ class MonetaryDonation(models.Model, JournalLiner):
             raise ValidationError({'earmark': [msg]})
         # NOTE: self.campaign is set in a signal handler.
 
-    def create_journalentry_lineitems(self, je: JournalEntry):
+    def create_journalentry_lineitems(self, je: JournalEntry, batch: JournalBatch):
 
         je.prebatch(JournalEntryLineItem(
             account=self.earmark,
@@ -1374,7 +1683,7 @@ class ReceivableInvoiceReference(models.Model, JournalLiner):
     portion = models.DecimalField(max_digits=6, decimal_places=2, null=True, blank=True, default=None,
         help_text="Leave blank unless they're only paying a portion of the invoice.")
 
-    def create_journalentry_lineitems(self, je: JournalEntry):
+    def create_journalentry_lineitems(self, je: JournalEntry, batch: JournalBatch):
 
         whostr = quote_entity(self.invoice.name())
 
@@ -1593,7 +1902,7 @@ class ExpenseClaim(Journaler):
         if self.amount != self.checksum():
             raise ValidationError(_("Total of line items must match amount of claim."))
 
-    def _create_journalentries(self):
+    def _create_journalentries(self, batch: JournalBatch):
 
         source_url = self.get_absolute_url()
         name_str = quote_entity(self.claimant.username)
@@ -1635,7 +1944,7 @@ class ExpenseClaim(Journaler):
                 description=eli.description
             ))
 
-        Journaler.batch(je)
+        batch.add(je)
 
 
 class ExpenseClaimNote(Note):
@@ -1755,13 +2064,13 @@ class ExpenseTransaction(Journaler):
     def __str__(self):
         return "${} by {}".format(self.amount_paid, self.payment_method_verbose())
 
-    def _create_journalentries(self):
+    def _create_journalentries(self, batch: JournalBatch):
         je = JournalEntry(
             when=self.payment_date,
             source_url=self.get_absolute_url()
         )
 
-        self.create_lineitems_for(je)
+        self.create_lineitems_for(je, batch)
 
         # Run through the line items creating cash/expense entries.
         for eli in self.expenselineitem_set.all():
@@ -1785,7 +2094,7 @@ class ExpenseTransaction(Journaler):
                 description=eli.description
             ))
 
-        Journaler.batch(je)
+        batch.add(je)
 
 
 # REVIEW:
@@ -1818,7 +2127,7 @@ class ExpenseClaimReference(models.Model, JournalLiner):
     portion = models.DecimalField(max_digits=6, decimal_places=2, null=True, blank=True, default=None,
         help_text="Leave blank unless you're only paying a portion of the claim.")
 
-    def create_journalentry_lineitems(self, je: JournalEntry):
+    def create_journalentry_lineitems(self, je: JournalEntry, batch: JournalBatch):
 
         uname = quote_entity(self.claim.claimant.username)
         if self.portion is not None and self.portion < self.claim.amount:
@@ -1952,7 +2261,7 @@ class PayableInvoiceReference(models.Model, JournalLiner):
     portion = models.DecimalField(max_digits=6, decimal_places=2, null=True, blank=True, default=None,
         help_text="Leave blank unless we're only paying a portion of the invoice.")
 
-    def create_journalentry_lineitems(self, je: JournalEntry):
+    def create_journalentry_lineitems(self, je: JournalEntry, batch: JournalBatch):
 
         name_str = quote_entity(self.invoice.name())
         if self.portion is not None and self.portion < self.invoice.amount:
@@ -1,12 +1,19 @@
 
 # Standard
+from collections import defaultdict
+from typing import Dict, List, Tuple
 
 # Third Party
-from django.db.models.signals import pre_save
+from django.conf import settings
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 
 # Local
-from books.models import Sale, MonetaryDonation, Campaign
+from books.models import (
+    Sale, MonetaryDonation, Campaign,
+    DirtyJournaler, journal_dirty, registered_journaler_classes,
+)
+from bzw_ops.jobs import defer
 
 __author__ = 'Adrian'
 
@@ -38,3 +45,61 @@ def link_donation_to_campaign(sender, **kwargs):
     except Campaign.DoesNotExist:
         pass
 
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# JOURNAL
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+# Saving or deleting a transaction, or one of the JournalLiners that make it up, marks the transaction dirty.
+# Dirty transactions are re-journaled by "generatejournal --incremental" or, if configured, by an rq job.
+
+JOURNAL_ON_CHANGE = settings.BZWOPS_BOOKS_CONFIG.get('JOURNAL_ON_CHANGE', False)
+
+# Maps each JournalLiner model to its (journaler class, FK attname) links to the transactions it's part of.
+_parent_links = defaultdict(list)  # type: Dict[type, List[Tuple[type, str]]]
+
+
+def _mark_dirty(journaler_class, pk) -> None:
+    if pk is None:
+        return
+    DirtyJournaler.mark(journaler_class, pk)
+    if JOURNAL_ON_CHANGE:
+        defer(journal_dirty, key="books:journal-dirty")
+
+
+def mark_journaler_dirty(sender, **kwargs):
+    journaler = kwargs.get('instance')
+    _mark_dirty(sender, journaler.pk)
+
+
+def note_liner_parents(sender, **kwargs):
+    """Remember which transactions the liner was part of before this save, since it might have been moved."""
+    liner = kwargs.get('instance')
+    liner.prev_parent_ids = None
+    if liner.pk is not None:
+        attnames = [attname for _, attname in _parent_links[sender]]
+        liner.prev_parent_ids = sender.objects.filter(pk=liner.pk).values_list(*attnames).first()
+
+
+def mark_liner_parents_dirty(sender, **kwargs):
+    liner = kwargs.get('instance')
+    links = _parent_links[sender]
+    prev_parent_ids = getattr(liner, 'prev_parent_ids', None) or [None] * len(links)
+    for (journaler_class, attname), prev_id in zip(links, prev_parent_ids):
+        parent_id = getattr(liner, attname)
+        _mark_dirty(journaler_class, parent_id)
+        if prev_id != parent_id:
+            _mark_dirty(journaler_class, prev_id)
+
+
+# All the models have been loaded by the time that this module is imported, so the journalers are all registered.
+for _journaler_class in registered_journaler_classes:
+    post_save.connect(mark_journaler_dirty, sender=_journaler_class)
+    post_delete.connect(mark_journaler_dirty, sender=_journaler_class)
+    for _rel in _journaler_class.relations_to_relevant_children():
+        _parent_links[_rel.field.model].append((_journaler_class, _rel.field.attname))
+
+for _liner_class in _parent_links:
+    pre_save.connect(note_liner_parents, sender=_liner_class)
+    post_save.connect(mark_liner_parents_dirty, sender=_liner_class)
+    post_delete.connect(mark_liner_parents_dirty, sender=_liner_class)
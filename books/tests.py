@@ -1,18 +1,26 @@
 
 # Standard
+import re
+import csv
 from decimal import Decimal
 from datetime import date
+from typing import Dict, Tuple
+from contextlib import redirect_stdout
+from io import StringIO
+from unittest.mock import patch
 
 # Third Party
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.core.exceptions import ValidationError
 from django.core.management import call_command
+from django.contrib.auth.models import User
+from django.urls import reverse
 
 # Local
 from books.models import (
-    MonetaryDonation, Sale,
+    MonetaryDonation, Sale, Donation, DonationNote,
     JournalEntry, JournalEntryLineItem,
-    Account
+    Account, AccountBalance, DirtyJournaler, JournalBatch, journal_dirty
 )
 
 
@@ -36,6 +44,31 @@ class TestMonetaryDonation(TestCase):
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =]
 
+class TestEmailReceipts(TestCase):
+
+    fixtures = ['test_data']
+
+    def test_unsendable_receipt(self):
+        donation = Donation.objects.create(donator_name="Anonymous", send_receipt=True)
+        with redirect_stdout(StringIO()):
+            call_command("emailreceipts")
+            call_command("emailreceipts")
+        donation.refresh_from_db()
+        # It's not retried until somebody addresses the failure, so only one note is written.
+        self.assertFalse(donation.send_receipt)
+        self.assertEqual(DonationNote.objects.filter(donation=donation).count(), 1)
+
+    def test_receipt_send_failure(self):
+        donation = Donation.objects.create(donator_email="donor@example.com", send_receipt=True)
+        with patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=OSError("SMTP down")):
+            with redirect_stdout(StringIO()):
+                call_command("emailreceipts")
+        donation.refresh_from_db()
+        # A failure to send might be temporary, so the receipt is tried again next time.
+        self.assertTrue(donation.send_receipt)
+        self.assertIn("SMTP down", DonationNote.objects.get(donation=donation).content)
+
+
 class TestJournalEntries(TestCase):
 
     def setUp(self):
@@ -120,3 +153,201 @@ class TestJournalEntries(TestCase):
     def test_generate(self):
         # TODO: generatejournal should have a test mode that raises exceptions?
         call_command("generatejournal")
+
+
+class TestIncrementalJournal(TestCase):
+
+    fixtures = ['test_data']
+
+    def journal(self) -> Dict[str, Decimal]:
+        with redirect_stdout(StringIO()):
+            call_command("generatejournal", "--incremental")
+        self.assertEqual(DirtyJournaler.objects.count(), 0)
+        return dict(JournalEntryLineItem.objects.values_list('journal_entry__source_url', 'amount')
+            .filter(account_id=35))
+
+    def test_incremental(self):
+        donations = Account.objects.get(pk=35)
+        sale1 = Sale.objects.create(total_paid_by_customer=10)
+        sale2 = Sale.objects.create(total_paid_by_customer=20)
+        donation = MonetaryDonation.objects.create(sale=sale1, amount=10, earmark=donations)
+        MonetaryDonation.objects.create(sale=sale2, amount=20, earmark=donations)
+        url1, url2 = sale1.get_absolute_url(), sale2.get_absolute_url()
+        self.assertEqual(self.journal(), {url1: Decimal("10.00"), url2: Decimal("20.00")})
+
+        # Nothing changed, so nothing is re-journaled.
+        self.assertEqual(journal_dirty(), 0)
+
+        # A change to a line of a transaction re-journals the transaction.
+        donation.amount = 15
+        donation.save()
+        self.assertEqual(DirtyJournaler.objects.count(), 1)
+        self.assertEqual(self.journal(), {url1: Decimal("15.00"), url2: Decimal("20.00")})
+
+        # Moving a line affects both transactions.
+        donation.sale = sale2
+        donation.save()
+        self.assertEqual(DirtyJournaler.objects.count(), 2)
+        self.assertEqual(self.journal(), {url2: Decimal("35.00")})
+
+        sale2.delete()
+        self.assertEqual(self.journal(), {})
+        self.assertFalse(JournalEntry.objects.filter(source_url=url2).exists())
+
+    def test_journal_one_transaction(self):
+        donations = Account.objects.get(pk=35)
+        sale1 = Sale.objects.create(total_paid_by_customer=10)
+        sale2 = Sale.objects.create(total_paid_by_customer=20)
+        MonetaryDonation.objects.create(sale=sale1, amount=10, earmark=donations)
+        self.assertEqual(DirtyJournaler.objects.count(), 2)
+        # As the admin does after a save. The transaction that was journaled is no longer dirty.
+        sale1.journal_one_transaction()
+        self.assertEqual(list(DirtyJournaler.objects.values_list('object_id', flat=True)), [sale2.pk])
+
+    def test_failure_keeps_marks(self):
+        sale = Sale.objects.create(total_paid_by_customer=10)
+        with patch.object(Sale, 'create_journalentry', side_effect=RuntimeError("Broken")):
+            self.assertRaises(RuntimeError, journal_dirty)
+        self.assertEqual(list(DirtyJournaler.objects.values_list('object_id', flat=True)), [sale.pk])
+        self.assertEqual(journal_dirty(), 1)
+
+    def test_batch(self):
+        donations = Account.objects.get(pk=35)
+        for n in range(1, 6):
+            sale = Sale.objects.create(total_paid_by_customer=n)
+            MonetaryDonation.objects.create(sale=sale, amount=n, earmark=donations)
+        with JournalBatch(flush_size=2) as batch:
+            for sale in Sale.objects.all():
+                sale.create_journalentry(batch)
+        self.assertEqual(batch.stats(), {
+            'entries': 5, 'line items': 10, 'unbalanced': 0, 'flushes': 3, 'peak pending': 6})
+        self.assertEqual(batch.total_debits, Decimal("15.00"))
+        self.assertEqual(batch.total_credits, Decimal("15.00"))
+        self.assertEqual(JournalEntryLineItem.objects.count(), 10)
+
+
+class TestAccountBalance(TestCase):
+
+    fixtures = ['test_data']
+
+    def setUp(self):
+        self.cash = Account.objects.get(pk=1)
+        self.petty_cash = Account.objects.create(
+            name="Petty Cash",
+            parent=self.cash,
+            category=Account.CAT_ASSET,
+            type=Account.TYPE_DEBIT,
+            description="Petty Cash"
+        )
+        self.donations = Account.objects.get(pk=35)
+
+    def add_entry(self, batch: JournalBatch, when: date, acct: Account, amount: str):
+        je = JournalEntry(when=when, source_url="https://example.com/{}/".format(when.isoformat()))
+        for line_acct in [acct, self.donations]:
+            je.prebatch(JournalEntryLineItem(
+                account=line_acct, action=JournalEntryLineItem.ACTION_BALANCE_INCREASE, amount=Decimal(amount)))
+        batch.add(je)
+
+    def balances(self, acct: Account) -> list:
+        return list(AccountBalance.objects.filter(account=acct).values_list('when', 'balance', 'rollup_balance'))
+
+    def test_balances(self):
+        d1, d2, d3 = date(2018, 1, 1), date(2018, 1, 2), date(2018, 1, 5)
+        with JournalBatch() as batch:
+            self.add_entry(batch, d1, self.cash, "10.00")
+            self.add_entry(batch, d3, self.petty_cash, "5.00")
+        self.assertEqual(self.balances(self.cash), [(d1, 10, 10), (d3, 10, 15)])
+        self.assertEqual(self.balances(self.petty_cash), [(d3, 5, 5)])
+
+        # A change on an earlier day carries through to the later balances.
+        with JournalBatch() as batch:
+            self.add_entry(batch, d2, self.petty_cash, "2.50")
+        self.assertEqual(self.balances(self.cash), [(d1, 10, 10), (d2, 10, 12.5), (d3, 10, 17.5)])
+        self.assertEqual(self.balances(self.donations), [(d1, 10, 10), (d2, 12.5, 12.5), (d3, 17.5, 17.5)])
+
+        with JournalBatch() as batch:
+            batch.delete(JournalEntry.objects.filter(when=d1))
+        self.assertEqual(self.balances(self.cash), [(d2, 0, 2.5), (d3, 0, 7.5)])
+        self.assertEqual(AccountBalance.balance_before(self.cash, d3, rollup=True), Decimal("2.50"))
+
+        # The incremental refreshes should agree with a rebuild.
+        refreshed = list(AccountBalance.objects.values_list('account', 'when', 'increase', 'decrease', 'balance', 'rollup_change', 'rollup_balance'))
+        AccountBalance.rebuild()
+        rebuilt = list(AccountBalance.objects.values_list('account', 'when', 'increase', 'decrease', 'balance', 'rollup_change', 'rollup_balance'))
+        self.assertEqual(refreshed, rebuilt)
+
+
+    def test_interleaved_refreshes(self):
+        d2, d3 = date(2018, 1, 2), date(2018, 1, 5)
+        batch_a = JournalBatch()
+        self.add_entry(batch_a, d2, self.cash, "10.00")
+
+        # Batch A's refresh waits on the lock while batch B journals and refreshes some of the same accounts.
+        lock_accounts = AccountBalance._lock_accounts
+
+        def interleave(acct_ids):
+            with patch.object(AccountBalance, '_lock_accounts', lock_accounts):
+                with JournalBatch() as batch_b:
+                    self.add_entry(batch_b, d3, self.petty_cash, "5.00")
+            lock_accounts(acct_ids)
+
+        with patch.object(AccountBalance, '_lock_accounts', interleave):
+            batch_a.close()
+
+        self.assertEqual(self.balances(self.cash), [(d2, 10, 10), (d3, 10, 15)])
+        self.assertEqual(self.balances(self.petty_cash), [(d3, 5, 5)])
+
+    def test_account_history(self):
+        d1, d2, d3 = date(2018, 1, 1), date(2018, 1, 2), date(2018, 1, 5)
+        with JournalBatch() as batch:
+            self.add_entry(batch, d1, self.cash, "10.00")
+            self.add_entry(batch, d2, self.cash, "2.50")
+            self.add_entry(batch, d3, self.cash, "1.25")
+        User.objects.create_user(username='fake1', password="fake1")
+        self.client.login(username='fake1', password="fake1")
+        url = reverse('books:account-history-in-range', args=[self.cash.pk, "20180102", "20180131"])
+
+        response = self.client.get(url)
+        self.assertEqual(response.context['opening_balance'], 10)
+        self.assertEqual([jeli.balance for jeli in response.context['jelis']], [12.5, 13.75])
+        self.assertEqual(response.context['closing_balance'], 13.75)
+
+        response = self.client.get(url, {'format': "csv"})
+        rows = list(csv.reader(StringIO(b"".join(response.streaming_content).decode())))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[2][:4], ["2018-01-05", "", "1.25", "13.75"])
+
+
+class TestGenerateJournal(TransactionTestCase):
+
+    # Parallel generation happens in other processes, so the test data has to be committed.
+
+    fixtures = ['test_data']
+
+    def setUp(self):
+        donations = Account.objects.get(pk=35)
+        for n in range(1, 8):
+            sale = Sale.objects.create(total_paid_by_customer=10*n)
+            MonetaryDonation.objects.create(sale=sale, amount=10*n, earmark=donations)
+        unbalanced = Sale.objects.create(total_paid_by_customer=100)
+        MonetaryDonation.objects.create(sale=unbalanced, amount=50, earmark=donations)
+
+    def generate(self, *args) -> Tuple[str, list]:
+        out = StringIO()
+        with redirect_stdout(out):
+            call_command("generatejournal", *args)
+        lines = JournalEntryLineItem.objects\
+            .order_by('journal_entry__source_url', 'account_id', 'action', 'amount')\
+            .values_list('journal_entry__source_url', 'account_id', 'action', 'amount', 'description')
+        report = out.getvalue().split("Found")[1].split("Statistics")[0]
+        return report, list(lines)
+
+    def test_parallel(self):
+        serial_report, serial_lines = self.generate()
+        parallel_report, parallel_lines = self.generate("--jobs", "2", "--shard-size", "3")
+        self.assertIn("Found 1 Errors", "Found" + serial_report)
+        self.assertEqual(len(serial_lines), 16)
+        self.assertEqual(serial_lines, parallel_lines)
+        # The line item pks differ, but everything else in the report should be the same.
+        strip_pks = lambda report: re.sub(r"(Line Item|Journal Entry) #?\d+", r"\1", report)
+        self.assertEqual(strip_pks(serial_report), strip_pks(parallel_report))
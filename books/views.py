@@ -4,6 +4,7 @@ from datetime import date, datetime, timedelta
 from logging import getLogger
 from typing import List, Tuple, Iterator, Union
 import json
+import csv
 from decimal import Decimal
 from typing import Optional
 from urllib.parse import urlsplit
@@ -11,13 +12,17 @@ from urllib.parse import urlsplit
 # Third Party
 from django.shortcuts import render
 from rest_framework import viewsets
-from django.http.response import HttpResponse
+from django.http.response import HttpResponse, StreamingHttpResponse
 from django.http.request import HttpRequest
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth import settings
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
+from django.utils.functional import cached_property
+from django.db.models import Sum, F, Case, When, Window, DecimalField, QuerySet
+from django.db.models.expressions import RowRange
+from django.core.paginator import Paginator
 import requests
 from numpy import array
 
@@ -29,7 +34,7 @@ from .models import (
     Sale, SaleNote, Note,
     MonetaryDonation,
     OtherItem, OtherItemType,
-    Journaler, JournalEntry, JournalEntryLineItem
+    Journaler, JournalEntry, JournalEntryLineItem, AccountBalance
 )
 from .serializers import (
     SaleSerializer, SaleNoteSerializer,
@@ -42,6 +47,7 @@ from members.models import Member  # Temporary
 _logger = getLogger("books")
 
 SQUAREUP_APIV1_TOKEN = settings.BZWOPS_BOOKS_CONFIG['SQUAREUP_APIV1_TOKEN']
+ACCOUNT_HISTORY_PAGE_SIZE = settings.BZWOPS_BOOKS_CONFIG.get('ACCOUNT_HISTORY_PAGE_SIZE', 500)
 
 ONE_DAY = timedelta(days=1)
 
@@ -178,14 +184,12 @@ def revenues_and_expenses_from_journal(request):
     end = date.today()
 
     def get_data(category, factor) -> List:
-        data = []
-        for jeli in JournalEntryLineItem.objects.filter(
+        # Like the line items they summarize, increases and decreases both count toward the totals.
+        days = AccountBalance.objects.filter(
           account__category=category,
-          journal_entry__when__gte=start,
-          journal_entry__when__lte=end).prefetch_related('journal_entry'):  # type: JournalEntryLineItem
-            pt = (jeli.journal_entry.when.isoformat(), factor * float(jeli.amount))
-            data.append(pt)
-        return data
+          when__gte=start,
+          when__lte=end).values_list('when', 'increase', 'decrease')
+        return [(when.isoformat(), factor * float(increase + decrease)) for when, increase, decrease in days]
 
     rev = get_data(Account.CAT_REVENUE, 1.0)
     exp = get_data(Account.CAT_EXPENSE, -1.0)
@@ -207,28 +211,15 @@ def revenues_and_expenses_from_journal(request):
 
 def get_cash_pts(start: date, end:date) -> List[DatedFloat]:
     root_cash_acct = Account.get(ACCT_ASSET_CASH)
-    cash_accts = filter(
-        lambda x: x.is_subaccount_of(root_cash_acct) or x == root_cash_acct,
-        Account.objects.all()
-    ) # type: List[Account]
-    cash_acct_ids = map(
-        lambda x: x.id,
-        cash_accts
-    ) # type: List[int]
-
-    cash_jelis = JournalEntryLineItem.objects.filter(
-      account_id__in=cash_acct_ids,
-      journal_entry__when__gte=start,
-      journal_entry__when__lte=end
-    ).prefetch_related('journal_entry')
-
-    cash_deltas = []
-    for jeli in cash_jelis:  # type: JournalEntryLineItem
-        if jeli.action == JournalEntryLineItem.ACTION_BALANCE_DECREASE:
-            pt = (jeli.journal_entry.when, -1.0*float(jeli.amount))
-        else:
-            pt = (jeli.journal_entry.when, 1.0*float(jeli.amount))
-        cash_deltas.append(pt)
+
+    # The daily changes in the root cash account, rolled up with all of its subaccounts.
+    cash_changes = AccountBalance.objects.filter(
+      account=root_cash_acct,
+      when__gte=start,
+      when__lte=end
+    ).values_list('when', 'rollup_change')
+
+    cash_deltas = [(when, float(change)) for when, change in cash_changes]
     cash_pts = list(_fill(_acc(cash_deltas)))
     return cash_pts
 
@@ -391,6 +382,57 @@ def items_needing_attn(request):
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 
+def with_running_change(jelis: QuerySet) -> QuerySet:
+    """
+    Orders the line items by date and annotates each with "running_change",
+    the net change in its account's balance through that line item. The line items should all be in one account.
+    """
+    change = Case(
+        When(action=JournalEntryLineItem.ACTION_BALANCE_INCREASE, then=F('amount')),
+        default=F('amount') * -1,
+        output_field=DecimalField(max_digits=10, decimal_places=2),
+    )
+    order = [F('journal_entry__when').asc(), F('journal_entry_id').asc(), F('id').asc()]
+    return jelis\
+        .select_related('journal_entry')\
+        .annotate(running_change=Window(Sum(change), order_by=order, frame=RowRange(start=None, end=0)))\
+        .order_by(*order)
+
+
+class _CountedPaginator(Paginator):
+    """Django can't count() a queryset that's annotated with a window function, so this is told how to count it."""
+
+    def __init__(self, object_list, per_page, counted: QuerySet):
+        super().__init__(object_list, per_page)
+        self.counted = counted
+
+    @cached_property
+    def count(self) -> int:
+        return self.counted.count()
+
+
+class _Echo:
+    """A file-like object that just hands back what's written to it, so csv.writer can feed a streaming response."""
+    def write(self, value):
+        return value
+
+
+def _account_history_csv(jelis: QuerySet, opening_balance: Decimal) -> Iterator[str]:
+    writer = csv.writer(_Echo())
+    yield writer.writerow(["Date", "Decrease", "Increase", "Balance", "Description", "Source"])
+    for jeli in jelis.iterator():  # type: JournalEntryLineItem
+        je = jeli.journal_entry  # type: JournalEntry
+        increase = jeli.action == jeli.ACTION_BALANCE_INCREASE
+        yield writer.writerow([
+            je.when.isoformat(),
+            "" if increase else jeli.amount,
+            jeli.amount if increase else "",
+            opening_balance + jeli.running_change,
+            jeli.description,
+            je.source_url,
+        ])
+
+
 @login_required
 def account_history(
     request,
@@ -424,32 +466,44 @@ def account_history(
     end_date = date(year=end_year, month=end_month, day=end_day)
     end_date = min(end_date, date.today())
 
-    jelis = list(JournalEntryLineItem.objects.filter(
-        account=account_pk,
+    opening_balance = AccountBalance.balance_before(acct, begin_date)
+    lineitems = JournalEntryLineItem.objects.filter(
+        account=acct,
         journal_entry__when__gte=begin_date,
         journal_entry__when__lte=end_date,
-    ))
+    )
+    jelis = with_running_change(lineitems)
 
-    jelis.sort(key=lambda x: x.journal_entry.when)
+    if request.GET.get('format') == "csv":
+        response = StreamingHttpResponse(_account_history_csv(jelis, opening_balance), content_type="text/csv")
+        filename = "account-{}-{}-{}.csv".format(acct.pk, begin_date.isoformat(), end_date.isoformat())
+        response['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
+        return response
 
-    decrease_total = Decimal("0.00")
-    increase_total = Decimal("0.00")
-    for jeli in jelis:  # type: JournalEntryLineItem
+    page = _CountedPaginator(jelis, ACCOUNT_HISTORY_PAGE_SIZE, lineitems).get_page(request.GET.get('page'))
+    for jeli in page:  # type: JournalEntryLineItem
         je = jeli.journal_entry  # type: JournalEntry
-        if jeli.action == jeli.ACTION_BALANCE_INCREASE:
-            increase_total += jeli.amount
-            jeli.sign = 1
-        else:
-            decrease_total += jeli.amount
-            jeli.sign = -1
+        jeli.sign = 1 if jeli.action == jeli.ACTION_BALANCE_INCREASE else -1
+        jeli.balance = opening_balance + jeli.running_change
         # DB contains abs URLs pointing to production, so I'll add relative urls.
         je.relative_source_url = urlsplit(je.source_url).path
 
+    totals = AccountBalance.objects.filter(
+        account=acct,
+        when__gte=begin_date,
+        when__lte=end_date,
+    ).aggregate(increase_total=Sum('increase'), decrease_total=Sum('decrease'))
+    increase_total = totals['increase_total'] or Decimal("0.00")
+    decrease_total = totals['decrease_total'] or Decimal("0.00")
+
     params = {
         'begin_date': begin_date,
         'end_date': end_date,
         'acct': acct,
-        'jelis': jelis,
+        'jelis': page,
+        'page': page,
+        'opening_balance': opening_balance,
+        'closing_balance': opening_balance + increase_total - decrease_total,
         'decrease_total': decrease_total,
         'increase_total': increase_total,
         'change_total': increase_total - decrease_total,
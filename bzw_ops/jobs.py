@@ -0,0 +1,67 @@
+# Standard
+import logging
+from typing import Callable, Optional
+
+# Third Party
+from django.conf import settings
+from django.db import transaction
+
+__author__ = 'adrian'
+
+logger = logging.getLogger("bzw_ops")
+
+_CONFIG = settings.BZWOPS_JOBS_CONFIG
+ASYNC = _CONFIG.get('ASYNC', True)
+COALESCE_TIMEOUT = _CONFIG.get('COALESCE_TIMEOUT', 60*60)
+
+
+def _pending_key(key: str) -> str:
+    return "bzw_ops:job-pending:{}".format(key)
+
+
+def get_queue(name: str='default'):
+    # These are imported here because bzw_ops.worker sets Django up, which can't be done while apps are loading.
+    from rq import Queue
+    from bzw_ops.worker import conn
+    return Queue(name, connection=conn)
+
+
+def _run_coalesced(key: str, func: Callable, args: tuple) -> None:
+    # The marker is cleared first so that changes made while this job runs get a job of their own.
+    from bzw_ops.worker import conn
+    conn.delete(_pending_key(key))
+    func(*args)
+
+
+def _enqueue(func: Callable, args: tuple, key: Optional[str], queue: str) -> None:
+    marked = False
+    try:
+        q = get_queue(queue)
+        if key is None:
+            q.enqueue(func, *args)
+        elif q.connection.set(_pending_key(key), 1, nx=True, ex=COALESCE_TIMEOUT):
+            marked = True
+            q.enqueue(_run_coalesced, key, func, args)
+        # Otherwise, an equivalent job is already waiting to run.
+    except Exception as e:
+        # If the queue can't be reached, doing the work now is better than not doing it at all.
+        logger.error("Couldn't enqueue %s so running it now: %s", func.__name__, str(e))
+        if marked:
+            # No job is waiting, so later jobs with the same key mustn't be coalesced into this one.
+            try:
+                q.connection.delete(_pending_key(key))
+            except Exception as e:
+                logger.error("Couldn't clear the pending marker for %s: %s", key, str(e))
+        func(*args)
+
+
+def defer(func: Callable, *args, key: Optional[str]=None, queue: str='default') -> None:
+    """Runs func(*args) on the rq worker, once the current transaction (if any) commits.
+    Jobs with the same key that are still waiting to run are coalesced into one, so func must be idempotent.
+    The worker imports func by name, so it must be a module level function.
+    When deferred jobs are disabled (e.g. while testing) func is run immediately, instead.
+    """
+    if not ASYNC:
+        func(*args)
+        return
+    transaction.on_commit(lambda: _enqueue(func, args, key, queue))
@@ -227,6 +227,18 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/2.0/topics/cache/
+# A database cache is shared by all web and worker processes, so invalidation in one is seen by the others.
+# Run "manage.py createcachetable" after deploying a change to this.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'bzwops_cache',
+    }
+}
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.8/topics/i18n/
 
@@ -437,13 +449,49 @@ BZWOPS_CONFIG = {
     'EMAIL_STAFF_LIST': "",
 }
 
+BZWOPS_MAIL_CONFIG = {
+    # Configuration for batched outbound email. See modelmailer.batch.MailBatch.
+    'BATCH_SIZE': 50,
+    'MAX_PER_SECOND': None,  # None means no throttling.
+
+    # Set the XEROPS_MAIL_DRY_RUN_DIR environment variable to write email to files in that dir instead of sending it.
+    'DRY_RUN_DIR': os.getenv('XEROPS_MAIL_DRY_RUN_DIR', None),
+}
+
+BZWOPS_JOBS_CONFIG = {
+    # Configuration for work deferred to the rq worker. See bzw_ops.jobs.
+    # Deferred jobs run immediately, in-process, while testing.
+    'ASYNC': not TESTING,
+    'COALESCE_TIMEOUT': 60*60,  # Seconds that a job can wait in the queue before equivalent jobs stop coalescing.
+}
+
 BZWOPS_MEMBERS_CONFIG = {
     # Configuration specific to the "members" app.
+
+    # Notifications are queued and then delivered by the rq worker. See members.notifications.
+    'PUSHOVER_API_URL': "https://api.pushover.net/1/messages.json",
+    'EML2SMS_DOMAIN': os.getenv('XEROPS_EML2SMS_DOMAIN', None),  # For keys that are phone numbers.
+    'NOTIFICATION_MAX_ATTEMPTS': 5,
+    'NOTIFICATION_RETRY_DELAY': 60,  # Seconds before the first retry. Doubles for each retry after that.
+    'NOTIFICATION_TIMEOUT': 10,  # Seconds
+
+    # Door access decisions come from a snapshot of registered cards that's rebuilt at least this often.
+    'ACCESS_CACHE_MAX_AGE': 10*60,  # Seconds
+    'ACCESS_CACHE_CHECK_INTERVAL': 5,  # Seconds between checks for changes made by other processes.
+
+    # Batches of card reads from RFID readers. See members.views.rfid_visits.
+    'RFID_DEBOUNCE': 60,  # Seconds within which repeated reads of a card count as one.
+    'RFID_CLOCK_SKEW': 5*60,  # Seconds that a reader's clock may be ahead of the server's.
+    'RFID_MAX_BACKLOG': 7*24*60*60,  # Seconds. Older reads are rejected.
 }
 
 BZWOPS_TASKS_CONFIG = {
     # Configuration specific to the "tasks" app.
-    'USER_VOLUNTEER': "adrianb"  # The Volunteer Coordinator's username.
+    'USER_VOLUNTEER': "adrianb",  # The Volunteer Coordinator's username.
+
+    # Rendered iCalendar feeds are cached until a task, claim or worker changes.
+    'CALENDAR_CACHE_TIMEOUT': 24*60*60,  # Seconds
+    'CALENDAR_MAX_AGE': 5*60,  # Seconds that calendar clients may use a feed before checking for changes.
 }
 
 BZWOPS_INVENTORY_CONFIG = {
@@ -454,6 +502,16 @@ BZWOPS_BOOKS_CONFIG = {
     # Configuration specific to the "books" app.
     'SQUAREUP_LOCATION_ID': os.getenv('SQUAREUP_LOCATION_ID', None),
     'SQUAREUP_APIV1_TOKEN': os.getenv('SQUAREUP_APIV1_TOKEN', None),
+
+    # Changed transactions are marked dirty. If this is True, an rq job re-journals them soon after.
+    # Otherwise, they're re-journaled by "generatejournal --incremental".
+    'JOURNAL_ON_CHANGE': not TESTING,
+
+    # The number of journal entries that are accumulated before they're saved in bulk. See books.models.JournalBatch.
+    'JOURNAL_FLUSH_SIZE': 1000,
+
+    # The number of line items shown on each page of an account's history.
+    'ACCOUNT_HISTORY_PAGE_SIZE': 500,
 }
 
 BZWOPS_SODA_CONFIG = {
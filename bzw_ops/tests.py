@@ -1,5 +1,6 @@
 
 # Standard
+from unittest.mock import patch
 
 # Third Party
 from django.test import TestCase
@@ -7,6 +8,7 @@ from django.contrib import admin
 from django.core.management import call_command
 
 # Local
+import bzw_ops.jobs as jobs
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 
@@ -78,3 +80,67 @@ class TestProductionDatabase(TestCase):
 
     def test_with_dbcheck_command(self):
         call_command('dbcheck')
+
+
+class FakeRedis:
+
+    def __init__(self):
+        self.keys = {}
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.keys:
+            return None
+        self.keys[key] = value
+        return True
+
+    def delete(self, key):
+        self.keys.pop(key, None)
+
+
+class FakeQueue:
+
+    def __init__(self):
+        self.connection = FakeRedis()
+        self.jobs = []
+
+    def enqueue(self, func, *args):
+        self.jobs.append((func, args))
+
+
+class TestJobs(TestCase):
+
+    def test_coalescing(self):
+        queue = FakeQueue()
+        calls = []
+        with patch.object(jobs, 'get_queue', lambda name: queue):
+            jobs._enqueue(calls.append, ("a",), "test:a", 'default')
+            jobs._enqueue(calls.append, ("a",), "test:a", 'default')  # Coalesced with the first.
+            jobs._enqueue(calls.append, ("b",), "test:b", 'default')
+            jobs._enqueue(calls.append, ("c",), None, 'default')  # Jobs without keys are never coalesced.
+            jobs._enqueue(calls.append, ("c",), None, 'default')
+        self.assertEqual(len(queue.jobs), 4)
+        self.assertEqual(calls, [])  # Nothing has run in-process.
+
+    def test_fallback(self):
+        calls = []
+
+        def unavailable(name):
+            raise ConnectionError("No redis")
+
+        with patch.object(jobs, 'get_queue', unavailable):
+            jobs._enqueue(calls.append, ("a",), "test:a", 'default')
+        self.assertEqual(calls, ["a"])
+
+    def test_fallback_after_marking(self):
+        queue = FakeQueue()
+        calls = []
+
+        def unavailable(func, *args):
+            raise ConnectionError("No redis")
+
+        with patch.object(jobs, 'get_queue', lambda name: queue):
+            with patch.object(queue, 'enqueue', unavailable):
+                jobs._enqueue(calls.append, ("a",), "test:a", 'default')
+            jobs._enqueue(calls.append, ("a",), "test:a", 'default')  # Not coalesced with the failed attempt.
+        self.assertEqual(calls, ["a"])
+        self.assertEqual(len(queue.jobs), 1)
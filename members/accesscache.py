@@ -0,0 +1,111 @@
+# Standard
+import time
+from datetime import date
+from typing import Dict, NamedTuple, Optional
+import hashlib
+
+# Third Party
+from django.conf import settings
+from django.core.cache import cache
+
+# Local
+from members.models import Member, Membership, MembershipCoverage
+
+__author__ = 'adrian'
+
+# Door access decisions are made from an in-process snapshot of every registered card.
+# The snapshot is rebuilt when another process invalidates it, when the day changes, and when it gets old.
+# Other processes' invalidations are only checked for every so often, so most lookups don't touch the cache at all.
+
+_CONFIG = settings.BZWOPS_MEMBERS_CONFIG
+MAX_AGE = _CONFIG.get('ACCESS_CACHE_MAX_AGE', 10*60)
+CHECK_INTERVAL = _CONFIG.get('ACCESS_CACHE_CHECK_INTERVAL', 5)
+
+# Bumping this generation tells every process that its snapshot is stale.
+_GENERATION_KEY = "members:access-generation"
+
+
+class CardAccess(NamedTuple):
+    member_pk: int
+    membership_start_date: Optional[date]  # Of the member's latest membership.
+    membership_end_date: Optional[date]  # Of the member's latest membership.
+    paid_through: Optional[date]  # See MembershipCoverage.paid_through(), as of the snapshot's date.
+
+    @property
+    def membership_current(self) -> bool:
+        return self.paid_through is not None and self.paid_through >= date.today()
+
+
+_snapshot = {}  # type: Dict[str, CardAccess]
+_snapshot_key = None  # The (generation, date) that the snapshot was built for.
+_snapshot_time = 0.0
+_checked_generation = None  # type: Optional[int]
+_checked_time = 0.0
+
+
+def _generation() -> int:
+    gen = cache.get(_GENERATION_KEY)
+    if gen is None:
+        cache.add(_GENERATION_KEY, 0, None)
+        gen = cache.get(_GENERATION_KEY, 0)
+    return gen
+
+
+def _recent_generation() -> int:
+    # The generation as of at most CHECK_INTERVAL seconds ago.
+    global _checked_generation, _checked_time
+    if _checked_generation is None or time.monotonic() - _checked_time > CHECK_INTERVAL:
+        _checked_generation = _generation()
+        _checked_time = time.monotonic()
+    return _checked_generation
+
+
+def invalidate() -> None:
+    """Discards the access snapshots of all processes. Call this whenever cards or memberships change."""
+    global _snapshot_key, _checked_generation
+    _snapshot_key = None
+    _checked_generation = None
+    try:
+        cache.incr(_GENERATION_KEY)
+    except ValueError:
+        cache.add(_GENERATION_KEY, 0, None)
+
+
+def _build(today: date) -> Dict[str, CardAccess]:
+    cards = dict(
+        Member.objects
+        .exclude(membership_card_md5__isnull=True)
+        .exclude(membership_card_md5="")
+        .values_list('pk', 'membership_card_md5')
+    )
+    latest = {}  # Maps member pk to their latest membership's (start, end).
+    mships = Membership.objects\
+        .filter(member_id__in=cards.keys())\
+        .order_by('start_date')\
+        .values_list('member_id', 'start_date', 'end_date')
+    for member_pk, start, end in mships.iterator():
+        latest[member_pk] = start, end
+    paid_through = MembershipCoverage.paid_through(cards.keys(), today)
+
+    snapshot = {}
+    for member_pk, md5 in cards.items():
+        start, end = latest.get(member_pk, (None, None))
+        snapshot[md5] = CardAccess(member_pk, start, end, paid_through.get(member_pk))
+    return snapshot
+
+
+def snapshot() -> Dict[str, CardAccess]:
+    """Returns a dict that maps the md5 of each registered card to its access info."""
+    global _snapshot, _snapshot_key, _snapshot_time
+    today = date.today()
+    key = _recent_generation(), today
+    if key != _snapshot_key or time.monotonic() - _snapshot_time > MAX_AGE:
+        _snapshot = _build(today)
+        _snapshot_key = key
+        _snapshot_time = time.monotonic()
+    return _snapshot
+
+
+def lookup(card_str: str) -> Optional[CardAccess]:
+    """Returns the access info for the given card, or None if the card isn't registered."""
+    return snapshot().get(hashlib.md5(card_str.encode()).hexdigest())
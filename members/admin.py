@@ -12,7 +12,7 @@ from reversion.admin import VersionAdmin
 # Local
 from books.admin import Sellable, Invoiceable, sale_link
 from members.models import (
-    Tag, Pushover, Tagging, VisitEvent,
+    Tag, Pushover, Notification, Tagging, VisitEvent,
     Member, Membership, GroupMembership, KeyFee, ExternalId,
     MemberNote, MemberLogin, MembershipGiftCardRedemption,
     MembershipGiftCard, MembershipGiftCardReference, MembershipCampaign,
@@ -75,6 +75,25 @@ class VisitEventAdmin(admin.ModelAdmin):  # No need to version events.
     raw_id_fields = ['who']
 
 
+@admin.register(Notification)
+class NotificationAdmin(admin.ModelAdmin):  # No need to version the outbox.
+
+    def has_add_permission(self, request):
+        return False
+        # Don't allow humans to add these. They are created by automated processes.
+
+    ordering = ['-created']
+    list_display = ['pk', 'created', 'who', 'via', 'title', 'status', 'attempts', 'sent', 'last_error']
+    search_fields = [
+        '^who__auth_user__first_name',
+        '^who__auth_user__last_name',
+        '^who__auth_user__username',
+    ]
+    list_filter = ['status', 'created']
+    date_hierarchy = 'created'
+    raw_id_fields = ['who', 'via']
+
+
 class MemberTypeFilter(admin.SimpleListFilter):
     title = "Worker Type"
     parameter_name = 'type'
@@ -1,6 +1,8 @@
 
 # Standard
+from collections import OrderedDict, defaultdict
 from datetime import datetime, date, timedelta, time
+from typing import Dict, List, Tuple
 import logging
 
 # Third Party
@@ -12,7 +14,8 @@ from django.conf import settings
 from freezegun import freeze_time
 
 # Local
-from members.models import Membership, VisitEvent
+from members.models import Member, Membership, VisitEvent
+from modelmailer.batch import MailBatch
 
 __author__ = 'adrian'
 
@@ -58,58 +61,77 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         # Intended for test cases which will run on a specific date.
         parser.add_argument('--date')
+        # By default, yesterday's visits are checked. These allow backfills over a range of dates.
+        parser.add_argument('--start', help="The first visit date to check, as YYYY-MM-DD.")
+        parser.add_argument('--end', help="The last visit date to check, as YYYY-MM-DD.")
 
     def process_bad_visitors(self, bad_visitors):
-        for member, (pm, visit) in bad_visitors.items():
 
-            if member.email in [None, ""]:
-                logger.info("Bad visit by %s but they haven't provided an email address.", member.username)
-                continue
+        text_content_template = get_template('members/email-unpaid-visit.txt')
+        html_content_template = get_template('members/email-unpaid-visit.html')
 
-            if not member.nag_re_membership:
-                logger.info("Bad visit by %s but they're not configured to nag re membership.", member.username)
-                continue
+        with MailBatch() as batch:
+            for member, (pm, visit) in bad_visitors.items():
+
+                if member.email in [None, ""]:
+                    logger.info("Bad visit by %s but they haven't provided an email address.", member.username)
+                    continue
+
+                if not member.nag_re_membership:
+                    logger.info("Bad visit by %s but they're not configured to nag re membership.", member.username)
+                    continue
 
-            # Send email messages:
-            text_content_template = get_template('members/email-unpaid-visit.txt')
-            html_content_template = get_template('members/email-unpaid-visit.html')
-
-            d = {
-                'friendly_name': member.friendly_name,
-                'paid_membership': pm,
-                'bad_visit': visit,
-                'is_keyholder': member.is_tagged_with("Keyholder"),
-            }
-
-            subject = 'Please Renew your Xerocraft Membership'
-            from_email = EMAIL_TREASURER
-            bcc_email = EMAIL_ARCHIVE
-            to = member.email
-            text_content = text_content_template.render(d)
-            html_content = html_content_template.render(d)
-            msg = EmailMultiAlternatives(subject, text_content, from_email, [to], [bcc_email])
-            msg.attach_alternative(html_content, "text/html")
-            msg.send()
-
-            logger.info("Email sent to %s re bad visit.", member.username)
-            pm.when_nudged = date.today()
-            pm.nudge_count += 1
-            pm.save()
+                # Send email messages:
+                d = {
+                    'friendly_name': member.friendly_name,
+                    'paid_membership': pm,
+                    'bad_visit': visit,
+                    'is_keyholder': member.is_tagged_with("Keyholder"),
+                }
+
+                subject = 'Please Renew your Xerocraft Membership'
+                from_email = EMAIL_TREASURER
+                bcc_email = EMAIL_ARCHIVE
+                to = member.email
+                text_content = text_content_template.render(d)
+                html_content = html_content_template.render(d)
+                msg = EmailMultiAlternatives(subject, text_content, from_email, [to], [bcc_email])
+                msg.attach_alternative(html_content, "text/html")
+
+                # Only count the nudge if the email actually went out.
+                def nudged(member=member, pm=pm):
+                    logger.info("Email sent to %s re bad visit.", member.username)
+                    pm.when_nudged = date.today()
+                    pm.nudge_count += 1
+                    pm.save()
+
+                batch.add(msg, on_sent=nudged)
 
     # TODO: "Open" times should be defined in a database table.
     def during_open_hack(self, visit):
-        assert timezone.localtime(visit.when).date() == self.yesterday.date()
+        local_when = timezone.localtime(visit.when)
         time_leeway = timedelta(hours=1)
         for (hack_dow, hack_start, hack_end) in OPENHACKS:
-            visit_dow = timezone.localtime(visit.when).weekday()
-            if visit_dow == hack_dow:
-                hack_start = self.tz.localize(datetime.combine(self.yesterday, hack_start))
-                hack_end = self.tz.localize(datetime.combine(self.yesterday, hack_end))
+            if local_when.weekday() == hack_dow:
+                hack_start = self.tz.localize(datetime.combine(local_when.date(), hack_start))
+                hack_end = self.tz.localize(datetime.combine(local_when.date(), hack_end))
                 if hack_start-time_leeway <= visit.when <= hack_end+time_leeway:
                     return True
         return False
 
-    def collect_bad_visitors(self):
+    def is_covered(self, pms: List[Membership], visit_date: date) -> bool:
+        for pm in pms:
+            if pm.start_date <= visit_date <= (pm.end_date + self.leeway):
+                # Don't nag because the latest paid membership covers the visit.
+                # Note that there's some leeway in this to allow time for payments to be processed.
+                return True
+            if pm.start_date > visit_date:
+                # Don't nag because there is a future paid membership.
+                return True
+        return False
+
+    def collect_bad_visitors(self, start_date: date, end_date: date) -> Dict[Member, Tuple[Membership, VisitEvent]]:
+        """Finds the members that visited without paying on the given (local) dates, along with their first such visit."""
 
         # NOTE: Don't want "members" to depend on "tasks".
         # This attempts to dynamically load "tasks".
@@ -121,57 +143,62 @@ class Command(BaseCommand):
             # The website doesn't have "tasks" installed.
             Work = None
 
-        bad_visitors = {}
-
-        yesterdays_visits = VisitEvent.objects.filter(when__range=[self.yesterday, self.today])
-        for visit in yesterdays_visits:
-            pms = None
-            work_count = None
+        range_start = self.tz.localize(datetime.combine(start_date, time()))
+        range_end = self.tz.localize(datetime.combine(end_date + timedelta(days=1), time()))
+        visits = VisitEvent.objects\
+            .filter(when__range=[range_start, range_end])\
+            .select_related('who__auth_user')\
+            .prefetch_related('who__tags')\
+            .order_by('when')
+
+        # Ignore visits during open hacks because all open hack visits are OK.
+        # The rest are grouped by visitor so that each visitor's info is only fetched once.
+        visits_by_member = OrderedDict()
+        for visit in visits:
+            if not self.during_open_hack(visit):
+                visits_by_member.setdefault(visit.who, []).append(visit)
+        member_ids = [member.pk for member in visits_by_member]
+
+        pms_by_member = defaultdict(list)
+        for pm in Membership.objects.filter(member_id__in=member_ids).order_by('start_date', 'pk'):
+            pms_by_member[pm.member_id].append(pm)
+
+        work_days = set()
+        if Work is not None:
+            work_days = set(Work.objects
+                .filter(claim__claiming_member_id__in=member_ids, work_date__range=[start_date, end_date])
+                .values_list('claim__claiming_member_id', 'work_date'))
 
-            if self.during_open_hack(visit):
-                # Ignore the visit if it was during open hacks because all open hack visits are OK.
-                continue
+        bad_visitors = {}
+        for member, member_visits in visits_by_member.items():
 
-            if visit.who.is_tagged_with("Director"):
-                # Ignore visits by directors (who have decided they don't need to pay).
+            if member.is_tagged_with("Director"):
+                # Directors have decided they don't need to pay.
                 continue
 
-            pms = Membership.objects.filter(member=visit.who).all()
+            pms = pms_by_member[member.pk]
             if len(pms) == 0:
                 # Don't nag people that have NEVER paid because either:
                 #  1) It's too soon to bother the member.
                 #  2) The member is hopeless and will never pay.
                 continue
-            else:
-                covered = False
-                for pm in pms:
-                    if pm.start_date <= visit.when.date() <= (pm.end_date + self.leeway):
-                        # Don't nag because the latest paid membership covers the visit.
-                        # Note that there's some leeway in this to allow time for payments to be processed.
-                        covered = True
-                        break
-                    if pm.start_date > visit.when.date():
-                        # Don't nag because there is a future paid membership.
-                        covered = True
-                        break
-                if covered:
-                    continue
-
-            if Work is not None:
-                work_count = Work.objects.filter(
-                    claim__claiming_member=visit.who, work_date=visit.when.date()
-                ).count()
-                if work_count > 0:
-                    # Don't nag somebody who did volunteer work the day they visited.
-                    continue
 
+            # This is the membership that will be referred to in the nudge.
+            pm = pms[-1]
             if pm.when_nudged == self.today.date():
                 # Don't nag somebody more than once per day.
                 continue
 
-            # Make a note to nag this visitor
-            if visit.who not in bad_visitors:
-                bad_visitors[visit.who] = (pm, visit)
+            for visit in member_visits:
+                visit_date = timezone.localtime(visit.when).date()
+                if self.is_covered(pms, visit_date):
+                    continue
+                if (member.pk, visit_date) in work_days:
+                    # Don't nag somebody who did volunteer work the day they visited.
+                    continue
+                # Make a note to nag this visitor
+                bad_visitors[member] = (pm, visit)
+                break
 
         return bad_visitors
 
@@ -187,7 +214,14 @@ class Command(BaseCommand):
         self.today = timezone.make_aware(self.today, timezone.get_default_timezone())
         self.yesterday = self.today - timedelta(days=1)
 
-        bad_visitors = self.collect_bad_visitors()
+        start_date = self.yesterday.date()
+        if options['start'] is not None:
+            start_date = datetime.strptime(options['start'], "%Y-%m-%d").date()
+        end_date = self.yesterday.date()
+        if options['end'] is not None:
+            end_date = datetime.strptime(options['end'], "%Y-%m-%d").date()
+
+        bad_visitors = self.collect_bad_visitors(start_date, end_date)
         self.process_bad_visitors(bad_visitors)
 
         if test_time is not None:
@@ -0,0 +1,20 @@
+# Standard
+
+# Third Party
+from django.core.management.base import BaseCommand
+
+# Local
+from members.models import MembershipCoverage
+import members.accesscache as accesscache
+
+__author__ = 'adrian'
+
+
+class Command(BaseCommand):
+
+    help = "Rederives all members' coverage periods from their memberships, repairing any drift."
+
+    def handle(self, **options):
+        MembershipCoverage.refresh()
+        accesscache.invalidate()
+        self.stdout.write("Rebuilt {} coverage period(s).".format(MembershipCoverage.objects.count()))
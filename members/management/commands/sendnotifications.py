@@ -0,0 +1,33 @@
+# Standard
+import time
+
+# Third Party
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+# Local
+import members.notifications as notifications
+
+__author__ = 'adrian'
+
+
+class Command(BaseCommand):
+
+    help = "Attempts delivery of queued notifications that are due, including retries of earlier failures. " \
+           "Run with --every to keep doing so, e.g. as the 'notifier' process in the Procfile."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--every', type=int, default=None, metavar='SECONDS',
+            help="Repeat forever, pausing this many seconds between passes.")
+
+    def handle(self, **options):
+        every = options['every']
+        while True:
+            attempted = notifications.deliver_due()
+            if every is None or attempted > 0:
+                self.stdout.write("Attempted delivery of {} notification(s).".format(attempted))
+            if every is None:
+                break
+            time.sleep(every)
+            # Like the rq worker, this is long running, so don't reuse database connections that may have dropped.
+            close_old_connections()
@@ -0,0 +1,33 @@
+# Generated by Django 2.0.3 on 2026-10-17 04:09
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('members', '0019_auto_20180422_1221'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Notification',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(blank=True, help_text='The title of the message.', max_length=250)),
+                ('message', models.TextField(help_text='The body of the message.', max_length=1024)),
+                ('url', models.CharField(blank=True, help_text='An optional URL to accompany the message.', max_length=512)),
+                ('url_title', models.CharField(blank=True, help_text='An optional title for the URL.', max_length=100)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, help_text='Date/time the message was queued.')),
+                ('status', models.CharField(choices=[('P', 'Pending'), ('S', 'Sent'), ('F', 'Failed')], db_index=True, default='P', help_text="Pending messages are still to be delivered. Failed messages won't be retried.", max_length=1)),
+                ('attempts', models.IntegerField(default=0, help_text='The number of delivery attempts made so far.')),
+                ('next_attempt', models.DateTimeField(db_index=True, default=django.utils.timezone.now, help_text='For pending messages, the earliest date/time of the next delivery attempt.')),
+                ('sent', models.DateTimeField(blank=True, default=None, help_text='Date/time the message was delivered.', null=True)),
+                ('last_error', models.CharField(blank=True, help_text='The reason the most recent delivery attempt failed, if it did.', max_length=255)),
+                ('via', models.ForeignKey(help_text='The notification mechanism through which the message is to be delivered.', on_delete=django.db.models.deletion.CASCADE, to='members.Pushover')),
+                ('who', models.ForeignKey(help_text='The member to be notified.', on_delete=django.db.models.deletion.CASCADE, to='members.Member')),
+            ],
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 2.0.3 on 2026-10-17 04:15
+
+from collections import defaultdict
+from datetime import timedelta
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_coverage(apps, schema_editor):
+    Membership = apps.get_model('members', 'Membership')
+    MembershipCoverage = apps.get_model('members', 'MembershipCoverage')
+    periods = defaultdict(list)
+    for member_id, start, end in Membership.objects.filter(member__isnull=False).values_list('member_id', 'start_date', 'end_date'):
+        periods[member_id].append((start, end))
+    coverage = []
+    for member_id, member_periods in periods.items():
+        merged = []
+        for start, end in sorted(member_periods):
+            if len(merged) > 0 and start <= merged[-1][1] + timedelta(days=1):
+                merged[-1] = merged[-1][0], max(end, merged[-1][1])
+            else:
+                merged.append((start, end))
+        coverage += [MembershipCoverage(member_id=member_id, start_date=start, end_date=end) for start, end in merged]
+    MembershipCoverage.objects.bulk_create(coverage)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('members', '0020_notification'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MembershipCoverage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_date', models.DateField(help_text='The first day of coverage.')),
+                ('end_date', models.DateField(help_text='The last day of coverage.')),
+                ('member', models.ForeignKey(help_text='The member who is covered.', on_delete=django.db.models.deletion.CASCADE, related_name='coverage', to='members.Member')),
+            ],
+            options={
+                'ordering': ['member', 'start_date'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='membershipcoverage',
+            index=models.Index(fields=['member', 'start_date', 'end_date'], name='members_mem_member__c11b9e_idx'),
+        ),
+        migrations.RunPython(populate_coverage, migrations.RunPython.noop),
+    ]
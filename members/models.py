@@ -2,18 +2,23 @@
 
 # Standard
 import base64
+import logging
 import uuid
 import hashlib
 import re
 from datetime import datetime, date, timedelta, time
 from decimal import Decimal
-from typing import Union, Tuple, Optional
+from typing import Union, Tuple, Optional, List, Dict, Set, FrozenSet, Iterable
 import abc
+from bisect import bisect_left
+from collections import defaultdict
 
 # Third Party
 from django.conf import settings
-from django.db import models
+from redis import RedisError
+from django.db import models, transaction
 from django.utils import timezone
+from django.utils.functional import cached_property
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.utils.translation import ugettext_lazy as _
@@ -21,17 +26,22 @@ from django.utils.translation import ugettext_lazy as _
 # Local
 from books.models import (
     Account, Sale, ReceivableInvoice,
-    JournalEntry, JournalEntryLineItem, Journaler, JournalLiner,
+    JournalEntry, JournalEntryLineItem, JournalBatch, Journaler, JournalLiner,
     ACCT_REVENUE_MEMBERSHIP, ACCT_LIABILITY_UNEARNED_MSHIP_REVENUE,
     quote_entity
 )
 from abutils.utils import generate_ctrlid
 from abutils.time import is_very_last_day_of_month
+from members.signals import visit_events_created
 
 TZ = timezone.get_default_timezone()
 
+logger = logging.getLogger("members")
+
 ORG_NAME = settings.BZWOPS_CONFIG.get('ORG_NAME', "")
 
+TESTING = getattr(settings, 'TESTING', False)
+
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 # CTRLID Functions
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
@@ -186,32 +196,53 @@ class Member(models.Model):
         self.save()
         return b64
 
+    @cached_property
+    def tag_names(self) -> FrozenSet[str]:
+        """The names of the member's tags. Computed once per instance, or in bulk via prefetch_related('tags')."""
+        return frozenset(tag.name for tag in self.tags.all())
+
+    @cached_property
+    def can_tag_names(self) -> FrozenSet[str]:
+        """The names of the tags with which the member can tag others. Computed once per instance."""
+        return frozenset(
+            Tagging.objects
+            .filter(tagged_member=self, can_tag=True)
+            .values_list('tag__name', flat=True)
+        )
+
+    def forget_tags(self) -> None:
+        """Discards the cached tag names. Called when one of the member's taggings changes."""
+        self.__dict__.pop('tag_names', None)
+        self.__dict__.pop('can_tag_names', None)
+        getattr(self, '_prefetched_objects_cache', {}).pop('tags', None)
+
     def is_tagged_with(self, tag_or_tagname) -> bool:
         '''Determine if member is tagged with the given tag or tag-name.'''
         if type(tag_or_tagname) is Tag:
             tag = tag_or_tagname  # type: Tag
-            return tag in self.tags.all()
+            return tag.name in self.tag_names
         elif type(tag_or_tagname) is str:
             tagname = tag_or_tagname  # type: str
-            return tagname in [x.name for x in self.tags.all()]
+            return tagname in self.tag_names
 
     def can_tag_with(self, tag):
         '''Determine if member can tag others with tags having given tag-name.'''
-        for tagging in self.taggings.all():
-            if tagging.tag.name == tag.name:
-                return tagging.can_tag
-        return False
+        return tag.name in self.can_tag_names
 
     def is_domain_staff(self):  # Different than website staff.
         return self.is_tagged_with("Staff")
 
     def is_currently_paid(self, grace_period=timedelta(0)) -> bool:
         """Determine whether member is currently covered by a membership with a given grace period."""
-        mship = self.latest_nonfuture_membership
-        if mship is None:
+        paid_through = self.paid_through()
+        if paid_through is None:
             return False
         else:
-            return mship.end_date + grace_period >= date.today()
+            return paid_through + grace_period >= date.today()
+
+    def paid_through(self, on: Optional[date]=None) -> Optional[date]:
+        """The last day of the member's coverage that started most recently on or before the given date (default today)."""
+        return MembershipCoverage.paid_through([self.pk], on).get(self.pk)
 
     @property
     def latest_nonfuture_membership(self) -> Optional['Membership']:
@@ -366,10 +397,66 @@ class Pushover(models.Model):
         except Pushover.DoesNotExist:
             return None
 
+    def __str__(self):
+        return "{} for {}".format(self.get_mechanism_display(), self.who)
+
     class Meta:
         verbose_name = "Notification Mechanism"
 
 
+class Notification(models.Model):
+    """ An outbox entry for a message to be delivered via one of a member's notification mechanisms. """
+
+    who = models.ForeignKey(Member,
+        on_delete=models.CASCADE,  # There's no point in delivering messages to deleted members.
+        help_text="The member to be notified.")
+
+    via = models.ForeignKey(Pushover,
+        on_delete=models.CASCADE,  # If the mechanism is removed, undelivered messages can't be sent.
+        help_text="The notification mechanism through which the message is to be delivered.")
+
+    title = models.CharField(max_length=250, blank=True,
+        help_text="The title of the message.")
+
+    message = models.TextField(max_length=1024,
+        help_text="The body of the message.")
+
+    url = models.CharField(max_length=512, blank=True,
+        help_text="An optional URL to accompany the message.")
+
+    url_title = models.CharField(max_length=100, blank=True,
+        help_text="An optional title for the URL.")
+
+    created = models.DateTimeField(null=False, blank=False, default=timezone.now,
+        help_text="Date/time the message was queued.")
+
+    STAT_PENDING = "P"
+    STAT_SENT = "S"
+    STAT_FAILED = "F"
+    STATUS_CHOICES = [
+        (STAT_PENDING, "Pending"),
+        (STAT_SENT, "Sent"),
+        (STAT_FAILED, "Failed"),
+    ]
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES, default=STAT_PENDING, db_index=True,
+        help_text="Pending messages are still to be delivered. Failed messages won't be retried.")
+
+    attempts = models.IntegerField(default=0,
+        help_text="The number of delivery attempts made so far.")
+
+    next_attempt = models.DateTimeField(default=timezone.now, db_index=True,
+        help_text="For pending messages, the earliest date/time of the next delivery attempt.")
+
+    sent = models.DateTimeField(null=True, blank=True, default=None,
+        help_text="Date/time the message was delivered.")
+
+    last_error = models.CharField(max_length=255, blank=True,
+        help_text="The reason the most recent delivery attempt failed, if it did.")
+
+    def __str__(self):
+        return "{} for {}".format(self.title, self.who)
+
+
 class Tagging(models.Model):
     """ Intermediate table representing the many-tomany relation between Member and Tag
     """
@@ -407,6 +494,7 @@ class Tagging(models.Model):
         if tagger.can_tag_with(tag):
             try:
                 tag = Tagging.objects.get(tagged_member=taggee, tag=tag)
+                tag.tagged_member = taggee  # So that the taggee's cached tag names are discarded.
                 tag.delete()
             except Tagging.DoesNotExist:
                 pass
@@ -489,23 +577,170 @@ class VisitEvent(models.Model):
         default=None, null=True, blank=True,
         help_text="The reason for a visit. Not used on Departures.")
 
+    # For the purpose of counting a member's visits per day, the day begins at 4am.
+    DAY_START = time(4)
+
+    # The latest event of each type for each member is kept in a redis hash of its time, day and ordinal on that day,
+    # so that the receivers of a new event can learn about the member's previous ones without querying for them.
+    SEEN_TIMEOUT = 24*60*60
+
+    # If the hash holds an event that's older than the new one, replaces it with the new one and returns the old one's
+    # time along with the new one's ordinal on its day. Otherwise returns nil. Redis runs it atomically, so
+    # simultaneous events are counted one after the other.
+    _NOTE_SEEN_LUA = """
+        local last = redis.call('HMGET', KEYS[1], 'when', 'day', 'count')
+        if not last[1] or tonumber(last[1]) >= tonumber(ARGV[1]) then
+            return nil
+        end
+        local count = 1
+        if last[2] == ARGV[2] then
+            count = tonumber(last[3]) + 1
+        end
+        redis.call('HMSET', KEYS[1], 'when', ARGV[1], 'day', ARGV[2], 'count', count)
+        redis.call('EXPIRE', KEYS[1], ARGV[3])
+        return {last[1], count}
+    """
+
+    # Sets up the hash from the database, replacing whatever it held, since that was either missing or stale.
+    _SEED_SEEN_LUA = """
+        redis.call('HMSET', KEYS[1], 'when', ARGV[1], 'day', ARGV[2], 'count', ARGV[3])
+        redis.call('EXPIRE', KEYS[1], ARGV[4])
+    """
+
+    _seen_info = None  # type: Tuple[Optional[datetime], int]
+
+    @staticmethod
+    def _seen_key(who_id: int, event_type: str) -> str:
+        # Tests use the same redis as the worker, so their keys are kept apart from the real ones.
+        return "{}members:last-visit:{}:{}".format("test:" if TESTING else "", who_id, event_type)
+
+    @staticmethod
+    def _seen_conn():
+        # Imported here because bzw_ops.worker sets Django up, which can't be done while apps are loading.
+        from bzw_ops.worker import conn
+        return conn
+
+    @staticmethod
+    def forget_seen(who_id: int, event_type: str) -> None:
+        """Discards the info kept about the member's latest event of the given type, e.g. because it changed."""
+        try:
+            VisitEvent._seen_conn().delete(VisitEvent._seen_key(who_id, event_type))
+        except RedisError as e:
+            logger.warning("Couldn't forget latest visit of %d: %s", who_id, str(e))
+
+    def _day_of(self, when: datetime) -> date:
+        return (timezone.localtime(when) - timedelta(hours=self.DAY_START.hour)).date()
+
+    def _seen_from_db(self) -> Tuple[Optional[datetime], int, int]:
+        """Returns the time of the member's previous event of this type, the number of their earlier events
+        of this type on this one's day, and the number of their events of this type that are later than this one.
+        """
+        day_start = TZ.localize(datetime.combine(self._day_of(self.when), self.DAY_START))
+        info = VisitEvent.objects\
+            .filter(who_id=self.who_id, event_type=self.event_type)\
+            .exclude(pk=self.pk)\
+            .aggregate(
+                prev_when=models.Max('when', filter=models.Q(when__lt=self.when)),
+                count=models.Count('pk', filter=models.Q(when__gte=day_start, when__lt=self.when)),
+                later=models.Count('pk', filter=models.Q(when__gte=self.when)),
+            )
+        return info['prev_when'], info['count'], info['later']
+
+    def note_seen(self) -> Tuple[Optional[datetime], int]:
+        """
+        Returns the time of the member's previous event of this type and this event's ordinal on its day.
+        This is determined once per event, from redis if possible, which is then updated to hold this event.
+        """
+        if self._seen_info is not None:
+            return self._seen_info
+
+        key = VisitEvent._seen_key(self.who_id, self.event_type)
+        day = self._day_of(self.when)
+        args = [self.when.timestamp(), day.toordinal(), self.SEEN_TIMEOUT]
+        try:
+            conn = VisitEvent._seen_conn()
+            seen = conn.eval(self._NOTE_SEEN_LUA, 1, key, *args)
+            if seen is None:
+                # Either redis doesn't know about the member's latest event or this event is out of order.
+                prev_when, count, later = self._seen_from_db()
+                if later > 0:
+                    # Redis' count for this event's day (if it has one) doesn't include this event.
+                    conn.delete(key)
+                else:
+                    # Seed redis with the member's previous event and then count this one after it.
+                    prev_stamp = prev_when.timestamp() if prev_when is not None else 0
+                    prev_day = self._day_of(prev_when).toordinal() if prev_when is not None else 0
+                    conn.eval(self._SEED_SEEN_LUA, 1, key, prev_stamp, prev_day, count, self.SEEN_TIMEOUT)
+                    seen = conn.eval(self._NOTE_SEEN_LUA, 1, key, *args)
+        except RedisError as e:
+            logger.warning("Couldn't note visit of %d in redis, so asking the database: %s", self.who_id, str(e))
+            seen = None
+            prev_when, count, _ = self._seen_from_db()
+
+        if seen is not None:
+            prev_stamp, ordinal = seen
+            prev_when = datetime.fromtimestamp(float(prev_stamp), timezone.utc) if float(prev_stamp) > 0 else None
+            self._seen_info = prev_when, ordinal
+        else:
+            self._seen_info = prev_when, count + 1
+        return self._seen_info
+
     def debounced(self) -> bool:
         """
         RFID checkin systems may fire multiple times. Skip checkin if "too close" to the prev checkin time.
         This method is analogous with "button debouncing" in electronics, hence the name.
         Returns True if visit should be considered, else false.
         """
-        try:
-            prev_criteria = {
-                'who': self.who,
-                'event_type': self.event_type,
-                'when__lt': self.when
-            }
-            recent_visit = VisitEvent.objects.filter(**prev_criteria).latest('when')
-            delta = self.when - recent_visit.when
-        except VisitEvent.DoesNotExist:
-            delta = timedelta.max
-        return delta > timedelta(hours=1)
+        prev_when, _ = self.note_seen()
+        if prev_when is None:
+            return True
+        return self.when - prev_when > timedelta(hours=1)
+
+    def is_first_of_day(self) -> bool:
+        """Determine whether this is the member's first event of this type on its day. See DAY_START."""
+        _, count = self.note_seen()
+        return count == 1
+
+    @staticmethod
+    def bulk_ingest(events: List['VisitEvent'], debounce: timedelta) -> List['VisitEvent']:
+        """
+        Creates the given (unsaved) events in a single insert, skipping any that are within the debounce period
+        of another event (already recorded or earlier in the list) of the same type, member and method.
+        This discards duplicates as well as bounces.
+        Receivers of the visit_events_created signal are sent the list of events that were actually created.
+        """
+        if len(events) == 0:
+            return []
+        events = sorted(events, key=lambda e: e.when)
+
+        # The times of the events recorded so far for each (who, type, method), in order.
+        # Seeded with those already in the DB that are near enough to affect the given events.
+        recorded = defaultdict(list)
+        nearby = VisitEvent.objects\
+            .filter(
+                who_id__in={e.who_id for e in events},
+                when__gte=events[0].when - debounce,
+                when__lte=events[-1].when + debounce,
+            )\
+            .order_by('when')\
+            .values_list('who_id', 'event_type', 'method', 'when')
+        for who_id, event_type, method, when in nearby:
+            recorded[who_id, event_type, method].append(when)
+
+        created = []
+        for event in events:
+            times = recorded[event.who_id, event.event_type, event.method]
+            i = bisect_left(times, event.when)
+            if i < len(times) and times[i] - event.when <= debounce:
+                continue  # A duplicate (e.g. a batch that was resent) or a bounce.
+            if i > 0 and event.when - times[i-1] <= debounce:
+                continue  # A bounce.
+            times.insert(i, event.when)
+            created.append(event)
+
+        created = VisitEvent.objects.bulk_create(created)
+        visit_events_created.send(sender=VisitEvent, events=created)
+        return created
 
     def __str__(self):
         return "%s, %s, %s" % (self.when.isoformat()[:10], self.who, self.event_type)
@@ -647,7 +882,7 @@ class MembershipJournalLiner(JournalLiner, models.Model):
     class Meta:
         abstract = True
 
-    def create_membership_jelis(self, je: JournalEntry):
+    def create_membership_jelis(self, je: JournalEntry, batch: JournalBatch):
 
         # Interestingly, this case requires that we create a number of future revenue recognition
         # journal entries, in addition to the line items we create for the sale's journal entry.
@@ -673,7 +908,7 @@ class MembershipJournalLiner(JournalLiner, models.Model):
                 description="To (earned) membership revenue"
             ))
 
-            Journaler.batch(je2)
+            batch.add(je2)
 
         if hasattr(self, 'member') and hasattr(self, 'membership_type'):
             uname = quote_entity(self.member.username) if self.member is not None else "unknown"
@@ -753,8 +988,8 @@ class GroupMembership(MembershipJournalLiner):
             if mship.membership_type != Membership.MT_GROUP:
                 raise ValidationError(_("Individual memberships covered by a group membership must have type GROUP."))
 
-    def create_journalentry_lineitems(self, je: JournalEntry):
-        self.create_membership_jelis(je)
+    def create_journalentry_lineitems(self, je: JournalEntry, batch: JournalBatch):
+        self.create_membership_jelis(je, batch)
         # je.prebatch(JournalEntryLineItem(
         #     account=Account.get(ACCT_REVENUE_MEMBERSHIP),
         #     action=JournalEntryLineItem.ACTION_BALANCE_INCREASE,
@@ -886,8 +1121,89 @@ class Membership(MembershipJournalLiner):
     class Meta:
         ordering = ['start_date']
 
-    def create_journalentry_lineitems(self, je: JournalEntry):
-        self.create_membership_jelis(je)
+    def create_journalentry_lineitems(self, je: JournalEntry, batch: JournalBatch):
+        self.create_membership_jelis(je, batch)
+
+
+class MembershipCoverage(models.Model):
+    """
+    The periods during which a member is covered by one or more memberships, including those that are parts of
+    group memberships. Memberships that overlap or abut are merged, so a member's periods never overlap.
+    These are derived from Membership and are kept up to date as memberships are saved and deleted.
+    """
+
+    member = models.ForeignKey(Member, related_name='coverage',
+        on_delete=models.CASCADE,  # Coverage is derived from memberships and is meaningless without the member.
+        help_text="The member who is covered.")
+
+    start_date = models.DateField(help_text="The first day of coverage.")
+
+    end_date = models.DateField(help_text="The last day of coverage.")
+
+    def __str__(self):
+        return "{}, {} to {}".format(self.member, self.start_date, self.end_date)
+
+    class Meta:
+        ordering = ['member', 'start_date']
+        indexes = [models.Index(fields=['member', 'start_date', 'end_date'])]
+
+    @staticmethod
+    def merge(periods: Iterable[Tuple[date, date]]) -> List[Tuple[date, date]]:
+        """Merges (start, end) periods that overlap or abut. Returns the merged periods in order."""
+        merged = []
+        for start, end in sorted(periods):
+            if len(merged) > 0 and start <= merged[-1][1] + timedelta(days=1):
+                merged[-1] = merged[-1][0], max(end, merged[-1][1])
+            else:
+                merged.append((start, end))
+        return merged
+
+    @classmethod
+    def refresh(cls, member_ids: Optional[Iterable[int]]=None) -> None:
+        """Rederives the coverage of the given members from their memberships or, if member_ids is None, of all members."""
+        mships = Membership.objects.filter(member__isnull=False)
+        old = MembershipCoverage.objects.all()
+        members = Member.objects.all()
+        if member_ids is not None:
+            member_ids = set(member_ids)
+            mships = mships.filter(member_id__in=member_ids)
+            old = old.filter(member_id__in=member_ids)
+            members = members.filter(pk__in=member_ids)
+        with transaction.atomic():
+            # Refreshes of the same member take turns. The memberships are read once the lock is held,
+            # so a refresh can't write coverage derived from memberships that a concurrent one has since changed.
+            list(members.select_for_update().order_by('pk').values_list('pk', flat=True))
+            periods = defaultdict(list)
+            for member_id, start, end in mships.values_list('member_id', 'start_date', 'end_date').iterator():
+                periods[member_id].append((start, end))
+            old.delete()
+            MembershipCoverage.objects.bulk_create([
+                MembershipCoverage(member_id=member_id, start_date=start, end_date=end)
+                for member_id, member_periods in periods.items()
+                for start, end in MembershipCoverage.merge(member_periods)
+            ])
+
+    @staticmethod
+    def paid_through(member_ids: Iterable[int], on: Optional[date]=None) -> Dict[int, date]:
+        """
+        Maps each of the given members to the last day of the coverage that started most recently on or before the
+        given date (default today). Members that have no such coverage are omitted.
+        A member is paid on the given date if, and only if, they map to that date or later.
+        """
+        on = date.today() if on is None else on
+        rows = MembershipCoverage.objects\
+            .filter(member_id__in=member_ids, start_date__lte=on)\
+            .values('member_id')\
+            .annotate(paid_through=models.Max('end_date'))\
+            .values_list('member_id', 'paid_through')
+        return dict(rows)
+
+    @staticmethod
+    def paid_on(member_ids: Iterable[int], on: date) -> Set[int]:
+        """Returns the subset of the given members that are covered on the given date."""
+        return set(MembershipCoverage.objects\
+            .filter(member_id__in=member_ids, start_date__lte=on, end_date__gte=on)\
+            .values_list('member_id', flat=True))
 
 
 class KeyFee(MembershipJournalLiner):
@@ -916,8 +1232,8 @@ class KeyFee(MembershipJournalLiner):
     protected = models.BooleanField(default=False,
         help_text="Protect against further auto processing by ETL, etc. Prevents overwrites of manually entered data.")
 
-    def create_journalentry_lineitems(self, je: JournalEntry):
-        self.create_membership_jelis(je)
+    def create_journalentry_lineitems(self, je: JournalEntry, batch: JournalBatch):
+        self.create_membership_jelis(je, batch)
 
     def clean(self):
         # Range covered should be a subset of the membership
@@ -1013,7 +1329,7 @@ class MembershipGiftCardReference(models.Model, JournalLiner):
     class Meta:
         verbose_name = "Membership gift card"
 
-    def create_journalentry_lineitems(self, je: JournalEntry):
+    def create_journalentry_lineitems(self, je: JournalEntry, batch: JournalBatch):
         je.prebatch(JournalEntryLineItem(
             account=Account.get(ACCT_REVENUE_MEMBERSHIP),
             action=JournalEntryLineItem.ACTION_BALANCE_INCREASE,
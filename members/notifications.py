@@ -1,42 +1,53 @@
-
 # Standard
 import os
 import logging
+from datetime import timedelta
 from typing import Optional
 
 # Third-party
-import pushover
+import requests
 from django.conf import settings
+from django.core.mail import send_mail
+from django.db import transaction
+from django.utils import timezone
 
 # Local
-from members.models import Member, Pushover
+from members.models import Member, Pushover, Notification
+from bzw_ops.jobs import defer
 
 TESTING = getattr(settings, 'TESTING', False)
 
 logger = logging.getLogger("members")
 
-pushover_available = False
+_CONFIG = settings.BZWOPS_MEMBERS_CONFIG
+PUSHOVER_API_URL = _CONFIG.get('PUSHOVER_API_URL', "https://api.pushover.net/1/messages.json")
+EML2SMS_DOMAIN = _CONFIG.get('EML2SMS_DOMAIN', None)
+MAX_ATTEMPTS = _CONFIG.get('NOTIFICATION_MAX_ATTEMPTS', 5)
+RETRY_DELAY = _CONFIG.get('NOTIFICATION_RETRY_DELAY', 60)  # Seconds before the first retry. Doubles thereafter.
+TIMEOUT = _CONFIG.get('NOTIFICATION_TIMEOUT', 10)  # Seconds to wait on the notification service.
 
 api_token = os.getenv('XEROPS_PUSHOVER_API_KEY', None)
+pushover_available = api_token is not None
 
-if api_token is None:
+if not pushover_available:
     logger.info("Pushover not configured. Alerts will not be sent.")
-else:
-    try:
-        pushover.init(api_token)
-        pushover_available = True
-    except Exception as e:
-        logger.info("Pushover could not be initialized. Alerts will not be sent.")
-        logger.info("Pushover init exception: "+str(e))
 
 
-# REVIEW: This sometimes fails. Should it be an asynchronous task with retries?
+class PermanentFailure(Exception):
+    """Raised when a message can't be delivered and retrying won't help."""
+    pass
+
+
 def notify(
   target_member: Member,
   title: str,
   message: str,
   url: str = None,
   url_title: str = None) -> bool:
+    """Queues a message for delivery to the member via each of their notification mechanisms.
+    Delivery happens on the rq worker, so this never waits on the notification service.
+    Returns True if the member has at least one mechanism through which the message will be delivered.
+    """
 
     if TESTING:
         notify.MOST_RECENT_MEMBER = target_member
@@ -47,23 +58,134 @@ def notify(
     if settings.ISDEVHOST:
         return False
 
+    mechanisms = list(Pushover.objects.filter(who=target_member))
     if not pushover_available:
+        mechanisms = [m for m in mechanisms if m.mechanism != Pushover.MECH_PUSHOVER]
+    if len(mechanisms) == 0:
+        logger.warning("Couldn't send msg to %s since there's no notification mechanism for them.", str(target_member))
         return False
 
-    # TODO: Code currently only uses Pushover mechanism. Should be updated to use alternate mechanisms.
-    try:
-        target_key = Pushover.objects.get(who=target_member).key
-        client = pushover.Client(target_key)
-        client.send_message(message, title=title, url=url, url_title=url_title)
-        return True
-    except Pushover.DoesNotExist:
-        logger.warning("Couldn't send msg to %s since there's no pushover key for them.", str(target_member))
-        return False
-    except Exception as e:
-        logger.error("Couldn't send msg to %s because %s", str(target_member), str(e))
-        return False
+    with transaction.atomic():
+        for mechanism in mechanisms:
+            notification = Notification.objects.create(
+                who=target_member,
+                via=mechanism,
+                title=title,
+                message=message,
+                url=url or "",
+                url_title=url_title or "",
+            )
+            defer(deliver, notification.pk)
+    return True
 
 # These were added to support testing:
 notify.MOST_RECENT_TITLE = None  # type: Optional[str]
 notify.MOST_RECENT_MESSSAGE = None  # type: Optional[str]
 notify.MOST_RECENT_MEMBER = None # type: Optional[Member]
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# DELIVERY
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+_session = None  # type: Optional[requests.Session]
+
+
+def _pushover_session() -> requests.Session:
+    # The worker reuses one session, and so one connection pool, for all the messages it delivers.
+    global _session
+    if _session is None:
+        _session = requests.Session()
+    return _session
+
+
+def _send_pushover(notification: Notification) -> None:
+    data = {
+        'token': api_token,
+        'user': notification.via.key,
+        'title': notification.title,
+        'message': notification.message,
+    }
+    if notification.url:
+        data['url'] = notification.url
+        data['url_title'] = notification.url_title
+    response = _pushover_session().post(PUSHOVER_API_URL, data=data, timeout=TIMEOUT)
+    if 400 <= response.status_code < 500 and response.status_code != 429:
+        # Pushover says that these shouldn't be retried, e.g. because the user key is invalid.
+        raise PermanentFailure("Pushover rejected the message: {} {}".format(response.status_code, response.text))
+    response.raise_for_status()
+
+
+def _send_eml2sms(notification: Notification) -> None:
+    address = notification.via.key
+    if "@" not in address:
+        if EML2SMS_DOMAIN is None:
+            raise PermanentFailure("No email-to-SMS gateway is configured for {}".format(address))
+        address = "{}@{}".format(address, EML2SMS_DOMAIN)
+    body = notification.message
+    if notification.url:
+        body += " " + notification.url
+    send_mail(notification.title, body, None, [address])
+
+
+_SENDERS = {
+    Pushover.MECH_PUSHOVER: _send_pushover,
+    Pushover.MECH_EML2SMS: _send_eml2sms,
+}
+
+
+def _retry_delay(attempts: int) -> int:
+    return RETRY_DELAY * 2 ** (attempts - 1)
+
+
+def _claim(notification_pk: int) -> Optional[Notification]:
+    # The attempt is recorded, and the next one scheduled, before sending. So the row is only locked briefly,
+    # other deliveries won't pick the message up while it's in flight, and it's retried if this worker dies.
+    with transaction.atomic():
+        notification = Notification.objects.select_for_update()\
+            .select_related('via', 'who')\
+            .filter(pk=notification_pk, status=Notification.STAT_PENDING, next_attempt__lte=timezone.now())\
+            .first()  # type: Notification
+        if notification is None:
+            return None  # It was already delivered, given up on, or is being attempted elsewhere.
+        notification.attempts += 1
+        notification.next_attempt = timezone.now() + timedelta(seconds=_retry_delay(notification.attempts))
+        notification.save(update_fields=['attempts', 'next_attempt'])
+    return notification
+
+
+def deliver(notification_pk: int) -> None:
+    """Makes one attempt to deliver a pending notification. If it fails, a retry is attempted by deliver_due."""
+
+    notification = _claim(notification_pk)
+    if notification is None:
+        return
+
+    pending = Notification.objects.filter(pk=notification.pk, status=Notification.STAT_PENDING)
+    try:
+        _SENDERS[notification.via.mechanism](notification)
+    except Exception as e:
+        error = str(e)[:255]
+        if isinstance(e, PermanentFailure) or notification.attempts >= MAX_ATTEMPTS:
+            pending.update(status=Notification.STAT_FAILED, last_error=error)
+            logger.error("Couldn't send msg to %s because %s", str(notification.who), str(e))
+        else:
+            pending.update(last_error=error)
+            logger.warning("Will retry msg to %s in %ds because %s",
+                str(notification.who), _retry_delay(notification.attempts), str(e))
+    else:
+        pending.update(status=Notification.STAT_SENT, sent=timezone.now(), last_error="")
+
+
+def deliver_due() -> int:
+    """Attempts delivery of all pending notifications whose next attempt is due. Returns the number attempted.
+    This is what retries failed deliveries, so the sendnotifications command should be kept running (see Procfile).
+    """
+    due = Notification.objects\
+        .filter(status=Notification.STAT_PENDING, next_attempt__lte=timezone.now())\
+        .order_by('next_attempt')\
+        .values_list('pk', flat=True)
+    pks = list(due)
+    for pk in pks:
+        deliver(pk)
+    return len(pks)
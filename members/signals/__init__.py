@@ -1 +1,8 @@
+# Third Party
+from django.dispatch import Signal
+
 __author__ = 'Adrian'
+
+# Sent with the list of VisitEvents that were created together by VisitEvent.bulk_ingest().
+# Receivers of post_save for VisitEvent should generally handle this, too, since bulk creation doesn't send post_save.
+visit_events_created = Signal(providing_args=["events"])
@@ -3,14 +3,19 @@ from datetime import timedelta
 import logging
 
 # Third Party
-from django.db.models.signals import post_save, pre_save, pre_delete
+from django.db.models.signals import post_save, pre_save, pre_delete, post_delete
 from django.dispatch import receiver
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
 
 # Local
-from members.models import Member, Tag, Tagging, MemberLogin, GroupMembership, Membership, VisitEvent
+from members.models import (
+    Member, Tag, Tagging, MemberLogin, GroupMembership, Membership, MembershipCoverage, VisitEvent
+)
+from members.signals import visit_events_created
 import members.notifications as notifications
+import members.accesscache as accesscache
+import members.stats as stats
 from abutils.utils import get_ip_address
 
 __author__ = 'Adrian'
@@ -49,6 +54,14 @@ def email_for_saved_tagging(sender, **kwargs):
         #TODO: Send email to other members with the same can_tag privilege informing them.
         pass
 
+
+@receiver([post_save, post_delete], sender=Tagging)
+def forget_cached_tags(sender, **kwargs):
+    """The tagged member's cached tag names are stale, if the tagging is holding on to the member."""
+    tagging = kwargs.get('instance')  # type: Tagging
+    if Tagging.tagged_member.is_cached(tagging):
+        tagging.tagged_member.forget_tags()
+
 # NOTE: DO NOT attempt to automatically manage group memberships here.
 
 
@@ -65,6 +78,61 @@ def link_membership_to_member(sender, **kwargs):
             mship.link_to_member()
 
 
+@receiver(pre_save, sender=Membership)
+def note_covered_member(sender, **kwargs):
+    """Remember who the membership covered before this save, since their coverage may have to shrink."""
+    mship = kwargs.get('instance')  # type: Membership
+    mship.prev_member_id = None
+    if mship.pk is not None:
+        mship.prev_member_id = Membership.objects.filter(pk=mship.pk).values_list('member_id', flat=True).first()
+
+
+@receiver([post_save, post_delete], sender=Membership)
+def maintain_coverage(sender, **kwargs):
+    mship = kwargs.get('instance')  # type: Membership
+    member_ids = {mship.member_id, getattr(mship, 'prev_member_id', None)} - {None}
+    if len(member_ids) > 0:
+        MembershipCoverage.refresh(member_ids)
+
+
+@receiver([post_save, post_delete], sender=Member)
+@receiver([post_save, post_delete], sender=Membership)
+def invalidate_access_cache(sender, **kwargs):
+    """Card registrations and memberships determine who gets through the door."""
+    accesscache.invalidate()
+
+
+@receiver([post_save, post_delete], sender=Membership)
+def invalidate_stats(sender, **kwargs):
+    stats.invalidate()
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# VISITS
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+@receiver(post_save, sender=VisitEvent)
+def note_seen_visit(sender, **kwargs):
+    """Keep the cache of each member's latest visit event current, for the other receivers of the new event."""
+    visit = kwargs.get('instance')  # type: VisitEvent
+    if kwargs.get('created', True):
+        visit.note_seen()
+    else:
+        VisitEvent.forget_seen(visit.who_id, visit.event_type)
+
+
+@receiver(post_delete, sender=VisitEvent)
+def forget_seen_visit(sender, **kwargs):
+    visit = kwargs.get('instance')  # type: VisitEvent
+    VisitEvent.forget_seen(visit.who_id, visit.event_type)
+
+
+@receiver(visit_events_created, sender=VisitEvent)
+def note_seen_visits(sender, **kwargs):
+    for visit in kwargs.get('events'):  # type: VisitEvent
+        visit.note_seen()
+
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 # LOGIN (No longer of interest)
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
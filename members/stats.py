@@ -0,0 +1,101 @@
+# Standard
+from collections import OrderedDict
+from datetime import date
+from time import mktime
+from typing import Dict, List, Optional
+
+# Third Party
+import numpy as np
+from django.core.cache import cache
+
+# Local
+from members.models import Membership
+
+__author__ = 'adrian'
+
+# The membership types charted by the member count series, in stacking order.
+# Not enough gift card sales to call them out separately. They're included in "Regular" counts.
+SERIES_TYPES = OrderedDict([
+    ("Regular", [Membership.MT_REGULAR, Membership.MT_GIFTCARD]),
+    ("Family", [Membership.MT_FAMILY]),
+    ("Work-Trade", [Membership.MT_WORKTRADE]),
+    ("Groups", [Membership.MT_GROUP]),
+    ("Comp", [Membership.MT_COMPLIMENTARY]),
+])
+
+SERIES_START = date(2015, 1, 1)
+
+# Bumping this generation discards cached series. It's bumped whenever a membership changes.
+_GENERATION_KEY = "members:stats-generation"
+CACHE_TIMEOUT = 24*60*60
+
+
+def _generation() -> int:
+    gen = cache.get(_GENERATION_KEY)
+    if gen is None:
+        cache.add(_GENERATION_KEY, 0, None)
+        gen = cache.get(_GENERATION_KEY, 0)
+    return gen
+
+
+def invalidate() -> None:
+    try:
+        cache.incr(_GENERATION_KEY)
+    except ValueError:
+        cache.add(_GENERATION_KEY, 0, None)
+
+
+def _zero_to_null(counts: np.ndarray) -> List[Optional[int]]:
+    if not counts.any():
+        # Google chart deals with all 0s better than all nulls.
+        return counts.tolist()
+    return [None if x == 0 else x for x in counts.tolist()]
+
+
+def _build_member_count_series(end_date: date) -> Dict:
+    rows = list(Membership.objects.values_list('membership_type', 'start_date', 'end_date'))
+    days = (end_date - SERIES_START).days + 1
+    if len(rows) == 0 or days <= 0:
+        return {'dates': [], 'series': OrderedDict((name, []) for name in SERIES_TYPES)}
+
+    types, starts, ends = (np.array(col) for col in zip(*rows))
+    first = np.datetime64(SERIES_START, 'D')
+    # Day offsets of the first and (one past the) last day of each membership, clipped to the charted period.
+    start_idx = np.clip((starts.astype('datetime64[D]') - first).astype(int), 0, days)
+    stop_idx = np.clip((ends.astype('datetime64[D]') - first).astype(int) + 1, 0, days)
+    valid = start_idx < stop_idx
+
+    def sweep(mask: np.ndarray) -> np.ndarray:
+        # Each membership adds 1 on its first day and subtracts it after its last, so a running sum counts them.
+        diff = np.zeros(days+1, dtype=int)
+        np.add.at(diff, start_idx[mask & valid], 1)
+        np.add.at(diff, stop_idx[mask & valid], -1)
+        return np.cumsum(diff[:-1])
+
+    # Like the chart always has, only include days on which there was at least one membership of any type.
+    any_counts = sweep(np.ones(len(rows), dtype=bool))
+    covered = any_counts > 0
+    dates = (first + np.arange(days))[covered].astype(date).tolist()
+    return {
+        # The chart wants local midnights as JavaScript times, i.e. milliseconds since the epoch.
+        'dates': [int(mktime(day.timetuple())) * 1000 for day in dates],
+        'series': OrderedDict(
+            (name, _zero_to_null(sweep(np.isin(types, mtypes))[covered]))
+            for name, mtypes in SERIES_TYPES.items()
+        ),
+    }
+
+
+def member_count_series() -> Dict:
+    """
+    The number of memberships of each charted type on each day from SERIES_START through today.
+    Returns a dict with 'dates', a list of JavaScript times, and 'series', which maps each of the
+    names in SERIES_TYPES to a list of counts (null where zero) for those dates.
+    """
+    today = date.today()
+    key = "members:member-count-series:{}:{}".format(_generation(), today.isoformat())
+    result = cache.get(key)
+    if result is None:
+        result = _build_member_count_series(today)
+        cache.set(key, result, CACHE_TIMEOUT)
+    return result
@@ -1,9 +1,13 @@
 
 # Standard
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest.mock import patch
+from urllib.parse import parse_qs
 import json
 import os
 import hashlib
+import threading
 
 # Third Party
 from django.conf import settings
@@ -14,15 +18,19 @@ from django.core import management, mail
 from django.utils import timezone
 from django.urls import reverse
 from freezegun import freeze_time
+from redis import RedisError
 import members.notifications as notifications
 
 # Local
 from members.models import (
-    Member, Tag, Tagging, VisitEvent, Membership, Pushover, MembershipGiftCard, DiscoveryMethod
+    Member, Tag, Tagging, VisitEvent, Membership, MembershipCoverage, Pushover, Notification, MembershipGiftCard,
+    DiscoveryMethod
 )
 from members.notifications import pushover_available
 from members.management.commands.membershipnudge import Command as MembershipNudgeCmd
 import members.views as views
+import members.stats as stats
+import members.accesscache as accesscache
 
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
@@ -103,6 +111,35 @@ class TestMemberNag(TestCase):
             management.call_command("membershipnudge", date=self.FREEZE_DATE_STR)
             self.assertEqual(len(mail.outbox), 0)
 
+    def test_backfill(self):
+
+        with freeze_time(self.FREEZE_DATE_STR):
+
+            # An expired membership, and a week of visits after it expired.
+            Membership.objects.create(
+                member=self.memb,
+                membership_type=Membership.MT_REGULAR,
+                start_date=date.today()-MembershipNudgeCmd.leeway-timedelta(days=60),
+                end_date=date.today()-MembershipNudgeCmd.leeway-timedelta(days=30),
+            )
+            for days_ago in range(2, 9):
+                VisitEvent.objects.create(
+                    who=self.memb,
+                    when=timezone.now() - timedelta(days=days_ago),
+                    method=VisitEvent.METHOD_RFID,
+                    event_type=VisitEvent.EVT_ARRIVAL
+                )
+            start = (date.today()-timedelta(days=8)).isoformat()
+            end = (date.today()-timedelta(days=2)).isoformat()
+
+            # Repeat visits result in a single nudge.
+            management.call_command("membershipnudge", date=self.FREEZE_DATE_STR, start=start, end=end)
+            self.assertEqual(len(mail.outbox), 1)
+
+            # Somebody that has already been nudged today isn't nudged again.
+            management.call_command("membershipnudge", date=self.FREEZE_DATE_STR, start=start, end=end)
+            self.assertEqual(len(mail.outbox), 1)
+
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 
@@ -144,6 +181,31 @@ class TestMembers(TestCase):
             self.assertTrue("Member" in tag_names)  # Every member should have this tag.
             self.assertTrue(m.auth_user is not None)  # Every member should be connected to a Django user.
 
+    def test_tag_names(self):
+        tagger = User.objects.create_user(username='fake2', first_name="Chris", last_name="Dodd").member
+        taggee = User.objects.get(username='fake1').member
+        director = Tag.objects.create(name="Director", meaning="Director.")
+        Tagging.objects.create(tagged_member=tagger, tag=director, can_tag=True)
+
+        with self.assertNumQueries(3):
+            for _ in range(3):
+                self.assertTrue(tagger.is_tagged_with("Director"))
+                self.assertTrue(tagger.is_tagged_with(director))
+                self.assertTrue(tagger.can_tag_with(director))
+                self.assertFalse(taggee.is_tagged_with("Director"))
+
+        # Changes to the taggee's taggings are seen by the taggee.
+        Tagging.add_if_permitted(tagger, taggee, director)
+        self.assertTrue(taggee.is_tagged_with("Director"))
+        self.assertFalse(taggee.can_tag_with(director))
+        Tagging.remove_if_permitted(tagger, taggee, director)
+        self.assertFalse(taggee.is_tagged_with("Director"))
+
+        # The tag names of many members can be fetched in bulk.
+        members = list(Member.objects.prefetch_related('tags'))
+        with self.assertNumQueries(0):
+            self.assertEqual({"Member", "Director"}, set().union(*(m.tag_names for m in members)))
+
 
 class TestCardsAndApi(TestCase):
 
@@ -200,11 +262,94 @@ class TestMembership(TestCase):
         self.assertTrue(mship.ctrlid.startswith("GEN"))
 
 
+class TestMembershipCoverage(TestCase):
+
+    def setUp(self):
+        self.alpha = User.objects.create_user(username='alpha', email="alpha@example.com").member
+        self.bravo = User.objects.create_user(username='bravo', email="bravo@example.com").member
+        self.today = date.today()
+
+    def mship(self, member, start_days, end_days) -> Membership:
+        return Membership.objects.create(
+            member=member,
+            start_date=self.today+timedelta(days=start_days),
+            end_date=self.today+timedelta(days=end_days),
+        )
+
+    def periods(self, member):
+        return [((c.start_date-self.today).days, (c.end_date-self.today).days) for c in member.coverage.all()]
+
+    def test_merging(self):
+        self.mship(self.alpha, -60, -31)
+        self.mship(self.alpha, -30, -1)  # Abuts the previous one.
+        mship = self.mship(self.alpha, -10, 20)  # Overlaps the previous one.
+        self.mship(self.alpha, 40, 70)
+        self.assertEqual(self.periods(self.alpha), [(-60, 20), (40, 70)])
+        self.assertTrue(self.alpha.is_currently_paid())
+        self.assertEqual(self.alpha.paid_through(), self.today+timedelta(days=20))
+
+        # Moving a membership to another member updates both members' coverage.
+        mship.member = self.bravo
+        mship.save()
+        self.assertEqual(self.periods(self.alpha), [(-60, -1), (40, 70)])
+        self.assertFalse(self.alpha.is_currently_paid())
+        self.assertTrue(self.alpha.is_currently_paid(grace_period=timedelta(days=1)))
+        self.assertTrue(self.bravo.is_currently_paid())
+
+        mship.delete()
+        self.assertEqual(self.periods(self.bravo), [])
+        self.assertFalse(self.bravo.is_currently_paid())
+
+    def test_bulk(self):
+        self.mship(self.alpha, -10, 10)
+        self.mship(self.bravo, -30, -20)
+        members = [self.alpha.pk, self.bravo.pk]
+        with self.assertNumQueries(1):
+            paid_through = MembershipCoverage.paid_through(members)
+        self.assertEqual(paid_through, {
+            self.alpha.pk: self.today+timedelta(days=10),
+            self.bravo.pk: self.today-timedelta(days=20),
+        })
+        self.assertEqual(MembershipCoverage.paid_on(members, self.today), {self.alpha.pk})
+        self.assertEqual(MembershipCoverage.paid_on(members, self.today-timedelta(days=25)), {self.bravo.pk})
+
+
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 # VIEWS
 
 class TestViews(TestCase):
-    pass
+
+    def test_member_count_vs_date(self):
+        director = User.objects.create_user(username='director', password='pw', email="director@example.com").member
+        tag = Tag.objects.create(name="Director", meaning="spam")
+        Tagging.objects.create(tagged_member=director, tag=tag)
+        today = date.today()
+        for mtype, start, end in [
+          (Membership.MT_REGULAR, -10, -1),
+          (Membership.MT_GIFTCARD, -5, 30),  # Counted as Regular, and extends past today.
+          (Membership.MT_WORKTRADE, -3, -3),
+          (Membership.MT_SCHOLARSHIP, -20, -15),  # Not charted, but its days still appear.
+          (Membership.MT_REGULAR, -30000, -29000)]:  # Before the chart starts.
+            Membership.objects.create(
+                member=director, membership_type=mtype,
+                start_date=today+timedelta(days=start), end_date=today+timedelta(days=end),
+            )
+
+        self.client.login(username='director', password='pw')
+        data = self.client.get(reverse('memb:desktop-member-count-vs-date-data')).json()
+        self.assertEqual(list(data['series'].keys()), ["Regular", "Family", "Work-Trade", "Groups", "Comp"])
+        self.assertEqual(len(data['dates']), 6+11)  # Days -20..-15 and -10..0.
+        self.assertEqual(data['series']["Regular"], [None]*6 + [1]*5 + [2]*5 + [1])
+        self.assertEqual(data['series']["Work-Trade"], [None]*13 + [1] + [None]*3)
+        self.assertEqual(data['series']["Family"], [0]*17)
+
+        # The series is cached until memberships change.
+        with self.assertNumQueries(2):  # Both are cache reads.
+            self.assertEqual(stats.member_count_series(), data)
+        Membership.objects.create(
+            member=director, membership_type=Membership.MT_FAMILY, start_date=today, end_date=today)
+        data = self.client.get(reverse('memb:desktop-member-count-vs-date-data')).json()
+        self.assertEqual(data['series']["Family"][-1], 1)
 
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
@@ -298,6 +443,91 @@ class TestNotify(TestCase):
             notifications.notify(self.user.member, "Testing Pushover", "This is a test.")
 
 
+class FakePushoverHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        self.server.received.append(parse_qs(self.rfile.read(length).decode()))
+        self.send_response(self.server.statuses.pop(0))
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(b'{"status": 1}')
+
+    def log_message(self, *args):
+        pass
+
+
+class TestNotificationDelivery(TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), FakePushoverHandler)
+        self.server.received = []
+        self.server.statuses = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self.member = User.objects.create_user(username='caller', email="jdoe@example.com").member
+        Pushover.objects.create(who=self.member, key="fakeuserkey")
+        url = "http://127.0.0.1:{}/1/messages.json".format(self.server.server_port)
+        for name, value in [
+          ('TESTING', False), ('PUSHOVER_API_URL', url), ('api_token', "fakeapitoken"), ('pushover_available', True)]:
+            patcher = patch.object(notifications, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def notify(self) -> Notification:
+        with self.settings(ISDEVHOST=False):
+            self.assertTrue(notifications.notify(self.member, "Title", "Message", url="http://example.com/"))
+        return Notification.objects.get(who=self.member)
+
+    def test_delivery(self):
+        self.server.statuses = [200]
+        notification = self.notify()  # Deferred jobs run immediately while testing.
+        self.assertEqual(notification.status, Notification.STAT_SENT)
+        self.assertEqual(self.server.received[0]['user'], ["fakeuserkey"])
+        self.assertEqual(self.server.received[0]['message'], ["Message"])
+
+    def test_retry(self):
+        self.server.statuses = [503, 200]
+        notification = self.notify()
+        self.assertEqual(notification.status, Notification.STAT_PENDING)
+        self.assertEqual(notification.attempts, 1)
+        self.assertEqual(notifications.deliver_due(), 0)  # The retry isn't due yet.
+        Notification.objects.filter(pk=notification.pk).update(next_attempt=timezone.now())
+        self.assertEqual(notifications.deliver_due(), 1)
+        notification.refresh_from_db()
+        self.assertEqual(notification.status, Notification.STAT_SENT)
+        self.assertEqual(notification.attempts, 2)
+
+    def test_claimed_before_sending(self):
+        in_flight = []
+
+        def send(notification):
+            # The attempt is recorded before sending, so other deliveries leave this message alone.
+            in_flight.append(Notification.objects.get(pk=notification.pk).attempts)
+            self.assertEqual(notifications.deliver_due(), 0)
+            raise ConnectionError("Unreachable")
+
+        with patch.dict(notifications._SENDERS, {Pushover.MECH_PUSHOVER: send}):
+            notification = self.notify()
+        self.assertEqual(in_flight, [1])
+        self.assertEqual(notification.status, Notification.STAT_PENDING)
+        self.assertEqual(notification.last_error, "Unreachable")
+        self.assertGreater(notification.next_attempt, timezone.now())
+
+    def test_permanent_failure(self):
+        self.server.statuses = [400]
+        notification = self.notify()
+        self.assertEqual(notification.status, Notification.STAT_FAILED)
+        self.assertEqual(notifications.deliver_due(), 0)
+
+    def test_no_mechanism(self):
+        Pushover.objects.all().delete()
+        with self.settings(ISDEVHOST=False):
+            self.assertFalse(notifications.notify(self.member, "Title", "Message"))
+
+
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 # GENERATE GIFT CARDS
 
@@ -417,6 +647,120 @@ class RfidEntry(TestCase):
         response = self.client.get(path)
         self.assertTrue(response.status_code == 200)
 
+    def test_access_cache(self):
+        mship = Membership.objects.create(
+            member=self.memb,
+            start_date=date.today()-timedelta(days=7),
+            end_date=date.today()+timedelta(days=7),
+        )
+        path = reverse('memb:rfid-entry-requested', args=[self.registered_card])
+        self.assertTrue(self.client.get(path).json()['membership_current'])
+
+        # Once the cache is warm, lookups don't query at all, not even to check that it's still valid.
+        with self.assertNumQueries(0):
+            self.client.get(path)
+
+        # Changes to memberships are seen immediately.
+        mship.end_date = date.today()-timedelta(days=1)
+        mship.save()
+        self.assertFalse(self.client.get(path).json()['membership_current'])
+
+        # Changes made by other processes are seen once the check interval has passed.
+        new_card = "123123123"
+        Member.objects.filter(pk=self.memb.pk).update(membership_card_md5=hashlib.md5(new_card.encode()).hexdigest())
+        accesscache.cache.incr(accesscache._GENERATION_KEY)
+        self.assertIsNone(accesscache.lookup(new_card))
+        with patch.object(accesscache, 'CHECK_INTERVAL', -1):
+            self.assertEqual(accesscache.lookup(new_card).member_pk, self.memb.pk)
+
+    def test_visit_batch(self):
+        path = reverse('memb:rfid-visits')
+        start = int(timezone.now().timestamp()) - 3600
+        reads = [
+            {'card': self.registered_card, 'when': start},
+            {'card': self.registered_card, 'when': start+2},  # A bounce.
+            {'card': self.registered_card, 'when': start+600},
+            {'card': self.registered_card, 'when': start},  # A duplicate.
+            {'card': self.unregistered_card, 'when': start},
+            {'card': "notacard", 'when': start},
+            {'card': self.registered_card, 'when': start+86400},  # In the future.
+            {'card': self.registered_card, 'when': 0},  # From a reader whose clock was reset.
+        ]
+        response = self.client.post(path, json.dumps({'reads': reads}), content_type="application/json")
+        self.assertEqual(response.json(), {'recorded': 2, 'skipped': 2, 'unregistered': 1, 'invalid': 3})
+        self.assertEqual(VisitEvent.objects.filter(who=self.memb, method=VisitEvent.METHOD_RFID).count(), 2)
+
+        # A reader that didn't get the response will resend the batch.
+        response = self.client.post(path, json.dumps({'reads': reads}), content_type="application/json")
+        self.assertEqual(response.json()['recorded'], 0)
+
+        response = self.client.post(path, "not json", content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+
+    def test_visit_seen(self):
+        def arrive(when: datetime) -> VisitEvent:
+            return VisitEvent.objects.create(who=self.memb, when=timezone.make_aware(when), event_type=VisitEvent.EVT_ARRIVAL)
+
+        first = arrive(datetime(2018, 3, 1, 10, 0))
+        self.assertTrue(first.debounced())
+        self.assertTrue(first.is_first_of_day())
+
+        bounce = arrive(datetime(2018, 3, 1, 10, 5))
+        with self.assertNumQueries(0):  # This was determined as the visit was saved.
+            self.assertFalse(bounce.debounced())
+            self.assertFalse(bounce.is_first_of_day())
+
+        late = arrive(datetime(2018, 3, 2, 2, 0))  # Still the same day, since days begin at 4am.
+        self.assertTrue(late.debounced())
+        self.assertFalse(late.is_first_of_day())
+        next_day = arrive(datetime(2018, 3, 2, 5, 0))
+        self.assertTrue(next_day.is_first_of_day())
+
+        # A visit that's recorded out of order is checked against the visits in the database.
+        backdated = arrive(datetime(2018, 3, 1, 9, 30))
+        self.assertTrue(backdated.is_first_of_day())
+        self.assertFalse(arrive(datetime(2018, 3, 2, 9, 0)).is_first_of_day())
+
+    def test_visit_seen_stale(self):
+        conn = VisitEvent._seen_conn()
+        key = VisitEvent._seen_key(self.memb.pk, VisitEvent.EVT_ARRIVAL)
+        try:
+            conn.delete(key)
+        except RedisError:
+            self.skipTest("Redis isn't available.")
+        self.addCleanup(conn.delete, key)
+
+        def arrive(when: datetime) -> VisitEvent:
+            return VisitEvent.objects.create(who=self.memb, when=timezone.make_aware(when), event_type=VisitEvent.EVT_ARRIVAL)
+
+        # Redis holds an event that isn't in the database and is later than the member's actual visits,
+        # e.g. because forgetting it failed when it was deleted.
+        stale = timezone.make_aware(datetime(2018, 3, 5, 10, 0))
+        conn.hmset(key, {'when': stale.timestamp(), 'day': stale.date().toordinal(), 'count': 1})
+        first = arrive(datetime(2018, 3, 1, 10, 0))
+        self.assertTrue(first.is_first_of_day())
+
+        # The database was consulted for the first visit and redis was corrected, so it's used for the next.
+        with self.assertNumQueries(0):
+            second = VisitEvent(who=self.memb, when=timezone.make_aware(datetime(2018, 3, 1, 11, 30)),
+                event_type=VisitEvent.EVT_ARRIVAL)
+            self.assertEqual(second.note_seen(), (first.when, 2))
+
+    def test_allow_list(self):
+        Membership.objects.create(
+            member=self.memb,
+            start_date=date.today()-timedelta(days=7),
+            end_date=date.today()+timedelta(days=7),
+        )
+        lapsed = User.objects.create_user(username='fake2', email="fake2@example.com").member
+        lapsed.membership_card_md5 = hashlib.md5("123123".encode()).hexdigest()
+        lapsed.save()
+        response = self.client.get(reverse('memb:rfid-allow-list'))
+        self.assertEqual(response.status_code, 200)
+        cards = response.json()['cards']
+        self.assertEqual(list(cards.keys()), [self.memb.membership_card_md5])
+        self.assertEqual(cards[self.memb.membership_card_md5]['paid_through'], str(date.today()+timedelta(days=7)))
+
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 # RECEPTION KIOSK API
@@ -44,6 +44,7 @@ urlpatterns = [
     url(r'^desktop/member-tags/$', views.member_tags, name='desktop-member-tags'),
     url(r'^desktop/member-tags/(?P<member_pk>[0-9]+)(?P<op>[+-])(?P<tag_pk>[0-9]+)/$', views.member_tags, name='desktop-member-tags'),
     url(r'^desktop/member-count-vs-date/$', views.desktop_member_count_vs_date, name='desktop-member-count-vs-date'),
+    url(r'^desktop/member-count-vs-date/data/$', views.desktop_member_count_vs_date_data, name='desktop-member-count-vs-date-data'),
 
     # For mobile apps:
     # TODO: Mobile app is not currently used.
@@ -61,4 +62,6 @@ urlpatterns = [
     url(r'^rfid-entry-requested/(?P<rfid_cardnum>[0-9]{1,32})/$', views.rfid_entry_requested, name='rfid-entry-requested'),
     url(r'^rfid-entry-granted/(?P<rfid_cardnum>[0-9]{1,32})/$', views.rfid_entry_granted, name='rfid-entry-granted'),
     url(r'^rfid-entry-denied/(?P<rfid_cardnum>[0-9]{1,32})/$', views.rfid_entry_denied, name='rfid-entry-denied'),
+    url(r'^rfid-visits/$', views.rfid_visits, name='rfid-visits'),
+    url(r'^rfid-allow-list/$', views.rfid_allow_list, name='rfid-allow-list'),
 ]
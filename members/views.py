@@ -1,21 +1,22 @@
 
 # Standard
-from datetime import date, timedelta
-from collections import Counter
-from time import mktime
+from datetime import date, datetime, timedelta
 from logging import getLogger
 from typing import Union, Tuple, Optional
 import json
+import re
 
 # Third party
-from dateutil.relativedelta import relativedelta
 from django.shortcuts import render
 from django.http import HttpResponse, JsonResponse
 from django.urls import reverse
 from django.core.exceptions import PermissionDenied
 from django.contrib.auth import authenticate
 from django.contrib.auth.decorators import login_required
-from django.views.decorators.csrf import ensure_csrf_cookie
+from django.views.decorators.csrf import ensure_csrf_cookie, csrf_exempt
+from django.views.decorators.http import require_POST
+from django.utils import timezone
+from django.utils.timezone import utc
 from django.conf import settings
 from django.core.mail import EmailMultiAlternatives
 from django.template.loader import get_template
@@ -36,6 +37,8 @@ from members.models import Member, Tag, Tagging, VisitEvent, Membership, Discove
 from members.forms import Desktop_ChooseUserForm
 from members.restapi.serializers import get_MemberSerializer
 from abutils.utils import request_is_from_host
+import members.accesscache as accesscache
+import members.stats as stats
 
 logger = getLogger("members")
 
@@ -48,6 +51,11 @@ ORG_NAME = settings.BZWOPS_ORG_NAME
 ORG_NAME_POSSESSIVE = settings.BZWOPS_ORG_NAME_POSSESSIVE
 FACILITY_PUBLIC_IP = settings.BZWOPS_FACILITY_PUBLIC_IP
 
+_CONFIG = settings.BZWOPS_MEMBERS_CONFIG
+RFID_DEBOUNCE = timedelta(seconds=_CONFIG.get('RFID_DEBOUNCE', 60))
+RFID_CLOCK_SKEW = timedelta(seconds=_CONFIG.get('RFID_CLOCK_SKEW', 5*60))
+RFID_MAX_BACKLOG = timedelta(seconds=_CONFIG.get('RFID_MAX_BACKLOG', 7*24*60*60))
+
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = PRIVATE
 
@@ -254,12 +262,9 @@ def member_tags(request, tag_pk=None, member_pk=None, op=None):
 
     if member is not None:
         members_tags = member.tags.all()
-        staff_can_tags = [tagging.tag for tagging in Tagging.objects.filter(can_tag=True, tagged_member=staff)]
-        staff_addable_tags = list(staff_can_tags) # copy contents, not pointer.
+        staff_can_tags = [tagging.tag for tagging in Tagging.objects.filter(can_tag=True, tagged_member=staff).select_related('tag')]
         # staff member can't add tags that member already has, so:
-        for tag in member.tags.all():
-            if tag in staff_addable_tags:
-                staff_addable_tags.remove(tag)
+        staff_addable_tags = [tag for tag in staff_can_tags if tag.name not in member.tag_names]
 
     today = date.today()
     visits = VisitEvent.objects.filter(when__gt=today)
@@ -302,34 +307,25 @@ def inside_facility_only(function):
 @inside_facility_only
 def rfid_entry_requested(request, rfid_cardnum):
 
-    member = Member.get_by_card_str(rfid_cardnum)
-    if member is None:
+    access = accesscache.lookup(rfid_cardnum)
+    if access is None:
         json = {'card_registered': False}
     else:
-        try:
-            latest_pm = Membership.objects.filter(member=member).latest('start_date')
-            json = {
-                'card_registered': True,
-                'membership_current': member.is_currently_paid(),
-                'membership_start_date': latest_pm.start_date,
-                'membership_end_date': latest_pm.end_date,
-            }
-        except Membership.DoesNotExist:
-            json = {
-                'card_registered': True,
-                'membership_current': False,
-                'membership_start_date': None,
-                'membership_end_date': None,
-            }
+        json = {
+            'card_registered': True,
+            'membership_current': access.membership_current,
+            'membership_start_date': access.membership_start_date,
+            'membership_end_date': access.membership_end_date,
+        }
     return JsonResponse(json)
 
 
 @inside_facility_only
 def rfid_entry_granted(request, rfid_cardnum):
-    member = Member.get_by_card_str(rfid_cardnum)
-    if member is not None:
+    access = accesscache.lookup(rfid_cardnum)
+    if access is not None:
         VisitEvent.objects.create(
-            who=member,
+            who_id=access.member_pk,
             # RFID reads are not reliable indicators of arrival.
             # Cards are sometimes read when people walk past the reader on the way OUT.
             # Therefore, RFID reads will be considered as indicationg *presence*.
@@ -341,6 +337,71 @@ def rfid_entry_granted(request, rfid_cardnum):
     return JsonResponse({'success': "Information noted."})
 
 
+@csrf_exempt
+@require_POST
+@inside_facility_only
+def rfid_visits(request):
+    """
+    Records a batch of card reads that a reader buffered, e.g. while the network was down.
+    The body is JSON like {"reads": [{"card": "1234567", "when": 1527000000}, ...]} where "when" is in Unix time.
+    Reads from further back than RFID_MAX_BACKLOG, e.g. from a reader whose clock was reset, are counted as invalid.
+    """
+    try:
+        reads = json.loads(request.body.decode())['reads']
+        assert type(reads) is list
+    except (ValueError, KeyError, AssertionError):
+        return JsonResponse(status=400, data={'error': "Expected a JSON object with a list of reads."})
+
+    now = timezone.now()
+    earliest_ok, latest_ok = now - RFID_MAX_BACKLOG, now + RFID_CLOCK_SKEW
+    events = []
+    invalid = unregistered = 0
+    for read in reads:
+        try:
+            card = str(read['card'])
+            when = datetime.fromtimestamp(float(read['when']), tz=utc)
+            assert re.fullmatch(r"[0-9]{1,32}", card) and earliest_ok <= when <= latest_ok
+        except (TypeError, ValueError, KeyError, AssertionError, OverflowError, OSError):
+            invalid += 1
+            continue
+        access = accesscache.lookup(card)
+        if access is None:
+            logger.warning("No member found with RFID card# %s", card)
+            unregistered += 1
+            continue
+        # As in rfid_entry_granted, RFID reads indicate presence, not arrival.
+        events.append(VisitEvent(
+            who_id=access.member_pk,
+            when=when,
+            event_type=VisitEvent.EVT_PRESENT,
+            method=VisitEvent.METHOD_RFID,
+        ))
+
+    created = VisitEvent.bulk_ingest(events, RFID_DEBOUNCE)
+    return JsonResponse({
+        'recorded': len(created),
+        'skipped': len(events) - len(created),
+        'unregistered': unregistered,
+        'invalid': invalid,
+    })
+
+
+@inside_facility_only
+def rfid_allow_list(request):
+    """The md5s of the cards that currently grant access, so the reader can keep working if it loses its connection."""
+    today = date.today()
+    cards = {
+        md5: {
+            'paid_through': access.paid_through,
+            'membership_start_date': access.membership_start_date,
+            'membership_end_date': access.membership_end_date,
+        }
+        for md5, access in accesscache.snapshot().items()
+        if access.membership_current
+    }
+    return JsonResponse({'as_of': today, 'cards': cards})
+
+
 @inside_facility_only
 def rfid_entry_denied(request, rfid_cardnum):
     return JsonResponse({'success': "Information noted."})
@@ -348,52 +409,19 @@ def rfid_entry_denied(request, rfid_cardnum):
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = REPORTS
 
-def zero_to_null(somelist: list) -> list:
-    if sum(somelist) == 0:
-        # Google chart deals with all 0s better than all nulls.
-        return somelist
-    return ["null" if x == 0 else x for x in somelist]
-
-
 @login_required()
 def desktop_member_count_vs_date(request):
     if not request.user.member.is_tagged_with("Director"):
         return HttpResponse("This page is for Directors only.")
+    # The page fetches its data from desktop_member_count_vs_date_data.
+    return render(request, 'members/desktop-member-count-vs-date.html', {})
+
 
-    end_date = date.today()  # .replace(day=1)  # - relativedelta(days=1)
-    wt_data = Counter()
-    reg_data = Counter()
-    comp_data = Counter()
-    group_data = Counter()
-    fam_data = Counter()
-
-    memberships = Membership.objects.all()
-    for pm in memberships:
-        # Not enough gift card sales to call them out separately. Will include them in "Regular" count.
-        wt_inc = 1 if pm.membership_type == pm.MT_WORKTRADE else 0
-        reg_inc = 1 if pm.membership_type in [pm.MT_REGULAR, pm.MT_GIFTCARD] else 0
-        comp_inc = 1 if pm.membership_type == pm.MT_COMPLIMENTARY else 0
-        group_inc = 1 if pm.membership_type == pm.MT_GROUP else 0
-        fam_inc = 1 if pm.membership_type == pm.MT_FAMILY else 0
-        day = max(pm.start_date, date(2015, 1, 1))
-        while day <= min(pm.end_date, end_date):
-            js_time_milliseconds = int(mktime(day.timetuple())) * 1000
-            wt_data.update({js_time_milliseconds: wt_inc})
-            reg_data.update({js_time_milliseconds: reg_inc})
-            comp_data.update({js_time_milliseconds: comp_inc})
-            group_data.update({js_time_milliseconds: group_inc})
-            fam_data.update({js_time_milliseconds: fam_inc})
-            day += relativedelta(days=1)
-
-    js_times = sorted(reg_data)  # Gets keys
-    reg_counts = zero_to_null([reg_data[k] for k in js_times])
-    wt_counts = zero_to_null([wt_data[k] for k in js_times])
-    comp_counts = zero_to_null([comp_data[k] for k in js_times])
-    group_counts = zero_to_null([group_data[k] for k in js_times])
-    fam_counts = zero_to_null([fam_data[k] for k in js_times])
-
-    data = list(zip(js_times, reg_counts, fam_counts, wt_counts, group_counts, comp_counts))
-    return render(request, 'members/desktop-member-count-vs-date.html', {'data': data})
+@login_required()
+def desktop_member_count_vs_date_data(request):
+    if not request.user.member.is_tagged_with("Director"):
+        return JsonResponse(status=403, data={'error': "This data is for Directors only."})
+    return JsonResponse(stats.member_count_series())
 
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
@@ -0,0 +1,125 @@
+# Standard
+import logging
+import tempfile
+import time
+from typing import Callable, List, Optional, Tuple
+
+# Third Party
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+
+# Local
+
+__author__ = 'Adrian'
+
+_CONFIG = getattr(settings, 'BZWOPS_MAIL_CONFIG', {})
+
+# Number of messages that are queued up before they're pushed through the connection.
+BATCH_SIZE = _CONFIG.get('BATCH_SIZE', 50)
+
+# Max number of messages sent per second. None means "as fast as the backend will go".
+MAX_PER_SECOND = _CONFIG.get('MAX_PER_SECOND', None)
+
+# If not None, messages are written to files in this directory instead of being sent.
+DRY_RUN_DIR = _CONFIG.get('DRY_RUN_DIR', None)
+
+
+class MailBatch:
+    """Sends many email messages over a single backend connection.
+
+    Use it as a context manager. Messages added inside the "with" block are sent in batches
+    over one connection which is closed when the block exits:
+
+        with MailBatch() as batch:
+            for member in members:
+                batch.add(msg_for(member), on_sent=...)
+
+    A message that can't be sent doesn't stop the rest. It's logged, recorded in "failures",
+    and its on_failed callback (if any) is called with the exception. If the connection can't
+    be opened, the same happens to every message in the batch.
+    """
+
+    def __init__(self, dry_run: bool=False, batch_size: int=None, max_per_second: float=None):
+        self.logger = logging.getLogger("modelmailer")
+        self.batch_size = batch_size if batch_size is not None else BATCH_SIZE
+        self.max_per_second = max_per_second if max_per_second is not None else MAX_PER_SECOND
+        self.dry_run = dry_run or DRY_RUN_DIR is not None
+        self.sent_count = 0
+        self.failures = []  # type: List[Tuple[EmailMessage, Exception]]
+        self._pending = []  # type: List[Tuple[EmailMessage, Optional[Callable], Optional[Callable]]]
+        self._connection = None
+        self._last_send_time = None  # type: Optional[float]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _open(self):
+        if self._connection is not None:
+            return
+        if self.dry_run:
+            file_path = DRY_RUN_DIR if DRY_RUN_DIR is not None else tempfile.mkdtemp(prefix="mailbatch-")
+            self.logger.info("Dry run. Email will be written to %s", file_path)
+            connection = get_connection('django.core.mail.backends.filebased.EmailBackend', file_path=file_path)
+        else:
+            connection = get_connection()
+        connection.open()
+        # Only kept once it's open, so that a failed open is tried again for the next batch.
+        self._connection = connection
+
+    def _throttle(self):
+        if self.max_per_second is None:
+            return
+        if self._last_send_time is not None:
+            wait = (1.0 / self.max_per_second) - (time.monotonic() - self._last_send_time)
+            if wait > 0:
+                time.sleep(wait)
+        self._last_send_time = time.monotonic()
+
+    def add(self, msg: EmailMessage, on_sent: Callable[[], None]=None, on_failed: Callable[[Exception], None]=None):
+        """Queue a message. The callbacks are called once the outcome of sending the message is known."""
+        self._pending.append((msg, on_sent, on_failed))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def _failed(self, msg: EmailMessage, on_failed: Optional[Callable], e: Exception):
+        self.logger.error("Failed to send '%s' to %s because: %s", msg.subject, ", ".join(msg.to), str(e))
+        self.failures.append((msg, e))
+        if on_failed is not None:
+            on_failed(e)
+
+    def flush(self):
+        """Send the messages queued so far, keeping the connection open for later batches."""
+        if len(self._pending) == 0:
+            return
+        pending, self._pending = self._pending, []
+        try:
+            self._open()
+        except Exception as e:
+            # E.g. bad credentials or the mail server is down. None of these messages can be sent.
+            for msg, _, on_failed in pending:
+                self._failed(msg, on_failed, e)
+            return
+        for msg, on_sent, on_failed in pending:
+            self._throttle()
+            try:
+                # Sending one at a time means that a bad message doesn't take the rest of the batch down with it.
+                if self._connection.send_messages([msg]) != 1:
+                    raise RuntimeWarning("Message was not accepted by the email backend.")
+            except Exception as e:
+                self._failed(msg, on_failed, e)
+                continue
+            self.sent_count += 1
+            if on_sent is not None:
+                on_sent()
+
+    def close(self):
+        """Send anything that's still queued and close the connection."""
+        try:
+            self.flush()
+        finally:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
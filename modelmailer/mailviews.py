@@ -8,6 +8,7 @@ from django.template.loader import get_template
 from django.db.models import Model
 
 # Local
+from modelmailer.batch import MailBatch
 
 _registry = {}
 
@@ -32,20 +33,38 @@ class MailView:
         html = get_template(spec['template'] + '.html').render(params)
         return html
 
+    @staticmethod
+    def _build_message(spec) -> EmailMultiAlternatives:
+        params = spec['parameters']
+        text = get_template(spec['template']+'.txt').render(params)
+        html = get_template(spec['template']+'.html').render(params)
+        msg = EmailMultiAlternatives(
+            spec['subject'],     # Subject
+            text,                # Text content
+            spec['sender'],      # From
+            spec['recipients'],  # To list
+            spec['bccs'],        # BCC list
+        )
+        msg.attach_alternative(html, "text/html")
+        return msg
+
+    def queue(self, obj: Model, batch: MailBatch, on_sent=None, on_failed=None):
+        """Renders the email for obj and adds it to the batch instead of sending it right away.
+        Unlike send(), this raises if the email can't be rendered.
+        """
+        spec = self.get_email_spec(obj)
+
+        def sent():
+            self.logger.info(spec['info-for-log'])
+            if on_sent is not None:
+                on_sent()
+
+        batch.add(self._build_message(spec), on_sent=sent, on_failed=on_failed)
+
     def send(self, obj: Model):
         try:
             spec = self.get_email_spec(obj)
-            params = spec['parameters']
-            text = get_template(spec['template']+'.txt').render(params)
-            html = get_template(spec['template']+'.html').render(params)
-            msg = EmailMultiAlternatives(
-                spec['subject'],     # Subject
-                text,                # Text content
-                spec['sender'],      # From
-                spec['recipients'],  # To list
-                spec['bccs'],        # BCC list
-            )
-            msg.attach_alternative(html, "text/html")
+            msg = self._build_message(spec)
             msg.send()
             self.logger.info(spec['info-for-log'])
             return True
@@ -1,13 +1,16 @@
 # Standard
+from unittest.mock import patch
 
 # Third Party
 from django.test import TestCase, TransactionTestCase
 from django.core import mail
+from django.core.mail import EmailMessage
 
 # Local
 from books.mailviews import PhysicalDonationMailView
 from books.models import Donation
 from modelmailer.mailviews import MailView
+from modelmailer.batch import MailBatch
 
 
 class DonationTests(TestCase):
@@ -28,3 +31,44 @@ class DonationTests(TestCase):
         don = Donation.objects.create(donator_name="Frank", donator_email="")
         mv = PhysicalDonationMailView()
         self.assertFalse(mv.send(don))
+
+
+class UnsendableMessage(EmailMessage):
+
+    def message(self):
+        raise ValueError("Can't render this one.")
+
+
+class MailBatchTests(TestCase):
+
+    def test_batch(self):
+        sent = []
+        failed = []
+        with MailBatch(batch_size=2) as batch:
+            batch.add(EmailMessage("One", "Body", "a@example.com", ["b@example.com"]), on_sent=lambda: sent.append(1))
+            batch.add(UnsendableMessage("Two", "Body", "a@example.com", ["b@example.com"]), on_failed=failed.append)
+            # Batch size was reached so the first two have been pushed through.
+            self.assertEqual(len(mail.outbox), 1)
+            batch.add(EmailMessage("Three", "Body", "a@example.com", ["b@example.com"]), on_sent=lambda: sent.append(3))
+        self.assertEqual([m.subject for m in mail.outbox], ["One", "Three"])
+        self.assertEqual(sent, [1, 3])
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(batch.sent_count, 2)
+        self.assertEqual(len(batch.failures), 1)
+
+    def test_connection_failure(self):
+        failed = []
+        with patch('django.core.mail.backends.locmem.EmailBackend.open', side_effect=OSError("No server")):
+            with MailBatch(batch_size=2) as batch:
+                for subject in ["One", "Two", "Three"]:
+                    batch.add(EmailMessage(subject, "Body", "a@example.com", ["b@example.com"]), on_failed=failed.append)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(len(failed), 3)
+        self.assertEqual(len(batch.failures), 3)
+
+    def test_queue_mailview(self):
+        don = Donation.objects.create(donator_name="Frank", donator_email="frank@example.com")
+        with MailBatch() as batch:
+            PhysicalDonationMailView().queue(don, batch)
+            self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(len(mail.outbox), 1)
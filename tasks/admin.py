@@ -201,6 +201,12 @@ def update_future_instances(model_admin, request, query_set):
             task.resync_with_template()
 
 
+def rematerialize_instances(model_admin, request, query_set):
+    """Creates any instances that are missing from today through each template's watermark."""
+    for template in query_set:  # type: RecurringTaskTemplate
+        template.create_tasks(0, since=datetime.date.today())
+
+
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 # Base classes for both Template and Task
 
@@ -278,6 +284,7 @@ class RecurringTaskTemplateAdmin(TemplateAndTaskBase):
     ]
     actions = [
         update_future_instances,
+        rematerialize_instances,
         set_nag_on,
         set_nag_off,
         set_nag_on_for_instances,
@@ -382,7 +389,14 @@ class RecurringTaskTemplateAdmin(TemplateAndTaskBase):
             ]
         }),
 
+        ("Scheduling", {
+            'fields': [
+                'materialized_through',
+            ]
+        }),
+
     ]
+    readonly_fields = ['materialized_through']
 
     class Media:
         css = {
@@ -477,6 +491,7 @@ class TaskAdmin(TemplateAndTaskBase):
         get_DayOfWeekListFilter_class('scheduled_date'),
         'priority',
         'status',
+        'staffing',
         'should_nag',
         'anybody_is_eligible'
     ]
@@ -0,0 +1,84 @@
+# Standard
+from datetime import date
+from hashlib import md5
+from typing import Callable, Optional, Tuple
+
+# Third Party
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpRequest, HttpResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+__author__ = 'Adrian'
+
+_CONFIG = settings.BZWOPS_TASKS_CONFIG
+CACHE_TIMEOUT = _CONFIG.get('CALENDAR_CACHE_TIMEOUT', 24*60*60)
+MAX_AGE = _CONFIG.get('CALENDAR_MAX_AGE', 5*60)
+
+# Every cached feed is keyed by the current generation, so bumping it invalidates all of them at once.
+_GENERATION_KEY = "tasks:calendar-generation"
+
+
+def generation() -> int:
+    """The current generation. Feeds rendered from data read after this call should be cached under it."""
+    gen = cache.get(_GENERATION_KEY)
+    if gen is None:
+        cache.add(_GENERATION_KEY, 0, None)
+        gen = cache.get(_GENERATION_KEY, 0)
+    return gen
+
+
+def invalidate() -> None:
+    """Discards all cached calendar feeds. Call this whenever the information in them might have changed."""
+    try:
+        cache.incr(_GENERATION_KEY)
+    except ValueError:
+        # The generation isn't in the cache yet, so there's nothing cached to invalidate.
+        cache.add(_GENERATION_KEY, 0, None)
+
+
+def _key(request: HttpRequest, feed: str, gen: int) -> str:
+    # Feeds show a window of days around today and contain absolute URLs, so those are part of the key, too.
+    return "tasks:calendar:{}:{}:{}:{}".format(feed, gen, date.today().isoformat(), request.get_host())
+
+
+def _entry(ics: bytes) -> Tuple[str, int, bytes]:
+    return md5(ics).hexdigest(), int(timezone.now().timestamp()), ics
+
+
+def prime(request: HttpRequest, feed: str, ics: bytes, gen: int) -> None:
+    """Caches a feed that was rendered ahead of being requested, from data read in the given generation."""
+    cache.set(_key(request, feed, gen), _entry(ics), CACHE_TIMEOUT)
+
+
+def ical_response(
+  request: HttpRequest,
+  feed: str,
+  render: Callable[[], bytes],
+  private: bool=False,
+  gen: Optional[int]=None) -> HttpResponse:
+    """Responds with the iCalendar document for the named feed, rendering it only if it isn't already cached.
+    The response carries ETag and Last-Modified headers so clients that already have it get a 304 Not Modified.
+    If the caller reads the generation before rendering (e.g. to prime other feeds) it should pass it as gen.
+    """
+
+    # The generation is read before rendering. If the data changes during the render, the result is
+    # cached under the generation it came from, which is already stale, rather than the new one.
+    key = _key(request, feed, gen if gen is not None else generation())
+    entry = cache.get(key)
+    if entry is None:
+        entry = _entry(render())
+        cache.set(key, entry, CACHE_TIMEOUT)
+    etag, last_modified, ics = entry
+
+    response = HttpResponse(ics, content_type='text/calendar')
+    response['Content-Disposition'] = 'attachment; filename="calendar.ics"'
+    response['ETag'] = quote_etag(etag)
+    response['Last-Modified'] = http_date(last_modified)
+    if private:
+        patch_cache_control(response, private=True, max_age=MAX_AGE)
+    else:
+        patch_cache_control(response, public=True, max_age=MAX_AGE)
+    return get_conditional_response(request, etag=response['ETag'], last_modified=last_modified, response=response)
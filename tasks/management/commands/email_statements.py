@@ -13,6 +13,7 @@ import django.utils.timezone as timezone
 # Local
 from tasks.models import Worker, TimeAccountEntry
 from tasks.views import render_time_acct_statement_as_html
+from modelmailer.batch import MailBatch
 
 __author__ = 'adrian'
 
@@ -25,7 +26,7 @@ class Command(BaseCommand):
     help = "If any time account entries were recently added, send worker a new statement."
 
     @staticmethod
-    def send_statement(user: User):
+    def build_statement(user: User) -> EmailMultiAlternatives:
         subject = 'Work Trade Statement for '+user.username+ ', ' + date.today().strftime('%a %b %d')
         from_email = VC_EMAIL
         bcc_email = XIS_EMAIL
@@ -34,7 +35,7 @@ class Command(BaseCommand):
         html_content = render_time_acct_statement_as_html(user, "recent")
         msg = EmailMultiAlternatives(subject, text_content, from_email, [to], [bcc_email])
         msg.attach_alternative(html_content, "text/html")
-        msg.send()
+        return msg
 
     def handle(self, *args, **options):
         logger = logging.getLogger("tasks")
@@ -57,7 +58,11 @@ class Command(BaseCommand):
             users_to_update.add(user)
 
         # Send a statement to each of the users:
-        for user in users_to_update:  # type: User
-            logger.info("Sent latest work-trade statement to %s.", user.username)
-            Command.send_statement(user)
+        with MailBatch() as batch:
+            for user in users_to_update:  # type: User
+                batch.add(
+                    Command.build_statement(user),
+                    on_sent=lambda username=user.username:
+                        logger.info("Sent latest work-trade statement to %s.", username)
+                )
 
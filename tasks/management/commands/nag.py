@@ -1,17 +1,20 @@
 # Standard
 import datetime
 import logging
+from collections import defaultdict, OrderedDict
+from typing import Dict, List, Set, Tuple
 
 # Third party
 from django.core.management.base import BaseCommand
 from django.core.mail import EmailMultiAlternatives
 from django.template.loader import get_template
-from django.db.models import F
+from django.db.models import F, Q
 from django.conf import settings
 
 # Local
-from tasks.models import Task, Claim, Nag, Worker, EligibleClaimant2
+from tasks.models import Task, Claim, Nag, EligibleClaimant2
 from members.models import Member
+from modelmailer.batch import MailBatch
 
 __author__ = 'adrian'
 
@@ -36,7 +39,7 @@ class Command(BaseCommand):
         parser.add_argument('--host', default="https://xerocraft-django.herokuapp.com")
 
     @staticmethod
-    def send_staffing_emergency_message(tasks, HOST):
+    def send_staffing_emergency_message(tasks, HOST, batch: MailBatch):
 
         text_content_template = get_template('tasks/email-staffing-emergency.txt')
         html_content_template = get_template('tasks/email-staffing-emergency.html')
@@ -55,43 +58,63 @@ class Command(BaseCommand):
         html_content = html_content_template.render(d)
         msg = EmailMultiAlternatives(subject, text_content, from_email, [to], [bcc_email])
         msg.attach_alternative(html_content, "text/html")
-        msg.send()
+        batch.add(msg)
 
     @staticmethod
-    def nag_for_workers(HOST):
-        today = datetime.date.today()
+    def plan_nags(today: datetime.date) -> Tuple[Dict[Member, List[Task]], List[Task]]:
+        """Decides who should be nagged about which of the next few days' NAGGING tasks.
+        All the tasks, claims and eligibilities in the window are loaded up front in a fixed number of queries.
+        The eligibility of each member for each task is then worked out in memory.
+        Returns (nag_lists, emergency_tasks) where nag_lists maps each member to the tasks they should be nagged about.
+        """
 
         # Find out who's doing what over the next 2 weeks. Who's already scheduled to work and who's heavily scheduled?
         ppl_already_scheduled = Claim.sum_in_period(today, today+TWOWEEKS)
-        ppl_heavily_scheduled = set([member for member, dur in ppl_already_scheduled.items() if dur >= datetime.timedelta(hours=6.0)])
+        ppl_heavily_scheduled = set([member.id for member, dur in ppl_already_scheduled.items() if dur >= datetime.timedelta(hours=6.0)])
 
         # Rule out the following sets:
-        ppl_excluded = set()
-        ppl_excluded |= set([worker.member for worker in Worker.objects.filter(should_nag=False)])
-        ppl_excluded |= set(Member.objects.filter(auth_user__email=""))
-        ppl_excluded |= set(Member.objects.filter(auth_user__is_active=False))
-
-        # Cycle through future days' NAGGING tasks to see which need workers and who should be nagged.
-        nag_lists = {}
+        ppl_excluded = set(Member.objects.filter(
+            Q(worker__should_nag=False) | Q(auth_user__email="") | Q(auth_user__is_active=False)
+        ).values_list('id', flat=True))
+
+        # Future days' NAGGING tasks that are workable.
+        tasks = list(Task.objects.filter(
+            scheduled_date__gte=today,
+            scheduled_date__lt=today+THREEDAYS,
+            should_nag=True,
+            status=Task.STAT_ACTIVE,
+        ).select_related('recurring_task_template'))
+        task_ids = [task.id for task in tasks]
+
+        # Build the task x member eligibility matrix and the claim info needed to prune it.
+        eligibles = defaultdict(set)  # type: Dict[int, Set[int]]
+        for task_id, member_id in EligibleClaimant2.objects.filter(task_id__in=task_ids).values_list('task_id', 'member_id'):
+            eligibles[task_id].add(member_id)
+
+        # Members whose claim EXPIRED are still a possibility.
+        not_nagable = defaultdict(set)  # type: Dict[int, Set[int]]
+        for task_id, member_id in Claim.objects.filter(
+          claimed_task_id__in=task_ids,
+          status__in=[Claim.STAT_CURRENT, Claim.STAT_UNINTERESTED, Claim.STAT_ABANDONED]
+        ).values_list('claimed_task_id', 'claiming_member_id'):
+            not_nagable[task_id].add(member_id)
+
+        # Cycle through the tasks to see which need workers and who should be nagged.
+        nag_ids = OrderedDict()  # type: Dict[int, List[Task]]
         emergency_tasks = []
-        for task in Task.objects.filter(scheduled_date__gte=today, scheduled_date__lt=today+THREEDAYS, should_nag=True):
+        for task in tasks:
 
-            # No need to nag if task is fully claimed or not workable.
-            if (not task.is_active()) or task.is_fully_claimed:
+            # No need to nag if task is fully claimed.
+            if task.max_work - task.claimed_duration == datetime.timedelta(0):
                 continue
 
             # Skip tasks that repeat at intervals and can slide. Nags for these will be
             # notifications pushed when an eligible worker walks into the facility.
             rtt = task.recurring_task_template
-            if rtt.repeat_interval is not None and rtt.missed_date_action == rtt.MDA_SLIDE_SELF_AND_LATER:
+            if rtt is not None and rtt.repeat_interval is not None and rtt.missed_date_action == rtt.MDA_SLIDE_SELF_AND_LATER:
                 continue
 
-            potentials = task.all_eligible_claimants()
-            potentials -= task.claimant_set(Claim.STAT_CURRENT)
-            potentials -= task.claimant_set(Claim.STAT_UNINTERESTED)
-            # potentials -= task.claimant_set(Claim.STAT_EXPIRED) Their claim expired but they're still a possibility.
-            potentials -= task.claimant_set(Claim.STAT_ABANDONED)
-            potentials -= ppl_excluded
+            potentials = eligibles[task.id] - not_nagable[task.id] - ppl_excluded
 
             panic_situation = task.scheduled_date == today and task.priority == Task.PRIO_HIGH
             if panic_situation:
@@ -100,14 +123,21 @@ class Command(BaseCommand):
                 # Don't bother heavily scheduled people if it's not time to panic
                 potentials -= ppl_heavily_scheduled
 
-            for member in potentials:
-                if member not in nag_lists:
-                    nag_lists[member] = []
-                nag_lists[member] += [task]
+            for member_id in potentials:
+                nag_ids.setdefault(member_id, []).append(task)
+
+        members = Member.objects.select_related('auth_user').in_bulk(list(nag_ids.keys()))
+        nag_lists = OrderedDict((members[member_id], tasks) for member_id, tasks in nag_ids.items())
+        return nag_lists, emergency_tasks
+
+    @staticmethod
+    def nag_for_workers(HOST, batch: MailBatch):
+        today = datetime.date.today()
+        nag_lists, emergency_tasks = Command.plan_nags(today)
 
         # Send staffing emergency message to staff list:
         if len(emergency_tasks) > 0:
-            Command.send_staffing_emergency_message(emergency_tasks, HOST)
+            Command.send_staffing_emergency_message(emergency_tasks, HOST, batch)
 
         # Send email nag messages to potential workers:
         text_content_template = get_template('tasks/email_nag_template.txt')
@@ -135,7 +165,8 @@ class Command(BaseCommand):
             html_content = html_content_template.render(d)
             msg = EmailMultiAlternatives(subject, text_content, from_email, [to], [bcc_email])
             msg.attach_alternative(html_content, "text/html")
-            msg.send()
+            # The nag's token is useless if the email never went out.
+            batch.add(msg, on_failed=lambda e, nag=nag: nag.delete())
 
     @staticmethod
     def abandon_suspect_claims():
@@ -165,7 +196,7 @@ class Command(BaseCommand):
             claim.save()
 
     @staticmethod
-    def verify_default_claims(HOST):
+    def verify_default_claims(HOST, batch: MailBatch):
 
         today = datetime.date.today()
         claims = Claim.objects.filter(
@@ -214,7 +245,7 @@ class Command(BaseCommand):
             html_content = html_content_template.render(d)
             msg = EmailMultiAlternatives(subject, text_content, from_email, [to], [bcc_email])
             msg.attach_alternative(html_content, "text/html")
-            msg.send()
+            batch.add(msg, on_failed=lambda e, nag=nag: nag.delete())
 
     def handle(self, *args, **options):
 
@@ -222,5 +253,6 @@ class Command(BaseCommand):
 
         # Order is significant!
         self.abandon_suspect_claims()
-        self.verify_default_claims(HOST)
-        self.nag_for_workers(HOST)
+        with MailBatch() as batch:
+            self.verify_default_claims(HOST, batch)
+            self.nag_for_workers(HOST, batch)
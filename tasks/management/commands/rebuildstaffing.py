@@ -0,0 +1,26 @@
+# Standard
+
+# Third Party
+from django.core.management.base import BaseCommand
+
+# Local
+from tasks.models import Task
+import tasks.calendarcache as calendarcache
+
+__author__ = 'adrian'
+
+
+class Command(BaseCommand):
+
+    help = "Recomputes the denormalized staffing fields of tasks from their claims, repairing any drift."
+
+    CHUNK_SIZE = 500
+
+    def handle(self, **options):
+        task_ids = list(Task.objects.order_by('pk').values_list('pk', flat=True))
+        changed = 0
+        for i in range(0, len(task_ids), self.CHUNK_SIZE):
+            changed += Task.refresh_staffing(task_ids[i:i+self.CHUNK_SIZE])
+        if changed > 0:
+            calendarcache.invalidate()
+        self.stdout.write("Repaired staffing for {} of {} task(s).".format(changed, len(task_ids)))
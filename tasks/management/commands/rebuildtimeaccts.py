@@ -0,0 +1,30 @@
+# Standard
+
+# Third Party
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+# Local
+from tasks.models import TimeAccountEntry
+
+__author__ = 'adrian'
+
+
+class Command(BaseCommand):
+
+    help = "Recomputes the running balances of all time account entries from scratch, repairing any drift."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true', dest='verify',
+            help="Only report how many balances are wrong, without repairing them.")
+
+    def handle(self, **options):
+        with transaction.atomic():
+            changed = TimeAccountEntry.rebuild_balances()
+            if options['verify']:
+                transaction.set_rollback(True)
+        count = TimeAccountEntry.objects.count()
+        if options['verify']:
+            self.stdout.write("Found {} of {} time account balance(s) to be wrong.".format(changed, count))
+        else:
+            self.stdout.write("Repaired {} of {} time account balance(s).".format(changed, count))
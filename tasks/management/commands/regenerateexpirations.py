@@ -0,0 +1,18 @@
+# Standard
+
+# Third Party
+from django.core.management.base import BaseCommand
+
+# Local
+from tasks.models import TimeAccountEntry
+
+__author__ = 'adrian'
+
+
+class Command(BaseCommand):
+
+    help = "Regenerates the expiration entries in all workers' time accounts. Run daily so that rolled-over hours expire on time."
+
+    def handle(self, **options):
+        count = TimeAccountEntry.regenerate_expirations()
+        self.stdout.write("Regenerated {} expiration(s).".format(count))
@@ -1,50 +1,87 @@
-
 # Standard
 import datetime
+import logging
 
 # Third Party
 from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction, IntegrityError
+from django.db.models import DateField, F, Min
+from django.db.models.functions import Cast
 
 # Local
 from tasks.models import RecurringTaskTemplate, Task
+import tasks.calendarcache as calendarcache
 
 __author__ = 'adrian'
 
 
+def _date_arg(s: str) -> datetime.date:
+    try:
+        return datetime.datetime.strptime(s, "%Y-%m-%d").date()
+    except ValueError:
+        raise CommandError("Dates must be in YYYY-MM-DD format, not '{}'".format(s))
+
+
 class Command(BaseCommand):
     help = 'Creates new tasks from templates, reschedules tasks that have slipped, etc.'
 
     def add_arguments(self, parser):
         parser.add_argument('num_days', type=int)
 
+        parser.add_argument('--templates', type=int, nargs='+', metavar='ID',
+            help="Only process the templates with these ids.")
+
+        parser.add_argument('--since', type=_date_arg, metavar='YYYY-MM-DD',
+            help="Re-materialize dates from this date onward, ignoring each template's watermark.")
+
     @staticmethod
-    def add_new_tasks(num_days):
-        for template in RecurringTaskTemplate.objects.filter(active=True):
-            template.create_tasks(num_days)
+    def add_new_tasks(num_days, template_ids=None, since=None):
+        templates = RecurringTaskTemplate.objects.filter(active=True)
+        if template_ids is not None:
+            templates = templates.filter(id__in=template_ids)
+        for template in templates:
+            template.create_tasks(num_days, since=since)
 
     @staticmethod
     def reschedule_missed_dates():
+        """Slides every active instance of a sliding template forward by however many days its earliest one is overdue.
+        Each template's instances are moved with a single UPDATE, so model save() and signals are NOT triggered.
+        Returns a dict that maps each template that slid to the number of days that its instances moved.
+        """
+        logger = logging.getLogger("tasks")
         today = datetime.date.today()
         RTT = RecurringTaskTemplate
-        for template in RTT.objects.filter(missed_date_action=RTT.MDA_SLIDE_SELF_AND_LATER):
-            tasks = template.instances.filter(
-                status=Task.STAT_ACTIVE,
-                scheduled_date__isnull=False
-            ).order_by('scheduled_date')
+        instances = Task.objects.filter(
+            recurring_task_template__missed_date_action=RTT.MDA_SLIDE_SELF_AND_LATER,
+            status=Task.STAT_ACTIVE,
+            scheduled_date__isnull=False
+        )
 
-            if len(tasks) == 0:
-                continue
+        # Empty order_by() is required so that Task's default ordering doesn't end up in the GROUP BY.
+        overdue = instances.order_by().values('recurring_task_template').annotate(
+            earliest=Min('scheduled_date')
+        ).filter(earliest__lt=today)
+        overdue = {row['recurring_task_template']: row['earliest'] for row in overdue}
 
-            t0 = tasks[0]
-            if t0.scheduled_date >= today:
+        moved = {}
+        for template_id, template in RTT.objects.in_bulk(list(overdue.keys())).items():
+            slide_delta = today - overdue[template_id]  # type: datetime.timedelta
+            try:
+                with transaction.atomic():
+                    count = instances.filter(recurring_task_template=template).update(
+                        scheduled_date=Cast(F('scheduled_date') + slide_delta, DateField())
+                    )
+            except IntegrityError as e:
+                logger.error("Couldn't slide %s because %s", template.short_desc, str(e))
                 continue
-
-            slide_delta = today - t0.scheduled_date
-            for task in tasks:
-                task.scheduled_date += slide_delta
-                task.save()
+            logger.info("Slid %d instance(s) of %s forward %d day(s).", count, template.short_desc, slide_delta.days)
+            moved[template] = slide_delta.days
+        if len(moved) > 0:
+            # Queryset updates don't send the signals that would normally invalidate cached calendars.
+            calendarcache.invalidate()
+        return moved
 
     def handle(self, *args, **options):
-        Command.reschedule_missed_dates()
-        Command.add_new_tasks(options['num_days'])
-
+        for template, days in Command.reschedule_missed_dates().items():
+            self.stdout.write("Slid {} forward {} day(s).".format(template.short_desc, days))
+        Command.add_new_tasks(options['num_days'], options['templates'], options['since'])
@@ -0,0 +1,18 @@
+# Generated by Django 2.0.3 on 2026-10-17 03:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tasks', '0013_class_class_x_person_classpayment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recurringtasktemplate',
+            name='materialized_through',
+            field=models.DateField(blank=True, help_text='Tasks have been created from this template through this date (inclusive).', null=True),
+        ),
+    ]
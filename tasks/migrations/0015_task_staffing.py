@@ -0,0 +1,88 @@
+# Generated by Django 2.0.3 on 2026-10-17 03:52
+
+import datetime
+from collections import defaultdict
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_staffing(apps, schema_editor):
+    # Same rules as Task.set_staffing(), which isn't available on the historical model.
+    Task = apps.get_model('tasks', 'Task')
+    Claim = apps.get_model('tasks', 'Claim')
+    claims = defaultdict(list)
+    rows = Claim.objects.order_by('pk').values_list(
+        'claimed_task_id', 'status', 'claimed_duration', 'date_verified', 'claiming_member_id')
+    for row in rows.iterator():
+        claims[row[0]].append(row[1:])
+
+    for task_id, max_work in Task.objects.filter(pk__in=list(claims.keys())).values_list('pk', 'max_work').iterator():
+        claimed_duration = datetime.timedelta(0)
+        current_claimant_count = 0
+        claims_verified = True
+        likely_claimant_id = None
+        done = False
+        provisional = False
+        for status, duration, date_verified, member_id in claims[task_id]:
+            if status in ["C", "W"]:  # Current, working
+                claimed_duration += duration
+                current_claimant_count += 1
+            if date_verified is None:
+                claims_verified = False
+                provisional |= status == "C"
+            if likely_claimant_id is None and status in ["C", "W", "D"]:  # Current, working, done
+                likely_claimant_id = member_id
+            done |= status == "D"
+
+        if done:
+            staffing = 'D'
+        elif max_work is not None and max_work - claimed_duration == datetime.timedelta(0):
+            staffing = 'P' if provisional else 'S'
+        else:
+            staffing = 'U'
+
+        Task.objects.filter(pk=task_id).update(
+            claimed_duration=claimed_duration,
+            current_claimant_count=current_claimant_count,
+            claims_verified=claims_verified,
+            likely_claimant_id=likely_claimant_id,
+            staffing=staffing,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('members', '0019_auto_20180422_1221'),
+        ('tasks', '0014_recurringtasktemplate_materialized_through'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='claimed_duration',
+            field=models.DurationField(default=datetime.timedelta(0), editable=False, help_text='The total duration of current and working claims on this task.'),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='claims_verified',
+            field=models.BooleanField(default=True, editable=False, help_text='True if every claim on this task has been verified.'),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='current_claimant_count',
+            field=models.IntegerField(default=0, editable=False, help_text='The number of current and working claims on this task.'),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='likely_claimant',
+            field=models.ForeignKey(blank=True, editable=False, help_text='The member that is likely to work (or is already working) the task.', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='members.Member'),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='staffing',
+            field=models.CharField(choices=[('S', 'Staffed'), ('U', 'Unstaffed'), ('P', 'Provisional'), ('D', 'Done')], db_index=True, default='U', editable=False, help_text='The staffing status of this task, as of its last claim change.', max_length=1),
+        ),
+        # Tasks without claims already have the right values, from the defaults.
+        migrations.RunPython(populate_staffing, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 2.0.3 on 2026-10-17 04:04
+
+from decimal import Decimal
+from itertools import groupby
+from django.db import migrations, models
+
+
+def populate_balances(apps, schema_editor):
+    TimeAccountEntry = apps.get_model('tasks', 'TimeAccountEntry')
+    rows = TimeAccountEntry.objects.order_by('worker_id', 'when', 'pk').values_list('worker_id', 'when', 'pk', 'change')
+    for _, worker_rows in groupby(rows.iterator(), lambda row: row[0]):
+        balance = Decimal("0.00")
+        for _, when_rows in groupby(worker_rows, lambda row: row[1]):
+            when_rows = list(when_rows)
+            balance += sum(row[3] for row in when_rows)
+            TimeAccountEntry.objects.filter(pk__in=[row[2] for row in when_rows]).update(balance=balance)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tasks', '0015_task_staffing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='timeaccountentry',
+            name='balance',
+            field=models.DecimalField(blank=True, decimal_places=2, editable=False, help_text="The worker's balance (in hours) as of this entry's date/time.", max_digits=7, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='timeaccountentry',
+            index=models.Index(fields=['worker', 'when'], name='tasks_timea_worker__544374_idx'),
+        ),
+        migrations.RunPython(populate_balances, migrations.RunPython.noop),
+    ]
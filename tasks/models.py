@@ -2,13 +2,18 @@
 # Standard
 import logging
 import abc
+import threading
+from contextlib import contextmanager
 from datetime import date, timedelta, datetime, time  # TODO: Replace datetime with django.utils.timezone
 import re
-from typing import Optional, Set
+from collections import defaultdict
+from itertools import groupby
+from operator import attrgetter, itemgetter
+from typing import Optional, Set, List, Dict
 from decimal import Decimal
 
 # Third party
-from django.db import models
+from django.db import models, transaction, DatabaseError
 from django.core.exceptions import ValidationError
 from django.core.validators import RegexValidator, MinValueValidator
 
@@ -22,6 +27,7 @@ from abutils.deprecation import deprecated
 from abutils.time import days_of_week_str, matches_weekday_of_month_pattern
 from abutils.validators import positive_duration
 from books.models import SaleLineItem
+import tasks.calendarcache as calendarcache
 
 
 _DEC0 = Decimal('0.00')
@@ -250,6 +256,9 @@ class RecurringTaskTemplate(TaskMixin):
         default=MDA_IGNORE, choices=MISSED_DATE_ACTIONS,
         help_text="What should be done if the task is not completed by the deadline date.")
 
+    materialized_through = models.DateField(null=True, blank=True,
+        help_text="Tasks have been created from this template through this date (inclusive).")
+
     def clean(self):
         if self.work_start_time is not None and self.work_duration is None:
             raise ValidationError(_("You must specify a duration if you specify a start time."))
@@ -266,17 +275,20 @@ class RecurringTaskTemplate(TaskMixin):
 
     # TODO: greatest_orig_sched_date(self):
 
-    def greatest_scheduled_date(self):
-        "Of the Tasks that correspond to this template, returns the greatest scheduled_date."
+    def greatest_scheduled_date(self, before: Optional[date]=None):
+        """Of the Tasks that correspond to this template, returns the greatest scheduled_date.
+        If "before" is specified, only tasks scheduled before that date are considered.
+        """
 
-        if len(self.instances.all()) == 0:
+        instances = self.instances.all()
+        if before is not None:
+            instances = instances.filter(scheduled_date__lt=before)
+        result = instances.aggregate(models.Max('scheduled_date'))['scheduled_date__max']
+        if result is None:
             # Nothing is scheduled yet but nothing can be scheduled before start_date.
             # So, pretend that day before start_date is the greatest scheduled date.
             result = self.start_date + timedelta(days=-1)
-            return result
-
-        scheduled_dates = map(lambda x: x.scheduled_date, self.instances.all())
-        return max(scheduled_dates)
+        return result
 
     def date_matches_template(self, d: date):
 
@@ -345,66 +357,269 @@ class RecurringTaskTemplate(TaskMixin):
     def repeats_at_intervals(self):
         return self.repeat_interval is not None
 
-    def create_tasks(self, max_days_in_advance):
-        """Creates/schedules new tasks from today or day after GSD (inclusive).
+    def matching_dates(self, first: date, last: date, last_scheduled: Optional[date]=None) -> List[date]:
+        """Returns the dates from first to last (inclusive) on which this template calls for a task.
+        For templates that repeat at intervals, last_scheduled is the date of the latest existing instance.
+        If it isn't provided, it's determined from the DB.
+        """
+        result = []  # type: List[date]
+        oneday = timedelta(days=1)
+
+        if self.repeats_at_intervals():
+            if last_scheduled is None:
+                last_scheduled = self.greatest_scheduled_date()
+            interval = timedelta(days=max(self.repeat_interval, 1))
+            curr = max(first, last_scheduled + timedelta(days=self.repeat_interval))
+            while curr <= last:
+                result.append(curr)
+                curr += interval
+            return result
+
+        if self.repeats_on_certain_days():
+            # Read the month, day-of-week, and ordinal flags once instead of once per day considered.
+            months = {num for num, chosen in enumerate([
+                self.jan, self.feb, self.mar, self.apr, self.may, self.jun,
+                self.jul, self.aug, self.sep, self.oct, self.nov, self.dec], start=1) if chosen}
+            weekdays = {num for num, chosen in enumerate([
+                self.monday, self.tuesday, self.wednesday, self.thursday,
+                self.friday, self.saturday, self.sunday]) if chosen}
+            ordinals = {num for num, chosen in enumerate([
+                self.first, self.second, self.third, self.fourth], start=1) if chosen}
+            curr = first
+            while curr <= last:
+                if curr.month in months and curr.weekday() in weekdays:
+                    if self.every \
+                      or (self.last and (curr + timedelta(weeks=1)).month != curr.month) \
+                      or (curr.day - 1) // 7 + 1 in ordinals:
+                        result.append(curr)
+                curr += oneday
+
+        return result
+
+    def create_tasks(self, max_days_in_advance, since: Optional[date]=None):
+        """Creates/schedules new tasks from today or day after the materialized_through watermark (inclusive).
         Stops when scheduling a new task would be more than max_days_in_advance from current date.
         Does not create/schedule a task on date D if one already exists for date D.
         Does nothing if the template is not active.
+        If "since" is specified, the watermark is ignored and dates from "since" onward are reconsidered.
+        This is used to re-materialize a template after it has been edited.
         """
 
         if not self.active:
             return
 
-        # Earliest possible date to schedule is "day after GSD" or "today", whichever is later.
-        # Note that curr gets inc'ed at start of while, so we need "GSD" and "yesterday" here.
-        gsd = self.greatest_scheduled_date()  # TODO: This should work with orig_sched_date, not scheduled_date
-        yesterday = date.today()+timedelta(days=-1)
-        curr = max(gsd, yesterday)
-        stop = date.today() + timedelta(days=max_days_in_advance)
+        today = date.today()
+        yesterday = today+timedelta(days=-1)
+        last = today + timedelta(days=max_days_in_advance)
+
+        if since is not None:
+            if self.materialized_through is not None:
+                # Reconsider everything that was previously materialized, too.
+                last = max(last, self.materialized_through)
+            first = max(since, today, self.start_date)
+            # Existing instances of interval and sliding templates may have moved off the template's original cadence.
+            if self.repeats_at_intervals():
+                dates = self.dates_between_instances(first, last)
+            elif self.missed_date_action == self.MDA_SLIDE_SELF_AND_LATER:
+                # Continue from the latest instance, instead of filling in around instances that have slid.
+                gsd = self.greatest_scheduled_date()
+                dates = self.matching_dates(max(first, gsd + timedelta(days=+1)), last)
+            else:
+                dates = self.matching_dates(first, last)
+                # Don't recreate instances that still exist, even if they've been rescheduled.
+                existing = set()
+                for sched, orig in self.instances.filter(
+                  models.Q(scheduled_date__gte=first) | models.Q(orig_sched_date__gte=first)
+                ).values_list('scheduled_date', 'orig_sched_date'):
+                    existing |= {sched, orig}
+                dates = [d for d in dates if d not in existing]
+
+        else:
+            # Earliest possible date to schedule is "day after watermark" or "today", whichever is later.
+            # Interval and sliding templates also need GSD because their instances can move past the watermark.
+            gsd = None
+            needs_gsd = self.materialized_through is None \
+                or self.repeats_at_intervals() \
+                or self.missed_date_action == self.MDA_SLIDE_SELF_AND_LATER
+            if needs_gsd:
+                gsd = self.greatest_scheduled_date()  # TODO: This should work with orig_sched_date, not scheduled_date
+            watermark = max(d for d in [gsd, self.materialized_through, yesterday] if d is not None)
+            dates = self.matching_dates(watermark + timedelta(days=+1), last, gsd)
+
+        self.create_instances(dates)
+
+        if self.materialized_through is None or self.materialized_through < last:
+            self.materialized_through = last
+            RecurringTaskTemplate.objects.filter(pk=self.pk).update(materialized_through=last)
+
+    def dates_between_instances(self, first: date, last: date) -> List[date]:
+        """For templates that repeat at intervals. Returns the dates from first to last (inclusive) on which
+        instances are missing, keeping to the cadence of the existing instances even if they've been moved.
+        """
+        interval = timedelta(days=max(self.repeat_interval, 1))
+        prev = self.greatest_scheduled_date(before=first)
+        later = list(self.instances
+            .filter(scheduled_date__gte=first)
+            .order_by('scheduled_date')
+            .values_list('scheduled_date', flat=True))
+        result = []  # type: List[date]
+        for next_sched in later + [last + interval]:
+            # A gap is only filled where there's a full interval before the next instance.
+            curr = max(first, prev + interval)
+            while curr <= last and curr + interval <= next_sched:
+                result.append(curr)
+                curr += interval
+            prev = max(prev, next_sched)
+        return result
+
+    def create_instances(self, dates: List[date]) -> List['Task']:
+        """Creates a Task for each of the given dates, along with its eligible claimants and default claim.
+        Everything is written with bulk inserts. If a bulk insert fails, falls back to creating one task at a time.
+        Returns the tasks that were created.
+        """
+
+        logger = logging.getLogger("tasks")
+
+        if self.work_start_time is not None:
+            # Tasks are unique on (scheduled_date, short_desc, work_start_time) so skip dates that are taken.
+            taken = set(Task.objects.filter(
+                scheduled_date__in=dates,
+                short_desc=self.short_desc,
+                work_start_time=self.work_start_time,
+            ).values_list('scheduled_date', flat=True))
+            for d in sorted(taken):
+                logger.error("Couldn't create %s on %s because it already exists", self.short_desc, d)
+            dates = [d for d in dates if d not in taken]
+
+        if len(dates) == 0:
+            return []
+
+        claim_duration = None  # type: Optional[timedelta]
+        if self.default_claimant_id is not None:
+            claim_duration = self.work_duration
+            if claim_duration is None:
+                if self.max_workers != 1:
+                    for d in dates:
+                        logger.error("Couldn't create %s on %s because %s",
+                            self.short_desc, d, "Not yet coded to deal with multiple workers.")
+                    return []
+                claim_duration = self.max_work
+
+        instructions = Snippet.expand(self.instructions)
+        today = date.today()
+        tasks = [
+            Task(
+                recurring_task_template =self,
+                creation_date           =today,
+                scheduled_date          =d,
+                orig_sched_date         =d,
+                # Copy mixin fields from template to instance:
+                owner                   =self.owner,
+                instructions            =instructions,
+                short_desc              =self.short_desc,
+                reviewer                =self.reviewer,
+                max_work                =self.max_work,
+                max_workers             =self.max_workers,
+                work_start_time         =self.work_start_time,
+                work_duration           =self.work_duration,
+                should_nag              =self.should_nag,
+                priority                =self.priority,
+                anybody_is_eligible     =self.anybody_is_eligible
+            ) for d in dates
+        ]
+        # Bulk inserts don't go through save(), so fill in the staffing fields here.
+        default_claims = []
+        if claim_duration is not None:
+            default_claims = [(Claim.STAT_CURRENT, claim_duration, None, self.default_claimant_id)]
+        for t in tasks:
+            t.set_staffing(default_claims)
+
+        eligibles = list(TemplateEligibleClaimant2.objects.filter(template_id=self.id).values_list('member_id', 'type'))
+
+        try:
+            with transaction.atomic():
+                Task.objects.bulk_create(tasks)
+                if any(t.pk is None for t in tasks):
+                    # Some DB backends can't return ids from a bulk insert, so look them up.
+                    ids = dict(Task.objects.filter(
+                        recurring_task_template=self,
+                        scheduled_date__in=dates,
+                    ).values_list('scheduled_date', 'id'))
+                    for t in tasks:
+                        t.pk = ids[t.scheduled_date]
+
+                # Many-to-many fields:
+                EligibleClaimant2.objects.bulk_create([
+                    EligibleClaimant2(task_id=t.pk, member_id=member_id, type=ec_type)
+                    for t in tasks for member_id, ec_type in eligibles
+                ])
+
+                if claim_duration is not None:
+                    Claim.objects.bulk_create([
+                        Claim(
+                            claiming_member_id=self.default_claimant_id,
+                            status=Claim.STAT_CURRENT,
+                            claimed_task_id=t.pk,
+                            claimed_start_time=t.work_start_time,
+                            claimed_duration=claim_duration
+                        ) for t in tasks
+                    ])
+
+        except DatabaseError as e:
+            logger.warning("Bulk creation of %s failed because %s. Creating one at a time.", self.short_desc, str(e))
+            created = [self._create_instance(d) for d in dates]
+            return [t for t in created if t is not None]
+
+        # Bulk inserts don't send the signals that would normally invalidate cached calendars.
+        calendarcache.invalidate()
+        for t in tasks:
+            logger.info("Created %s on %s", self.short_desc, t.scheduled_date)
+        return tasks
+
+    def _create_instance(self, d: date) -> Optional['Task']:
+        """Creates a single Task for date d. If task creation fails, log it and carry on."""
+
         logger = logging.getLogger("tasks")
-        while curr < stop:
-            curr += timedelta(days=+1)
-            if self.date_matches_template(curr):
-
-                # If task creation fails, log it and carry on.
-                t = None  # type: Task
-                try:
-                    t = Task.objects.create(
-                        recurring_task_template =self,
-                        creation_date           =date.today(),
-                        scheduled_date          =curr,
-                        orig_sched_date         =curr,
-                        # Copy mixin fields from template to instance:
-                        owner                   =self.owner,
-                        instructions            =Snippet.expand(self.instructions),
-                        short_desc              =self.short_desc,
-                        reviewer                =self.reviewer,
-                        max_work                =self.max_work,
-                        max_workers             =self.max_workers,
-                        work_start_time         =self.work_start_time,
-                        work_duration           =self.work_duration,
-                        should_nag              =self.should_nag,
-                        priority                =self.priority,
-                        anybody_is_eligible     =self.anybody_is_eligible
-                    )
-
-                    # Many-to-many fields:
-                    for ec in TemplateEligibleClaimant2.objects.filter(template_id=self.id):  # type: TemplateEligibleClaimant2
-                        EligibleClaimant2.objects.create(
-                            task_id=t.id,
-                            member_id=ec.member.id,
-                            type=ec.type
-                        )
-
-                    if self.default_claimant is not None:
-                        t.create_default_claim()
-
-                    logger.info("Created %s on %s", self.short_desc, curr)
-
-                except Exception as e:
-                    logger.error("Couldn't create %s on %s because %s", self.short_desc, curr, str(e))
-                    if t is not None:
-                        t.delete()
+        t = None  # type: Task
+        try:
+            t = Task.objects.create(
+                recurring_task_template =self,
+                creation_date           =date.today(),
+                scheduled_date          =d,
+                orig_sched_date         =d,
+                # Copy mixin fields from template to instance:
+                owner                   =self.owner,
+                instructions            =Snippet.expand(self.instructions),
+                short_desc              =self.short_desc,
+                reviewer                =self.reviewer,
+                max_work                =self.max_work,
+                max_workers             =self.max_workers,
+                work_start_time         =self.work_start_time,
+                work_duration           =self.work_duration,
+                should_nag              =self.should_nag,
+                priority                =self.priority,
+                anybody_is_eligible     =self.anybody_is_eligible
+            )
+
+            # Many-to-many fields:
+            for ec in TemplateEligibleClaimant2.objects.filter(template_id=self.id):  # type: TemplateEligibleClaimant2
+                EligibleClaimant2.objects.create(
+                    task_id=t.id,
+                    member_id=ec.member.id,
+                    type=ec.type
+                )
+
+            if self.default_claimant is not None:
+                t.create_default_claim()
+
+            logger.info("Created %s on %s", self.short_desc, d)
+            return t
+
+        except Exception as e:
+            logger.error("Couldn't create %s on %s because %s", self.short_desc, d, str(e))
+            if t is not None:
+                t.delete()
+            return None
 
     def recurrence_str(self):
         days_of_week = self.repeats_on_certain_days()
@@ -508,17 +723,26 @@ class Claim(models.Model, TimeWindowedObject):
         if False:  # TODO: Finish this check
             raise ValidationError(_("Task has a time window so claim must have a start time."))
 
+    def save(self, *args, **kwargs):
+        # A post_save handler updates the task's staffing fields. This keeps both writes in one transaction.
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
     @staticmethod
-    def sum_in_period(startDate, endDate):
-        """ Sum up hours claimed per claimant during period startDate to endDate, inclusive. """
-        claimants = {}
-        for task in Task.objects.filter(scheduled_date__gte=startDate).filter(scheduled_date__lte=endDate):  # type: Task
-            for claim in task.claim_set.all():  # type: Claim
-                if claim.status == claim.STAT_CURRENT:
-                    if claim.claiming_member not in claimants:
-                        claimants[claim.claiming_member] = timedelta(0)
-                    claimants[claim.claiming_member] += claim.claimed_duration
-        return claimants
+    def sum_in_period(startDate, endDate, statuses: Optional[List[str]]=None) -> Dict[mm.Member, timedelta]:
+        """ Sum up hours claimed per claimant during period startDate to endDate, inclusive.
+        Only claims with one of the given statuses are counted. By default, that's just CURRENT claims.
+        """
+        if statuses is None:
+            statuses = [Claim.STAT_CURRENT]
+        totals = Claim.objects.filter(
+            claimed_task__scheduled_date__gte=startDate,
+            claimed_task__scheduled_date__lte=endDate,
+            status__in=statuses,
+        ).order_by().values('claiming_member').annotate(total=models.Sum('claimed_duration'))
+        totals = {row['claiming_member']: row['total'] for row in totals}
+        members = mm.Member.objects.select_related('auth_user').in_bulk(list(totals.keys()))
+        return {members[member_id]: total for member_id, total in totals.items()}
 
     # Implementation of TimeWindowedObject abstract methods:
     def window_start_time(self):
@@ -670,6 +894,39 @@ class Task(TaskMixin, TimeWindowedObject):
     recurring_task_template = models.ForeignKey(RecurringTaskTemplate, null=True, blank=True, related_name="instances",
         on_delete=models.PROTECT)  # Existing code assumes that every task has a template.
 
+    # The following staffing fields are denormalized from the task's claims so that staffing can be
+    # filtered in the DB. They are maintained whenever a claim is saved or deleted and whenever the task
+    # is saved. If they drift, "manage.py rebuildstaffing" will repair them.
+
+    claimed_duration = models.DurationField(null=False, blank=False, default=timedelta(0), editable=False,
+        help_text="The total duration of current and working claims on this task.")
+
+    current_claimant_count = models.IntegerField(null=False, blank=False, default=0, editable=False,
+        help_text="The number of current and working claims on this task.")
+
+    claims_verified = models.BooleanField(null=False, default=True, editable=False,
+        help_text="True if every claim on this task has been verified.")
+
+    likely_claimant = models.ForeignKey(mm.Member, null=True, blank=True, related_name="+", editable=False,
+        on_delete=models.SET_NULL,
+        help_text="The member that is likely to work (or is already working) the task.")
+
+    STAFFING_STATUS_STAFFED     = "S"  # There is a verified current claim.
+    STAFFING_STATUS_UNSTAFFED   = "U"  # There is no current claim.
+    STAFFING_STATUS_PROVISIONAL = "P"  # There is an unverified current claim.
+    STAFFING_STATUS_DONE        = "D"  # A claim is marked as done.
+    STAFFING_STATUS_CHOICES = [
+        (STAFFING_STATUS_STAFFED,     "Staffed"),
+        (STAFFING_STATUS_UNSTAFFED,   "Unstaffed"),
+        (STAFFING_STATUS_PROVISIONAL, "Provisional"),
+        (STAFFING_STATUS_DONE,        "Done"),
+    ]
+    staffing = models.CharField(max_length=1, choices=STAFFING_STATUS_CHOICES, null=False, blank=False,
+        default=STAFFING_STATUS_UNSTAFFED, db_index=True, editable=False,
+        help_text="The staffing status of this task, as of its last claim change.")
+
+    STAFFING_FIELDS = ['claimed_duration', 'current_claimant_count', 'claims_verified', 'likely_claimant_id', 'staffing']
+
     def clean(self):
 
         # TODO: Sum of claim hours should be <= duration if max_claimants==1. More complicated for >1.
@@ -692,6 +949,64 @@ class Task(TaskMixin, TimeWindowedObject):
           and self.orig_sched_date is None:
             raise ValidationError(_("orig_sched_date must be set when scheduled_date is FIRST set."))
 
+    def save(self, *args, **kwargs):
+        # Recompute staffing from the claims so that saving a stale instance can't clobber it.
+        claims = [] if self.pk is None else Claim.objects.filter(claimed_task_id=self.pk).order_by('pk').values_list(
+            'status', 'claimed_duration', 'date_verified', 'claiming_member_id')
+        self.set_staffing(claims)
+        super().save(*args, **kwargs)
+
+    def set_staffing(self, claims) -> None:
+        """Sets the denormalized staffing fields, without saving them.
+        Claims is an iterable of (status, claimed_duration, date_verified, claiming_member_id) tuples, in pk order.
+        """
+        self.claimed_duration = timedelta(0)
+        self.current_claimant_count = 0
+        self.claims_verified = True
+        self.likely_claimant_id = None
+        done = False
+        provisional = False
+        for status, duration, date_verified, member_id in claims:
+            if status in [Claim.STAT_CURRENT, Claim.STAT_WORKING]:
+                self.claimed_duration += duration
+                self.current_claimant_count += 1
+            if date_verified is None:
+                self.claims_verified = False
+                provisional |= status == Claim.STAT_CURRENT
+            if self.likely_claimant_id is None and status in [Claim.STAT_CURRENT, Claim.STAT_WORKING, Claim.STAT_DONE]:
+                self.likely_claimant_id = member_id
+            done |= status == Claim.STAT_DONE
+
+        # Same rules as staffing_status(), below.
+        if done:
+            self.staffing = Task.STAFFING_STATUS_DONE
+        elif self.max_work is not None and self.max_work - self.claimed_duration == timedelta(0):
+            self.staffing = Task.STAFFING_STATUS_PROVISIONAL if provisional else Task.STAFFING_STATUS_STAFFED
+        else:
+            self.staffing = Task.STAFFING_STATUS_UNSTAFFED
+
+    @classmethod
+    def refresh_staffing(cls, task_ids: List[int]) -> int:
+        """Recomputes the denormalized staffing fields of the given tasks from their claims.
+        Returns the number of tasks whose staffing fields had to be changed.
+        """
+        claims = defaultdict(list)
+        for row in Claim.objects.filter(claimed_task_id__in=task_ids).order_by('pk').values_list(
+          'claimed_task_id', 'status', 'claimed_duration', 'date_verified', 'claiming_member_id'):
+            claims[row[0]].append(row[1:])
+
+        changed = 0
+        tasks = cls.objects.filter(pk__in=task_ids).only(
+            'max_work', 'claimed_duration', 'current_claimant_count', 'claims_verified', 'likely_claimant', 'staffing')
+        for task in tasks:  # type: Task
+            before = [getattr(task, f) for f in cls.STAFFING_FIELDS]
+            task.set_staffing(claims[task.pk])
+            after = [getattr(task, f) for f in cls.STAFFING_FIELDS]
+            if before != after:
+                cls.objects.filter(pk=task.pk).update(**dict(zip(cls.STAFFING_FIELDS, after)))
+                changed += 1
+        return changed
+
     @property
     def likely_worker(self) -> Optional[mm.Member]:
         """The member that is likely to work (or is already working) the task."""
@@ -736,11 +1051,6 @@ class Task(TaskMixin, TimeWindowedObject):
     def all_claims_verified(self) -> bool:
         return all(claim.date_verified is not None for claim in self.claim_set.all())
 
-    STAFFING_STATUS_STAFFED     = "S"  # There is a verified current claim.
-    STAFFING_STATUS_UNSTAFFED   = "U"  # There is no current claim.
-    STAFFING_STATUS_PROVISIONAL = "P"  # There is an unverified current claim.
-    STAFFING_STATUS_DONE        = "D"  # A claim is marked as done.
-
     def staffing_status(self) -> str:
         currClaims = self.claim_set.filter(status__in=[Claim.STAT_CURRENT, Claim.STAT_DONE])
         for claim in currClaims:  # type: Claim
@@ -974,11 +1284,12 @@ class Worker(models.Model):
 
     @property
     def time_acct_balance(self) -> Decimal:
-        entries = TimeAccountEntry.objects.filter(worker=self.member.worker)
-        if len(entries) == 0:
-            return _DEC0
-        else:
-            return entries.last().balance
+        # The latest entry's running balance is the current balance.
+        balance = TimeAccountEntry.objects\
+            .filter(worker_id=self.pk)\
+            .order_by('-when', '-pk')\
+            .values_list('balance', flat=True).first()
+        return _DEC0 if balance is None else balance
 
     def populate_calendar_token(self):
         "Creates a calendar token if none exists, else does nothing."
@@ -1210,23 +1521,90 @@ class TimeAccountEntry(models.Model):
         on_delete=models.CASCADE,  # Delete this entry if the mship backing it up is deleted.
         help_text="For debits, a link to the associated membership, if any.")
 
+    # This is a running balance, maintained by save() and by a post_delete handler.
+    # Entries with the same "when" all have the same balance. Use "manage.py rebuildtimeaccts" to repair it.
+    balance = models.DecimalField(max_digits=7, decimal_places=2,
+        null=True, blank=True, editable=False,
+        help_text="The worker's balance (in hours) as of this entry's date/time.")
+
     class Meta:
         ordering = ['when']
         verbose_name_plural = "time account entries"
+        indexes = [models.Index(fields=['worker', 'when'])]
 
     def __str__(self) -> str:
         change_str = "added to" if self.change > Decimal("0") else "removed from"
         return "{} hrs {} {}".format(self.change, change_str, self.worker.username)
 
-    @property
-    def balance(self) -> Decimal:
-        log = TimeAccountEntry.objects.filter(
-            worker=self.worker,
-            when__lte=self.when,
-            # expires__gt=self.effective No, we'll add an explicit Entry to reverse it.
-        )
-        balance = log.aggregate(models.Sum('change'))['change__sum']
-        return balance
+    # Per thread, the number of suspend_balance_shifts() blocks that are currently active.
+    _balance_shifts = threading.local()
+
+    @staticmethod
+    @contextmanager
+    def suspend_balance_shifts():
+        """Within this block, deleting entries doesn't adjust the balances of later entries.
+        For bulk changes that rebuild the balances afterwards, since shifting them one entry at a time is quadratic.
+        """
+        state = TimeAccountEntry._balance_shifts
+        state.suspended = getattr(state, 'suspended', 0) + 1
+        try:
+            yield
+        finally:
+            state.suspended -= 1
+
+    @staticmethod
+    def balance_shifts_suspended() -> bool:
+        return getattr(TimeAccountEntry._balance_shifts, 'suspended', 0) > 0
+
+    @staticmethod
+    def shift_balances(worker_id: int, when: datetime, change: Decimal, exclude_pk: Optional[int]=None) -> None:
+        """Adjusts the running balance of worker's entries at or after "when" by "change"."""
+        later = TimeAccountEntry.objects.filter(worker_id=worker_id, when__gte=when)
+        if exclude_pk is not None:
+            later = later.exclude(pk=exclude_pk)
+        later.update(balance=models.F('balance') + change)
+
+    def save(self, *args, **kwargs):
+        # Handlers sometimes specify the change as a float.
+        self.change = Decimal(self.change).quantize(Decimal("0.01"))
+        with transaction.atomic():
+            if self.pk is not None:
+                # Back out the previous version of this entry, as if it were being deleted.
+                prev = TimeAccountEntry.objects.filter(pk=self.pk).values_list('worker_id', 'when', 'change').first()
+                if prev is not None:
+                    prev_worker_id, prev_when, prev_change = prev
+                    TimeAccountEntry.shift_balances(prev_worker_id, prev_when, -prev_change, exclude_pk=self.pk)
+            # An earlier (or simultaneous) entry has the balance that this one adds to.
+            base = TimeAccountEntry.objects\
+                .filter(worker_id=self.worker_id, when__lte=self.when)\
+                .exclude(pk=self.pk)\
+                .order_by('-when', '-pk')\
+                .values_list('balance', flat=True).first()
+            self.balance = (_DEC0 if base is None else base) + self.change
+            super().save(*args, **kwargs)
+            TimeAccountEntry.shift_balances(self.worker_id, self.when, self.change, exclude_pk=self.pk)
+
+    @classmethod
+    def rebuild_balances(cls, worker: Optional[Worker]=None) -> int:
+        """Recomputes the running balances of the given worker's entries or, if worker is None, of all entries.
+        Returns the number of entries whose balance had to be changed.
+        """
+        entries = TimeAccountEntry.objects.all()
+        if worker is not None:
+            entries = entries.filter(worker=worker)
+        rows = entries.order_by('worker_id', 'when', 'pk').values_list('worker_id', 'when', 'pk', 'change', 'balance')
+
+        changed = 0
+        for _, worker_rows in groupby(rows.iterator(), itemgetter(0)):
+            balance = _DEC0
+            for _, when_rows in groupby(worker_rows, itemgetter(1)):
+                when_rows = list(when_rows)
+                balance += sum(change for _, _, _, change, _ in when_rows)
+                for _, _, pk, _, old_balance in when_rows:
+                    if old_balance != balance:
+                        TimeAccountEntry.objects.filter(pk=pk).update(balance=balance)
+                        changed += 1
+        return changed
 
     def clean(self):
         link_count = sum([self.work is not None, self.mship is not None, self.play is not None])
@@ -1234,58 +1612,83 @@ class TimeAccountEntry(models.Model):
             raise ValidationError("Specify ONE of work/play/mship or NONE of them.")
 
     @classmethod
-    def regenerate_expirations(cls, worker: Worker) -> None:
+    def regenerate_expirations(cls, worker: Optional[Worker]=None) -> int:
+        """Regenerates the expiration entries for the given worker or, if worker is None, for all workers.
+        Returns the number of expiration entries created.
+        """
         # TODO: This code doesn't yet handle TYPE_ADJUSTMENT
 
-        # Delete the current expirations since we'll regenerate all of them:
-        TimeAccountEntry.objects.filter(
-            worker=worker,
-            type=TimeAccountEntry.TYPE_EXPIRATION,
-        ).delete()
+        entries = TimeAccountEntry.objects.filter(
+            type__in=[TimeAccountEntry.TYPE_DEPOSIT, TimeAccountEntry.TYPE_WITHDRAWAL]
+        ).exclude(change=_DEC0)
+        old_expirations = TimeAccountEntry.objects.filter(type=TimeAccountEntry.TYPE_EXPIRATION)
+        if worker is not None:
+            entries = entries.filter(worker=worker)
+            old_expirations = old_expirations.filter(worker=worker)
+
+        now = timezone.now()
+        expirations = []
+        for _, worker_entries in groupby(entries.order_by('worker_id', 'when', 'pk').iterator(), attrgetter('worker_id')):
+            deposits = []
+            withdrawals = []
+            for entry in worker_entries:  # type: TimeAccountEntry
+                if entry.type == TimeAccountEntry.TYPE_DEPOSIT:
+                    deposits.append(entry)
+                else:
+                    withdrawals.append(entry)
+            expirations.extend(cls._expirations_fifo(deposits, withdrawals, now))
+
+        # Replace the current expirations with the regenerated ones.
+        # Neither the delete nor the bulk insert adjust the running balances one entry at a time,
+        # since those are all rebuilt afterwards.
+        with transaction.atomic():
+            with TimeAccountEntry.suspend_balance_shifts():
+                old_expirations.delete()
+            TimeAccountEntry.objects.bulk_create(expirations)
+            TimeAccountEntry.rebuild_balances(worker)
+        return len(expirations)
 
-        deposits = TimeAccountEntry.objects.filter(
-            worker=worker,
-            type=TimeAccountEntry.TYPE_DEPOSIT
-        ).exclude(change=_DEC0).order_by('when')
+    @staticmethod
+    def _expirations_fifo(deposits: List['TimeAccountEntry'], withdrawals: List['TimeAccountEntry'], now: datetime):
+        """Uses deposits to cover withdrawals, first in first out, in a single pass over both.
+        Deposits and withdrawals must be ordered by 'when' and must belong to the same worker.
+        Returns unsaved expiration entries for the unused portions of deposits that have expired.
+        """
+        expirations = []  # type: List[TimeAccountEntry]
 
-        withdrawals = TimeAccountEntry.objects.filter(
-            worker=worker,
-            type=TimeAccountEntry.TYPE_WITHDRAWAL
-        ).exclude(change=_DEC0).order_by('when')
+        # Withdrawals are always covered in order, so the ones before w are completely covered.
+        w = 0
+        not_covered = -withdrawals[0].change if len(withdrawals) > 0 else _DEC0  # Positive uncovered amount of withdrawal w.
 
-        for deposit in deposits:  # type: TimeAccountEntry
+        for deposit in deposits:
             deposit_available = deposit.change
 
-            # Look at all the withdrawals and decide which use the deposit available.
-            for withdrawal in withdrawals:  # type: TimeAccountEntry
-                if deposit_available.is_zero():
-                    # The deposit under examination has been fully utilized, so skip the rest of the withdrawals.
-                    break
-                if withdrawal.when > deposit.expires:
-                    # The deposit has expired from the perspective of the withdrawal, so skip it.
+            while deposit_available > _DEC0 and w < len(withdrawals):
+                if deposit.expires is not None and withdrawals[w].when > deposit.expires:
+                    # The deposit has expired from the perspective of this withdrawal and all later ones.
                     # This is what limits rollover.
-                    continue
-                if not hasattr(withdrawal, 'not_covered'):
-                    withdrawal.not_covered = withdrawal.change
-                if withdrawal.not_covered.is_zero():
-                    # The withdrawal is already completely covered by other deposits, so skip it.
-                    continue
-                deposit_amt_to_use = min(deposit_available, -1*withdrawal.not_covered)
+                    break
+                deposit_amt_to_use = min(deposit_available, not_covered)
                 deposit_available -= deposit_amt_to_use
-                withdrawal.not_covered += deposit_amt_to_use
+                not_covered -= deposit_amt_to_use
+                if not_covered <= _DEC0:
+                    w += 1
+                    not_covered = -withdrawals[w].change if w < len(withdrawals) else _DEC0
 
-            if deposit_available > _DEC0 and timezone.now() > deposit.expires:
+            if deposit_available > _DEC0 and deposit.expires is not None and now > deposit.expires:
                 explanation = "{} rolled-over hour(s) expired".format(deposit_available, deposit.when)
-                TimeAccountEntry.objects.create(
+                expirations.append(TimeAccountEntry(
                     type=TimeAccountEntry.TYPE_EXPIRATION,
                     work=None,
                     play=None,
                     explanation=explanation,
-                    worker=deposit.worker,
+                    worker_id=deposit.worker_id,
                     change=-1 * deposit_available,
                     when=deposit.expires,
                     expires=None  # not applicable.
-                )
+                ))
+
+        return expirations
 
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -1,5 +1,6 @@
 
 # Standard
+from datetime import timedelta
 
 # Third Party
 from rest_framework import serializers
@@ -72,11 +73,20 @@ class TaskSerializer(serializers.ModelSerializer):
         read_only=True, many=True, view_name='memb:member-detail', source='eligible_claimants_2'
     )
     claim_set = ClaimSerializer(many=True, read_only=True)
-    name_of_likely_worker = serializers.ReadOnlyField()  # This is a helpful "denormalization"
+    name_of_likely_worker = serializers.SerializerMethodField()  # This is a helpful "denormalization"
 
     # REVIEW: Having both of these seems redundant but both will remain, for now, for compatibility reasons.
-    is_fully_claimed = serializers.ReadOnlyField()
-    staffing_status = serializers.ReadOnlyField()
+    # These are read from the task's denormalized staffing fields so that lists of tasks don't query claims per task.
+    is_fully_claimed = serializers.SerializerMethodField()
+    staffing_status = serializers.ReadOnlyField(source='staffing')
+
+    @staticmethod
+    def get_name_of_likely_worker(obj: tm.Task):
+        return obj.likely_claimant.friendly_name if obj.likely_claimant is not None else None
+
+    @staticmethod
+    def get_is_fully_claimed(obj: tm.Task) -> bool:
+        return obj.max_work - obj.claimed_duration == timedelta(0)
 
     class Meta:
         model = tm.Task
@@ -51,7 +51,9 @@ class PlayViewSet(viewsets.ModelViewSet):
 # ---------------------------------------------------------------------------
 
 class TaskViewSet(viewsets.ModelViewSet):
-    queryset = tm.Task.objects.all().order_by('id')
+    queryset = tm.Task.objects.all().order_by('id')\
+        .select_related('likely_claimant__auth_user')\
+        .prefetch_related('claim_set')
     serializer_class = ts.TaskSerializer
     permission_classes = [IsAuthenticatedOrReadOnly, tp.TaskPermission]
     authentication_classes = [
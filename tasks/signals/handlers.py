@@ -1,16 +1,14 @@
 # Standard
 import logging
 from datetime import date, datetime, timedelta, time
-from decimal import Decimal
 
 # Third Party
-from django.db.models.signals import pre_save, post_save
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 from django.urls import reverse
 from django.contrib.sites.models import Site
 from django.conf import settings
 from django.utils import timezone
-from django.utils.timezone import localtime
 
 # Local
 from members.models import Member, Tagging, VisitEvent, Membership
@@ -19,6 +17,8 @@ from tasks.models import (
     Class_x_Person, ClassPayment
 )
 import members.notifications as notifications
+import tasks.calendarcache as calendarcache
+import tasks.timeaccounting as timeaccounting
 
 __author__ = 'Adrian'
 
@@ -76,6 +76,23 @@ def staffing_update_notification(sender, **kwargs):
         logger.error("Problem sending staffing update.")
 
 
+@receiver([post_save, post_delete], sender=Claim)
+def maintain_task_staffing(sender, **kwargs):
+    """Keep the claimed task's denormalized staffing fields in step with its claims."""
+    unused(sender)
+    claim = kwargs.get('instance')  # type: Claim
+    Task.refresh_staffing([claim.claimed_task_id])
+
+
+@receiver([post_save, post_delete], sender=Task)
+@receiver([post_save, post_delete], sender=Claim)
+@receiver([post_save, post_delete], sender=Worker)
+def invalidate_calendars(sender, **kwargs):
+    """Cached calendar feeds are built from tasks, claims and workers, so discard them when any of those change."""
+    unused(sender)
+    calendarcache.invalidate()
+
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 # VISIT
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -132,18 +149,7 @@ def maintenance_nag(sender, **kwargs):
             return
 
         # Only act on a member's first visit of the day.
-        start_of_today = localtime(timezone.now()).replace(
-            hour=4,  # For the purpose of this nag, I'm going to say that day begins at 4am.
-            minute=0,
-            second=0,
-            microsecond=0,
-        )
-        num_visits_today = VisitEvent.objects.filter(
-            who=visit.who,
-            event_type=VisitEvent.EVT_ARRIVAL,
-            when__gte=start_of_today,
-        ).count()
-        if num_visits_today > 1:
+        if not visit.is_first_of_day():
             return
 
         # This gets tasks that are scheduled like maintenance tasks.
@@ -262,159 +268,41 @@ def notify_manager_re_staff_arrival(sender, **kwargs):
 # TIME ACCOUNTING
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
-@receiver(post_save, sender=Work)
-@receiver(pre_save, sender=Work)
-def credit_time_acct_for_work(sender, **kwargs):
-    """When a witnessed work entry is created, credit it to the worker's time account."""
+@receiver(post_delete, sender=TimeAccountEntry)
+def maintain_time_acct_balances(sender, **kwargs):
+    """When an entry is deleted, take its change out of the running balance of the worker's later entries."""
     unused(sender)
-    try:
-        work = kwargs.get('instance')  # type: Work
+    entry = kwargs.get('instance')  # type: TimeAccountEntry
+    if TimeAccountEntry.balance_shifts_suspended():
+        return  # The balances are being rebuilt in bulk.
+    TimeAccountEntry.shift_balances(entry.worker_id, entry.when, -entry.change)
 
-        if work.pk is None:
-            # The work hasn't yet been saved to DB, so we can't link a TimeAccountEntry to it.
-            return
 
-        # While testing in shell, mship.member.worker is not available.
-        worker = Worker.objects.get(member_id=work.claim.claiming_member_id) # type: Worker
+# The entries themselves are derived by jobs on the rq worker. See tasks.timeaccounting.
 
-        try:
-            # If there's already an entry for this work, delete it since we'll recreate it.
-            TimeAccountEntry.objects.get(work=work).delete()
-        except TimeAccountEntry.DoesNotExist:
-            pass
-
-        # Remember: Time accounting is denominated in hours.
-        if work.witness is not None:
-            explanation="Work witnessed by {}".format(work.witness.username)
-            change=Decimal.from_float(work.work_duration.total_seconds() / 3600.0)
-            expires=work.datetime + timedelta(days=90)
-        else:  # Work was not witnessed so has no value.
-            explanation="Unwitnessed work"
-            change=Decimal.from_float(0.0)
-            expires=None  # i.e. n/a
-
-        TimeAccountEntry.objects.create(
-            type=TimeAccountEntry.TYPE_DEPOSIT,
-            work=work,
-            explanation=explanation,
-            worker=worker,
-            change=change,
-            when=work.datetime,
-            expires=expires
-        )
-
-        # TimeAccountEntry.regenerate_expirations(worker)
-
-    except Exception as e:
-        # Makes sure that problems here do not prevent the visit event from being saved!
-        logger.error("Problem in credit_time_account: %s", str(e))
+@receiver(post_save, sender=Work)
+def credit_time_acct_for_work(sender, **kwargs):
+    """When a witnessed work entry is created, credit it to the worker's time account."""
+    unused(sender)
+    work = kwargs.get('instance')  # type: Work
+    timeaccounting.schedule_work(work)
 
 
 @receiver(post_save, sender=Membership)
-@receiver(pre_save, sender=Membership)
 def debit_time_acct_for_mship(sender, **kwargs):
     """When an x month Work Trade membership is purchased, debit the worker's time account."""
     unused(sender)
-
-    try:
-        mship = kwargs.get('instance')  # type: Membership
-
-        if mship.pk is None:
-            # The mship hasn't yet been saved to DB, so we can't link a TimeAccountEntry to it.
-            return
-
-        if mship.membership_type != Membership.MT_WORKTRADE:
-            # This only applies to Work Trade memberships.
-            return
-
-        if mship.member is None:
-            # Sometimes automatic payment processing can't determine the member.
-            # If we run into one of these cases, just ignore it for now.
-            # It will be handled when the member reference is manuallys set.
-            return
-
-        # While testing in shell, mship.member.worker is not available.
-        worker = Worker.objects.get(member_id=mship.member_id) # type: Worker
-
-        try:
-            # If there's already an entry for this membership, delete it since we'll recreate it.
-            TimeAccountEntry.objects.get(mship=mship).delete()
-        except TimeAccountEntry.DoesNotExist:
-            pass
-
-        # REVIEW: This should be two different WT membership types, instead of depending on $price?
-        if mship.sale_price == Decimal("25.00"):
-            time_cost = Decimal("-6.0")
-        elif mship.sale_price == Decimal("10.00"):
-            time_cost = Decimal("-9.0")
-        else:
-            logger.error("Unexpected $%f sale price for mship #%ld", mship.sale_price, mship.id)
-            # Let them have it for 0 hours, until we figure out what happened and make a manual fix.
-            time_cost = Decimal("0.0")
-
-        # Remember: Time accounting is denominated in hours.
-        TimeAccountEntry.objects.create(
-            type=TimeAccountEntry.TYPE_WITHDRAWAL,
-            mship=mship,
-            explanation="Membership discount".format(mship.start_date),
-            worker=worker,
-            change=time_cost,
-            when=mship.datetime
-        )
-
-        # TimeAccountEntry.regenerate_expirations(worker)
-
-    except Exception as e:
-        # Makes sure that problems here do not prevent the visit event from being saved!
-        logger.error("Problem in debit_time_acct_for_mship: %s", str(e))
+    mship = kwargs.get('instance')  # type: Membership
+    if mship.membership_type == Membership.MT_WORKTRADE:
+        timeaccounting.schedule_mship(mship)
 
 
 @receiver(post_save, sender=Play)
-@receiver(pre_save, sender=Play)
 def debit_time_acct_for_play(sender, **kwargs):
     """When somebody plays for x hours, debit the worker's time account by 0.5x"""
     unused(sender)
-
-    try:
-        play = kwargs.get('instance')  # type: Play
-
-        if play.pk is None:
-            # The mship hasn't yet been saved to DB, so we can't link a TimeAccountEntry to it.
-            return
-
-        # While testing in shell, mship.member.worker is not available.
-        player = Member.objects.get(id=play.playing_member_id) # type: Member
-
-        try:
-            # If there's already an entry for this membership, delete it since we'll recreate it.
-            TimeAccountEntry.objects.get(play=play).delete()
-        except TimeAccountEntry.DoesNotExist:
-            pass
-
-        # Remember: Time accounting is denominated in hours.
-        if play.play_duration is None:
-            hours_cost = -2.0  # DEFAULT VALUE, I.E. HALF OF 4.0
-            explanation="Unspecified play time! Defaulted to 4.0hrs"
-        else:
-            hours_played = play.play_duration.total_seconds() / 3600.0  # type: float
-            hours_cost = -0.5 * hours_played  # type: float
-            explanation="{} hour(s) of play time".format(hours_played)
-
-        # Remember: Time accounting is denominated in hours.
-        TimeAccountEntry.objects.create(
-            type=TimeAccountEntry.TYPE_WITHDRAWAL,
-            play=play,
-            explanation=explanation,
-            worker=player.worker,
-            change=hours_cost,
-            when=play.datetime
-        )
-
-        # TimeAccountEntry.regenerate_expirations(worker)
-
-    except Exception as e:
-        # Makes sure that problems here do not prevent the visit event from being saved!
-        logger.error("Problem in debit_time_acct_for_play: %s", str(e))
+    play = kwargs.get('instance')  # type: Play
+    timeaccounting.schedule_play(play)
 
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -1,12 +1,17 @@
 # Standard
 from datetime import datetime, date, timedelta, time
+from decimal import Decimal
 from pydoc import locate  # for loading classes
 import os
+from io import StringIO
+from unittest.mock import patch
 
 # Third Party
 from django.core import management, mail
 from django.urls import reverse
 from django.test import TestCase, TransactionTestCase, LiveServerTestCase, Client, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 from django.contrib.auth.models import User
 from django.contrib.admin import site
 from django.core.management import call_command
@@ -18,6 +23,7 @@ from selenium.common.exceptions import NoSuchElementException
 import lxml.html
 import requests
 from pyvirtualdisplay import Display
+from icalendar import Calendar
 from rest_framework.test import APIRequestFactory
 from rest_framework.test import force_authenticate
 
@@ -29,11 +35,15 @@ from tasks.models import (
     Work, WorkNote,
     Nag,
     Snippet,
-    Worker
-
+    Worker,
+    TimeAccountEntry, Play,
 )
 from members.models import Member, VisitEvent
+from tasks.management.commands.scheduletasks import Command as ScheduleTasksCommand
+from tasks.management.commands.nag import Command as NagCommand
 import tasks.restapi as restapi
+import tasks.views as task_views
+import tasks.calendarcache as calendarcache
 from members.notifications import notify
 
 USER_VOLUNTEER = settings.BZWOPS_TASKS_CONFIG.get("USER_VOLUNTEER", None)
@@ -346,6 +356,14 @@ class TestRecurringTaskTemplateCertainDays(TestCase):
         self.rt.create_tasks(max_days_in_advance=34)
         self.assertEqual(len(Task.objects.all()), count)
 
+    def test_matching_dates(self):
+        self.rt.first = True
+        self.rt.wednesday = True
+        self.rt.jul = False
+        start = date(2018, 1, 1)
+        expected = [start + n*ONEDAY for n in range(366) if self.rt.date_matches_template_certain_days(start + n*ONEDAY)]
+        self.assertEqual(self.rt.matching_dates(start, start + 365*ONEDAY), expected)
+
 
 class TestRecurringTaskTemplateIntervals(TransactionTestCase):
 
@@ -365,6 +383,100 @@ class TestRecurringTaskTemplateIntervals(TransactionTestCase):
         self.assertEqual(len(Task.objects.all()), 13)
 
 
+class TestRecurringTaskTemplateBulkCreate(TestCase):
+
+    def setUp(self):
+        self.instructor = User.objects.create_user(username='instructor', password='123').member
+        self.helper = User.objects.create_user(username='helper', password='123').member
+        self.rt = RecurringTaskTemplate.objects.create(
+            short_desc = "a test",
+            max_work = timedelta(hours=1.5),
+            work_start_time = time(18, 0),
+            work_duration = timedelta(hours=1.5),
+            start_date = date.today(),
+            default_claimant = self.instructor,
+            repeat_interval = 7)
+        self.rt.full_clean()
+        TemplateEligibleClaimant2.objects.create(
+            template=self.rt, member=self.helper, type=TemplateEligibleClaimant2.TYPE_ELIGIBLE_2ND)
+
+    def test_create_tasks(self):
+        self.rt.create_tasks(27)
+        self.assertEqual(Task.objects.count(), 4)
+        for task in Task.objects.all():  # type: Task
+            self.assertEqual(task.all_eligible_claimants(), {self.helper})
+            self.assertEqual(task.claimant_set(Claim.STAT_CURRENT), {self.instructor})
+            self.assertEqual(task.orig_sched_date, task.scheduled_date)
+
+    def test_skips_taken_dates(self):
+        Task.objects.create(
+            short_desc = self.rt.short_desc,
+            max_work = timedelta(hours=1.5),
+            work_start_time = self.rt.work_start_time,
+            scheduled_date = date.today() + 6*ONEDAY,
+        )
+        self.rt.create_tasks(13)
+        self.assertEqual(self.rt.instances.count(), 1)
+        self.assertEqual(self.rt.greatest_scheduled_date(), date.today() + 13*ONEDAY)
+
+    def test_watermark(self):
+        self.rt.create_tasks(27)
+        self.assertEqual(self.rt.materialized_through, date.today() + 27*ONEDAY)
+
+        # A deleted instance isn't recreated by a normal run, since its date is behind the watermark...
+        self.rt.instances.filter(scheduled_date=date.today() + 13*ONEDAY).delete()
+        management.call_command("scheduletasks", "27")
+        self.assertEqual(self.rt.instances.count(), 3)
+
+        # ...but a targeted re-materialization does recreate it.
+        management.call_command("scheduletasks", "0", templates=[self.rt.id], since=date.today())
+        self.assertEqual(self.rt.instances.count(), 4)
+        self.rt.refresh_from_db()
+        self.assertEqual(self.rt.materialized_through, date.today() + 27*ONEDAY)
+
+
+class TestRescheduleMissedDates(TestCase):
+
+    def setUp(self):
+        self.rt = RecurringTaskTemplate.objects.create(
+            short_desc = "a test",
+            max_work = timedelta(hours=1.5),
+            start_date = date.today() - 7*ONEDAY,
+            repeat_interval = 7,
+            missed_date_action = RecurringTaskTemplate.MDA_SLIDE_SELF_AND_LATER)
+        self.rt.full_clean()
+        for days in [-3, 4, 11]:
+            Task.objects.create(
+                recurring_task_template = self.rt,
+                short_desc = self.rt.short_desc,
+                max_work = self.rt.max_work,
+                scheduled_date = date.today() + days*ONEDAY,
+                orig_sched_date = date.today() + days*ONEDAY,
+            )
+
+    def test_slide(self):
+        self.assertEqual(ScheduleTasksCommand.reschedule_missed_dates(), {self.rt: 3})
+        self.assertEqual(
+            list(self.rt.instances.values_list('scheduled_date', flat=True)),
+            [date.today(), date.today() + 7*ONEDAY, date.today() + 14*ONEDAY]
+        )
+        # Nothing is overdue anymore, so a second slide does nothing.
+        self.assertEqual(ScheduleTasksCommand.reschedule_missed_dates(), {})
+
+    def test_rematerialize_after_slide(self):
+        # The template's own cadence would be days 1, 8, 15 and 22.
+        RecurringTaskTemplate.objects.filter(pk=self.rt.pk).update(
+            start_date=date.today() - 5*ONEDAY, materialized_through=date.today() + 21*ONEDAY)
+        self.rt.refresh_from_db()
+        ScheduleTasksCommand.reschedule_missed_dates()
+        # Re-materializing continues the slid instances' cadence instead of adding a second set alongside them.
+        self.rt.create_tasks(0, since=date.today())
+        self.assertEqual(
+            list(self.rt.instances.order_by('scheduled_date').values_list('scheduled_date', flat=True)),
+            [date.today(), date.today() + 7*ONEDAY, date.today() + 14*ONEDAY, date.today() + 21*ONEDAY]
+        )
+
+
 class TestPriorityMatch(TestCase):
 
     def testPrioMatch(self):
@@ -574,6 +686,126 @@ class TestViews(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertContains(response, "TCV")
 
+    def test_ops_calendars_single_pass(self):
+
+        for desc, verified in [("Staffed", date.today()), ("Provisional", None)]:
+            t = Task.objects.create(
+                short_desc=desc,
+                max_work=timedelta(hours=2),
+                max_workers=1,
+                work_start_time=time(19,00,00),
+                work_duration=timedelta(hours=2),
+                scheduled_date=date.today(),
+                orig_sched_date=date.today(),
+            )
+            Claim.objects.create(
+                claimed_task=t,
+                claiming_member=self.member,
+                claimed_duration=t.work_duration,
+                claimed_start_time=t.work_start_time,
+                status=Claim.STAT_CURRENT,
+                date_verified=verified,
+            )
+
+        request = RequestFactory().get(reverse('task:ops-calendar'))
+        with self.assertNumQueries(2):  # The tasks, then their claims along with members and users.
+            docs = task_views._render_ops_calendars(request)
+
+        self.assertEqual(set(docs.keys()), {"ops", "ops-staffed", "ops-provisional", "ops-unstaffed"})
+        # Of the "Test Task" instances created in setUp, the first is provisionally claimed and the rest aren't.
+        expected = {
+            "ops": ["Test Task", "Staffed", "Provisional"],
+            "ops-staffed": ["Staffed"],
+            "ops-provisional": ["Test Task", "Provisional"],
+            "ops-unstaffed": ["Test Task"],
+        }
+        for feed, summaries in expected.items():
+            cal = Calendar.from_ical(docs[feed])
+            actual = {str(event['summary']) for event in cal.walk('VEVENT')}
+            self.assertEqual(actual, set(summaries), feed)
+
+    def test_calendar_caching(self):
+
+        t = Task.objects.create(
+            short_desc="TCC",
+            max_work=timedelta(hours=2),
+            max_workers=1,
+            work_start_time=time(19,00,00),
+            work_duration=timedelta(hours=2),
+            scheduled_date=date.today(),
+            orig_sched_date=date.today(),
+        )
+
+        client = Client()
+        url = reverse('task:ops-calendar')
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        # Client already has the latest version.
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # A new claim changes the feed.
+        Claim.objects.create(
+            claimed_task=t,
+            claiming_member=self.member,
+            claimed_duration=t.work_duration,
+            claimed_start_time=t.work_start_time,
+            status=Claim.STAT_CURRENT,
+        )
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertContains(response, self.member.friendly_name)
+
+    def test_member_calendar_cache_key(self):
+        url = reverse('task:member-calendar', kwargs={'token': self.arbitrary_token_b64})
+        self.assertEqual(Client().get(url).status_code, 200)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT cache_key FROM {}".format(settings.CACHES['default']['LOCATION']))
+            keys = [row[0] for row in cursor.fetchall()]
+        self.assertTrue(any("member:" in key for key in keys))
+        self.assertFalse(any(self.arbitrary_token_b64 in key for key in keys))
+
+    def test_calendar_change_during_render(self):
+
+        t = Task.objects.create(
+            short_desc="TCC",
+            max_work=timedelta(hours=2),
+            max_workers=1,
+            work_start_time=time(19,00,00),
+            work_duration=timedelta(hours=2),
+            scheduled_date=date.today(),
+            orig_sched_date=date.today(),
+        )
+        render_ops_calendars = task_views._render_ops_calendars
+
+        def render_then_claim(request):
+            docs = render_ops_calendars(request)
+            # The claim is made after the feeds were rendered but before they're cached.
+            # It's made without signals so that the generation is bumped exactly once, like a single save would.
+            Claim.objects.bulk_create([Claim(
+                claimed_task=t,
+                claiming_member=self.member,
+                claimed_duration=t.work_duration,
+                claimed_start_time=t.work_start_time,
+                status=Claim.STAT_CURRENT,
+            )])
+            Task.refresh_staffing([t.pk])
+            calendarcache.invalidate()
+            return docs
+
+        client = Client()
+        with patch.object(task_views, '_render_ops_calendars', render_then_claim):
+            stale = client.get(reverse('task:ops-calendar'))
+
+        # Neither the requested feed nor the ones rendered alongside it are served as current.
+        response = client.get(reverse('task:ops-calendar-provisional'))
+        self.assertContains(response, "TCC")
+        response = client.get(reverse('task:ops-calendar'))
+        self.assertNotEqual(response['ETag'], stale['ETag'])
+
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 
@@ -618,6 +850,240 @@ class RunSchedAndNagCmds(TestCase):
         self.assertEqual(len(Nag.objects.all()), 1)
 
 
+class TestNagPlan(TestCase):
+
+    def setUp(self):
+        self.members = []
+        for name in ['alpha', 'bravo', 'charlie']:
+            member = User.objects.create_user(username=name, password='123', email=name+'@example.com').member
+            member.worker.should_nag = True
+            member.worker.save()
+            self.members.append(member)
+        self.tasks = []
+        for n in range(3):
+            task = Task.objects.create(
+                short_desc="Nag Plan Test",
+                max_work=timedelta(hours=2),
+                max_workers=1,
+                work_start_time=time(9+n, 0),
+                work_duration=timedelta(hours=2),
+                scheduled_date=date.today()+ONEDAY,
+                should_nag=True,
+            )
+            for member in self.members:
+                EligibleClaimant2.objects.create(task=task, member=member, type=EligibleClaimant2.TYPE_ELIGIBLE_2ND)
+            self.tasks.append(task)
+
+    def test_plan(self):
+        alpha, bravo, charlie = self.members
+        t0, t1, t2 = self.tasks
+        Claim.objects.create(claimed_task=t0, claiming_member=alpha, status=Claim.STAT_CURRENT, claimed_duration=2*ONEHOUR)
+        Claim.objects.create(claimed_task=t1, claiming_member=bravo, status=Claim.STAT_UNINTERESTED, claimed_duration=2*ONEHOUR)
+        Claim.objects.create(claimed_task=t2, claiming_member=charlie, status=Claim.STAT_EXPIRED, claimed_duration=2*ONEHOUR)
+
+        nag_lists, emergency_tasks = NagCommand.plan_nags(date.today())
+        self.assertEqual(emergency_tasks, [])
+        self.assertEqual(nag_lists[alpha], [t1, t2])
+        self.assertEqual(nag_lists[bravo], [t2])
+        self.assertEqual(nag_lists[charlie], [t1, t2])
+
+
+class TestScheduledLoad(TestCase):
+
+    def setUp(self):
+        self.alpha = User.objects.create_user(username='alpha', password='123', email='alpha@example.com').member
+        self.bravo = User.objects.create_user(username='bravo', password='123', email='bravo@example.com').member
+        for n, (member, status) in enumerate([
+          (self.alpha, Claim.STAT_CURRENT),
+          (self.alpha, Claim.STAT_CURRENT),
+          (self.alpha, Claim.STAT_EXPIRED),
+          (self.bravo, Claim.STAT_DONE)]):
+            task = Task.objects.create(
+                short_desc="Load Test",
+                max_work=timedelta(hours=2),
+                max_workers=1,
+                work_start_time=time(9+n, 0),
+                work_duration=timedelta(hours=2),
+                scheduled_date=date.today()+ONEDAY,
+            )
+            Claim.objects.create(claimed_task=task, claiming_member=member, status=status, claimed_duration=2*ONEHOUR)
+
+    def test_sum_in_period(self):
+        tomorrow = date.today()+ONEDAY
+        self.assertEqual(Claim.sum_in_period(tomorrow, tomorrow), {self.alpha: 4*ONEHOUR})
+        self.assertEqual(
+            Claim.sum_in_period(tomorrow, tomorrow, [Claim.STAT_CURRENT, Claim.STAT_EXPIRED, Claim.STAT_DONE]),
+            {self.alpha: 6*ONEHOUR, self.bravo: 2*ONEHOUR}
+        )
+        self.assertEqual(Claim.sum_in_period(date.today(), date.today()), {})
+
+    def test_endpoint(self):
+        url = reverse('task:scheduled-load')
+        client = Client()
+        self.assertEqual(client.get(url).status_code, 401)
+
+        User.objects.create_superuser(username='admin', password='123', email='')
+        client.login(username='admin', password='123')
+        response = client.get(url, {'status': [Claim.STAT_CURRENT, Claim.STAT_DONE]})
+        self.assertEqual(response.status_code, 200)
+        load = response.json()['load']
+        self.assertEqual([(x['username'], x['hours']) for x in load], [('alpha', 4.0), ('bravo', 2.0)])
+
+        self.assertEqual(client.get(url, {'start': "tomorrow"}).status_code, 400)
+        self.assertEqual(client.get(url, {'status': "Z"}).status_code, 400)
+
+
+class TestTaskStaffing(TestCase):
+
+    def setUp(self):
+        self.alpha = User.objects.create_user(username='alpha', password='123', email='alpha@example.com').member
+        self.bravo = User.objects.create_user(username='bravo', password='123', email='bravo@example.com').member
+        self.task = Task.objects.create(
+            short_desc="Staffing Test",
+            max_work=timedelta(hours=2),
+            max_workers=2,
+            work_start_time=time(9, 0),
+            work_duration=timedelta(hours=2),
+            scheduled_date=date.today()+ONEDAY,
+        )
+
+    def assertStaffing(self, duration, count, verified, likely, staffing):
+        task = Task.objects.get(pk=self.task.pk)
+        self.assertEqual(task.claimed_duration, duration)
+        self.assertEqual(task.current_claimant_count, count)
+        self.assertEqual(task.claims_verified, verified)
+        self.assertEqual(task.likely_claimant, likely)
+        self.assertEqual(task.staffing, staffing)
+        # The denormalized fields must agree with the values computed from the claims.
+        self.assertEqual(task.staffing, task.staffing_status())
+        self.assertEqual(task.claims_verified, task.all_claims_verified())
+        self.assertEqual(task.likely_claimant, task.likely_worker)
+
+    def test_claim_changes(self):
+        self.assertStaffing(timedelta(0), 0, True, None, Task.STAFFING_STATUS_UNSTAFFED)
+
+        c1 = Claim.objects.create(claimed_task=self.task, claiming_member=self.alpha,
+            status=Claim.STAT_CURRENT, claimed_duration=ONEHOUR)
+        self.assertStaffing(ONEHOUR, 1, False, self.alpha, Task.STAFFING_STATUS_UNSTAFFED)
+
+        c2 = Claim.objects.create(claimed_task=self.task, claiming_member=self.bravo,
+            status=Claim.STAT_CURRENT, claimed_duration=ONEHOUR, date_verified=date.today())
+        self.assertStaffing(2*ONEHOUR, 2, False, self.alpha, Task.STAFFING_STATUS_PROVISIONAL)
+
+        c1.date_verified = date.today()
+        c1.save()
+        self.assertStaffing(2*ONEHOUR, 2, True, self.alpha, Task.STAFFING_STATUS_STAFFED)
+
+        # Saving a stale task instance mustn't clobber the staffing fields.
+        self.task.save()
+        self.assertStaffing(2*ONEHOUR, 2, True, self.alpha, Task.STAFFING_STATUS_STAFFED)
+
+        c1.delete()
+        self.assertStaffing(ONEHOUR, 1, True, self.bravo, Task.STAFFING_STATUS_UNSTAFFED)
+
+        c2.status = Claim.STAT_DONE
+        c2.save()
+        self.assertStaffing(timedelta(0), 0, True, self.bravo, Task.STAFFING_STATUS_DONE)
+
+    def test_rebuild(self):
+        Claim.objects.create(claimed_task=self.task, claiming_member=self.alpha,
+            status=Claim.STAT_CURRENT, claimed_duration=2*ONEHOUR, date_verified=date.today())
+        Task.objects.filter(pk=self.task.pk).update(claimed_duration=timedelta(0), staffing=Task.STAFFING_STATUS_UNSTAFFED)
+        call_command("rebuildstaffing", stdout=StringIO())
+        self.assertStaffing(2*ONEHOUR, 1, True, self.alpha, Task.STAFFING_STATUS_STAFFED)
+
+
+class TestTimeAccountExpirations(TestCase):
+
+    def setUp(self):
+        self.worker = User.objects.create_user(username='alpha', password='123', email='alpha@example.com').member.worker
+        self.other = User.objects.create_user(username='bravo', password='123', email='bravo@example.com').member.worker
+
+    def entry(self, worker, type, change, days_ago, expires_days=None):
+        when = timezone.now() - timedelta(days=days_ago)
+        return TimeAccountEntry.objects.create(
+            worker=worker, type=type, explanation="test", change=Decimal(change), when=when,
+            expires=None if expires_days is None else when+timedelta(days=expires_days)
+        )
+
+    def expirations(self, worker):
+        return list(TimeAccountEntry.objects.filter(
+            worker=worker, type=TimeAccountEntry.TYPE_EXPIRATION
+        ).order_by('when').values_list('change', flat=True))
+
+    def test_fifo(self):
+        DEP, WTH = TimeAccountEntry.TYPE_DEPOSIT, TimeAccountEntry.TYPE_WITHDRAWAL
+        self.entry(self.worker, DEP, "4.00", 200, 90)  # 3 used by first withdrawal, 1 expires.
+        self.entry(self.worker, WTH, "-3.00", 190)
+        self.entry(self.worker, DEP, "2.00", 150, 90)  # Covers part of next withdrawal before expiring.
+        self.entry(self.worker, DEP, "5.00", 100, 90)  # Covers the rest of it, and 2 expire.
+        self.entry(self.worker, WTH, "-5.00", 80)
+        self.entry(self.worker, DEP, "6.00", 10, 90)  # Not expired yet.
+        self.entry(self.other, DEP, "1.50", 100, 90)
+
+        self.assertEqual(TimeAccountEntry.regenerate_expirations(self.worker), 2)
+        self.assertEqual(self.expirations(self.worker), [Decimal("-1.00"), Decimal("-2.00")])
+        self.assertEqual(self.expirations(self.other), [])
+
+        # Batch mode regenerates everybody's, replacing the old ones.
+        self.assertEqual(TimeAccountEntry.regenerate_expirations(), 3)
+        self.assertEqual(self.expirations(self.worker), [Decimal("-1.00"), Decimal("-2.00")])
+        self.assertEqual(self.expirations(self.other), [Decimal("-1.50")])
+
+        # Regenerating replaces the old expirations without shifting the later balances once per deleted one.
+        deposit = TimeAccountEntry.objects.get(worker=self.other, type=DEP)
+        deposit.expiration = TimeAccountEntry.objects.get(worker=self.other, type=TimeAccountEntry.TYPE_EXPIRATION)
+        deposit.save()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(TimeAccountEntry.regenerate_expirations(), 3)
+        shifts = [q['sql'] for q in queries if q['sql'].startswith("UPDATE") and '"balance" = ("' in q['sql']]
+        self.assertEqual(shifts, [])
+        self.assertEqual(self.balances(self.other), [Decimal("1.50"), Decimal("0.00")])
+        deposit.refresh_from_db()
+        self.assertIsNone(deposit.expiration)
+
+    def balances(self, worker):
+        return list(TimeAccountEntry.objects.filter(worker=worker).order_by('when').values_list('balance', flat=True))
+
+    def test_running_balance(self):
+        DEP, WTH = TimeAccountEntry.TYPE_DEPOSIT, TimeAccountEntry.TYPE_WITHDRAWAL
+        self.entry(self.worker, DEP, "4.00", 30)
+        later = self.entry(self.worker, WTH, "-1.50", 10)
+        earlier = self.entry(self.worker, DEP, "2.00", 20)  # Inserted between the other two.
+        self.entry(self.other, DEP, "9.00", 15)
+        self.assertEqual(self.balances(self.worker), [Decimal("4.00"), Decimal("6.00"), Decimal("4.50")])
+        self.assertEqual(self.worker.time_acct_balance, Decimal("4.50"))
+
+        earlier.change = Decimal("3.00")
+        earlier.when = timezone.now() - timedelta(days=5)  # Moves it after the withdrawal.
+        earlier.save()
+        self.assertEqual(self.balances(self.worker), [Decimal("4.00"), Decimal("2.50"), Decimal("5.50")])
+
+        later.delete()
+        self.assertEqual(self.balances(self.worker), [Decimal("4.00"), Decimal("7.00")])
+        self.assertEqual(self.balances(self.other), [Decimal("9.00")])
+
+        # Break the ledger and have it rebuilt.
+        TimeAccountEntry.objects.filter(worker=self.worker).update(balance=None)
+        self.assertEqual(TimeAccountEntry.rebuild_balances(), 2)
+        self.assertEqual(self.balances(self.worker), [Decimal("4.00"), Decimal("7.00")])
+        self.assertEqual(TimeAccountEntry.rebuild_balances(), 0)
+
+    def test_play_debit(self):
+        # Deferred jobs run immediately while testing, so the entry exists as soon as the play is saved.
+        play = Play.objects.create(
+            playing_member=self.worker.member,
+            play_date=date.today() - timedelta(days=1),
+            play_start_time=time(12, 00),
+            play_duration=timedelta(hours=3),
+        )
+        self.assertEqual(self.worker.time_acct_balance, Decimal("-1.50"))
+        play.play_duration = timedelta(hours=4)
+        play.save()  # Updates the existing entry instead of adding another.
+        self.assertEqual(TimeAccountEntry.objects.filter(play=play).count(), 1)
+        self.assertEqual(self.worker.time_acct_balance, Decimal("-2.00"))
+
+
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 
 class RunEmailWMTD(TestCase):
@@ -0,0 +1,159 @@
+# Standard
+import logging
+from datetime import timedelta
+from decimal import Decimal
+
+# Third Party
+from django.db import transaction
+
+# Local
+from members.models import Membership
+from tasks.models import Worker, Work, Play, TimeAccountEntry
+from bzw_ops.jobs import defer
+
+__author__ = 'adrian'
+
+logger = logging.getLogger("tasks")
+
+# The entries in a worker's time account that are derived from their Work, Play and Membership records are kept
+# up to date by the jobs in this module. Saving one of those records schedules the job that (re)derives its entry,
+# and that job schedules a recompute of the worker's expirations. Both are coalesced, so a burst of saves costs
+# one job per record plus one recompute per worker.
+
+
+def schedule_work(work: Work) -> None:
+    defer(credit_for_work, work.pk, key="tasks:time-acct:work:{}".format(work.pk))
+
+
+def schedule_mship(mship: Membership) -> None:
+    defer(debit_for_mship, mship.pk, key="tasks:time-acct:mship:{}".format(mship.pk))
+
+
+def schedule_play(play: Play) -> None:
+    defer(debit_for_play, play.pk, key="tasks:time-acct:play:{}".format(play.pk))
+
+
+def _schedule_expirations(worker_id: int) -> None:
+    defer(regenerate_expirations, worker_id, key="tasks:time-acct:expirations:{}".format(worker_id))
+
+
+def _upsert_entry(worker: Worker, **fields) -> None:
+    """Creates or updates the entry for the Work, Play or Membership given in fields."""
+    with transaction.atomic():
+        source = {name: fields[name] for name in ('work', 'play', 'mship') if name in fields}
+        entry = TimeAccountEntry.objects.select_for_update().filter(**source).first()
+        if entry is None:
+            entry = TimeAccountEntry(**source)
+        entry.worker = worker
+        for name, value in fields.items():
+            setattr(entry, name, value)
+        entry.save()
+    _schedule_expirations(worker.pk)
+
+
+def credit_for_work(work_id: int) -> None:
+    """When a witnessed work entry is saved, credit it to the worker's time account."""
+    work = Work.objects.filter(pk=work_id).select_related('claim', 'witness').first()  # type: Work
+    if work is None:
+        return  # It has since been deleted, along with its entry.
+
+    try:
+        worker = Worker.objects.get(member_id=work.claim.claiming_member_id)  # type: Worker
+    except Worker.DoesNotExist:
+        logger.error("No worker for work #%d", work.pk)
+        return
+
+    # Remember: Time accounting is denominated in hours.
+    if work.witness is not None:
+        explanation = "Work witnessed by {}".format(work.witness.username)
+        change = Decimal.from_float(work.work_duration.total_seconds() / 3600.0)
+        expires = work.datetime + timedelta(days=90)
+    else:  # Work was not witnessed so has no value.
+        explanation = "Unwitnessed work"
+        change = Decimal.from_float(0.0)
+        expires = None  # i.e. n/a
+
+    _upsert_entry(worker,
+        type=TimeAccountEntry.TYPE_DEPOSIT,
+        work=work,
+        explanation=explanation,
+        change=change,
+        when=work.datetime,
+        expires=expires
+    )
+
+
+def debit_for_mship(mship_id: int) -> None:
+    """When an x month Work Trade membership is purchased, debit the worker's time account."""
+    mship = Membership.objects.filter(pk=mship_id).first()  # type: Membership
+    if mship is None:
+        return  # It has since been deleted, along with its entry.
+
+    if mship.membership_type != Membership.MT_WORKTRADE:
+        # This only applies to Work Trade memberships.
+        return
+
+    if mship.member_id is None:
+        # Sometimes automatic payment processing can't determine the member.
+        # If we run into one of these cases, just ignore it for now.
+        # It will be handled when the member reference is manually set.
+        return
+
+    try:
+        worker = Worker.objects.get(member_id=mship.member_id)  # type: Worker
+    except Worker.DoesNotExist:
+        logger.error("No worker for mship #%d", mship.pk)
+        return
+
+    # REVIEW: This should be two different WT membership types, instead of depending on $price?
+    if mship.sale_price == Decimal("25.00"):
+        time_cost = Decimal("-6.0")
+    elif mship.sale_price == Decimal("10.00"):
+        time_cost = Decimal("-9.0")
+    else:
+        logger.error("Unexpected $%f sale price for mship #%ld", mship.sale_price, mship.id)
+        # Let them have it for 0 hours, until we figure out what happened and make a manual fix.
+        time_cost = Decimal("0.0")
+
+    _upsert_entry(worker,
+        type=TimeAccountEntry.TYPE_WITHDRAWAL,
+        mship=mship,
+        explanation="Membership discount",
+        change=time_cost,
+        when=mship.datetime
+    )
+
+
+def debit_for_play(play_id: int) -> None:
+    """When somebody plays for x hours, debit the worker's time account by 0.5x"""
+    play = Play.objects.filter(pk=play_id).first()  # type: Play
+    if play is None:
+        return  # It has since been deleted, along with its entry.
+
+    try:
+        worker = Worker.objects.get(member_id=play.playing_member_id)  # type: Worker
+    except Worker.DoesNotExist:
+        logger.error("No worker for play #%d", play.pk)
+        return
+
+    if play.play_duration is None:
+        hours_cost = -2.0  # DEFAULT VALUE, I.E. HALF OF 4.0
+        explanation = "Unspecified play time! Defaulted to 4.0hrs"
+    else:
+        hours_played = play.play_duration.total_seconds() / 3600.0  # type: float
+        hours_cost = -0.5 * hours_played  # type: float
+        explanation = "{} hour(s) of play time".format(hours_played)
+
+    _upsert_entry(worker,
+        type=TimeAccountEntry.TYPE_WITHDRAWAL,
+        play=play,
+        explanation=explanation,
+        change=hours_cost,
+        when=play.datetime
+    )
+
+
+def regenerate_expirations(worker_id: int) -> None:
+    worker = Worker.objects.filter(pk=worker_id).first()
+    if worker is not None:
+        TimeAccountEntry.regenerate_expirations(worker)
@@ -2,9 +2,10 @@
 # Standard
 from hashlib import md5
 from datetime import date, datetime, timedelta
+from collections import OrderedDict
 import logging
 import json
-from typing import Generator, Tuple, Optional
+from typing import Generator, Tuple, Optional, Dict, List
 from decimal import Decimal
 
 # Third Party
@@ -16,13 +17,17 @@ from django.http import HttpResponse, JsonResponse, Http404
 from django.template.loader import render_to_string
 from django.urls import reverse
 from django.views.decorators.csrf import ensure_csrf_cookie
+from django.db.models import Prefetch
 import django.utils.timezone as timezone
 from icalendar import Calendar, Event
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
 
 # Local
 from tasks.models import Task, Nag, Claim, Work, WorkNote, Worker
 from members.models import Member
 from tasks.models import TimeAccountEntry
+import tasks.calendarcache as calendarcache
 
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
@@ -136,12 +141,12 @@ def offer_more_tasks(request, task_pk, auth_token):
         all_future_instances = Task.objects.filter(
             recurring_task_template=task.recurring_task_template,
             scheduled_date__gt=task.scheduled_date,
-            status=Task.STAT_ACTIVE
+            status=Task.STAT_ACTIVE,
+            claimed_duration=timedelta(0),  # i.e. nobody has claimed any of it yet.
         )
         future_instances_same_dow = []
         for instance in all_future_instances:
             if instance.scheduled_weekday() == task.scheduled_weekday() \
-               and instance.unclaimed_hours() == instance.max_work \
                and nag.who in instance.all_eligible_claimants():
                 future_instances_same_dow.append(instance)
             if len(future_instances_same_dow) > 3:  # Don't overwhelm potential worker.
@@ -463,15 +468,13 @@ def _new_calendar(name):
     return cal
 
 
-def _add_event(cal, task: Task, request):
+def _new_event(task: Task, request) -> Event:
+    """Task's claim_set must have been prefetched using _working_claims()."""
 
     # NOTE: We could add task workers as attendees, but the calendar format insists that these
     # be email addresses and we don't want to expose personal information about the workers.
     # So we'll build a worker string and make it part of the event description.
-    worker_str = ""
-    for claim in task.claim_set.filter(status__in=[Claim.STAT_CURRENT, Claim.STAT_WORKING],):  # type: Claim
-        worker_str += ", " if worker_str else ""
-        worker_str += claim.claiming_member.friendly_name
+    worker_str = ", ".join(claim.claiming_member.friendly_name for claim in task.claim_set.all())
     if not worker_str:
         worker_str = "Nobody has claimed this task."
 
@@ -487,20 +490,33 @@ def _add_event(cal, task: Task, request):
     event.add('dtstart',     dtstart)
     event.add('dtend',       dtstart + task.work_duration)
     event.add('dtstamp',     datetime.now())
-    cal.add_component(event)
+    return event
 
 
 def _ical_response(cal):
+    """An uncached response. Feeds that clients poll should use calendarcache.ical_response instead."""
     ics = cal.to_ical()
     response = HttpResponse(ics, content_type='text/calendar')
     response['Content-Disposition'] = 'attachment; filename="calendar.ics"'
-    # TODO: No cache header?
     return response
 
 
+def _working_claims() -> Prefetch:
+    """Prefetches the claims of the people working a task, along with the info needed for their names."""
+    return Prefetch(
+        'claim_set',
+        queryset=Claim.objects
+            .filter(status__in=[Claim.STAT_CURRENT, Claim.STAT_WORKING])
+            .select_related('claiming_member__auth_user')
+    )
+
+
 def _gen_tasks_for(member):
     """For the given member, generate all future tasks and past tasks in last 60 days"""
-    for task in member.tasks_claimed.filter(scheduled_date__gte=datetime.now()-timedelta(days=60)):  # type: Task
+    qset = member.tasks_claimed\
+        .filter(scheduled_date__gte=datetime.now()-timedelta(days=60))\
+        .prefetch_related(_working_claims())
+    for task in qset:  # type: Task
         if task.scheduled_date is None or task.work_start_time is None or task.work_duration is None:
             continue
         yield task
@@ -511,7 +527,7 @@ def _gen_all_tasks() -> Generator[Task, None, None]:
 
     qset = Task.objects\
         .filter(scheduled_date__gte=datetime.now()-timedelta(days=60))\
-        .prefetch_related("claim_set")
+        .prefetch_related(_working_claims())
 
     for task in qset:  # type: Task
         if task.scheduled_date is None or task.work_start_time is None or task.work_duration is None:
@@ -521,63 +537,101 @@ def _gen_all_tasks() -> Generator[Task, None, None]:
 
 def member_calendar(request, token):
 
-    # See if token corresponds to a Worker's calendar_token:
-    try:
-        worker = Worker.objects.get(calendar_token=token)
-        member = worker.member
-    except Worker.DoesNotExist:
-        member = None
+    def render():
+        # See if token corresponds to a Worker's calendar_token:
+        try:
+            worker = Worker.objects.get(calendar_token=token)
+            member = worker.member
+        except Worker.DoesNotExist:
+            member = None
+
+        # If token didn't correspond to nag, see if it's a member card string:
+        if member is None:
+            member = Member.get_by_card_str(token)
+
+        if member is None:
+            raise Http404("No such calendar")
+
+        cal = _new_calendar("My Xerocraft Tasks")
+        for task in _gen_tasks_for(member):  # type: Task
+            cal.add_component(_new_event(task, request))
+            # TODO: Add ALARM
+        return cal.to_ical()
+
+    # The token is as good as a password (it may be a membership card string) so it's not kept in the cache's keys.
+    feed = "member:" + md5(token.encode()).hexdigest()
+    return calendarcache.ical_response(request, feed, render, private=True)
+
+
+OPS_CALENDARS = OrderedDict([
+    # Feed name, calendar name
+    ("ops",             "All {} Tasks"),
+    ("ops-staffed",     "{} Staffed Tasks"),
+    ("ops-provisional", "{} Provisionally Staffed Tasks"),
+    ("ops-unstaffed",   "{} Unstaffed Tasks"),
+])
+
+
+def _render_ops_calendars(request) -> Dict[str, bytes]:
+    """Renders all of the ops calendars in a single pass over the tasks.
+    Each event is serialized once and the result is shared by every calendar that contains it.
+    Returns a dict mapping each of the OPS_CALENDARS feed names to its iCalendar document.
+    """
+    fragments = {feed: [] for feed in OPS_CALENDARS}  # type: Dict[str, List[bytes]]
+    for task in _gen_all_tasks():  # type: Task
+        event = _new_event(task, request).to_ical()
+        # Intentionally lacks ALARM
+        fragments["ops"].append(event)
+        # These are the same as is_fully_claimed and all_claims_verified() but use the denormalized staffing fields.
+        if task.max_work - task.claimed_duration != timedelta(0):
+            fragments["ops-unstaffed"].append(event)
+        elif task.claims_verified:
+            fragments["ops-staffed"].append(event)
+        else:
+            fragments["ops-provisional"].append(event)
 
-    # If token didn't correspond to nag, see if it's a member card string:
-    if member is None:
-        member = Member.get_by_card_str(token)
+    docs = {}
+    for feed, name in OPS_CALENDARS.items():
+        # An empty calendar ends with END:VCALENDAR. Splice the events in ahead of it.
+        empty = _new_calendar(name.format(_ORG_NAME_POSSESSIVE)).to_ical()
+        end = empty.rindex(b"END:VCALENDAR")
+        docs[feed] = empty[:end] + b"".join(fragments[feed]) + empty[end:]
+    return docs
 
-    if member is None:
-        raise Http404("No such calendar")
 
-    cal = _new_calendar("My Xerocraft Tasks")
-    for task in _gen_tasks_for(member):  # type: Task
-        _add_event(cal, task, request)
-        # TODO: Add ALARM
-    return _ical_response(cal)
+def _ops_calendar_response(request, feed: str) -> HttpResponse:
+
+    # All of the feeds rendered together are cached under the generation that was current before rendering.
+    gen = calendarcache.generation()
+
+    def render():
+        # Rendering one ops calendar costs about the same as rendering all of them, so cache the others, too.
+        docs = _render_ops_calendars(request)
+        for other_feed, ics in docs.items():
+            if other_feed != feed:
+                calendarcache.prime(request, other_feed, ics, gen)
+        return docs[feed]
+
+    return calendarcache.ical_response(request, feed, render, gen=gen)
 
 
 def ops_calendar(request):
-    cal = _new_calendar("All {} Tasks".format(_ORG_NAME_POSSESSIVE))
-    for task in _gen_all_tasks():  # type: Task
-        _add_event(cal, task, request)
-        # Intentionally lacks ALARM
-    return _ical_response(cal)
+    return _ops_calendar_response(request, "ops")
 
 
 def ops_calendar_staffed(request) -> HttpResponse:
     """A calendar containing tasks that have been verified as staffed."""
-    cal = _new_calendar("{} Staffed Tasks".format(_ORG_NAME_POSSESSIVE))
-    for task in _gen_all_tasks():  # type: Task
-        if task.is_fully_claimed and task.all_claims_verified():
-            _add_event(cal, task, request)
-            # Intentionally lacks ALARM
-    return _ical_response(cal)
+    return _ops_calendar_response(request, "ops-staffed")
 
 
 def ops_calendar_provisional(request) -> HttpResponse:
     """A calendar containing provisionally staffed (i.e. claims not yet verified) tasks."""
-    cal = _new_calendar("{} Provisionally Staffed Tasks".format(_ORG_NAME_POSSESSIVE))
-    for task in _gen_all_tasks():  # type: Task
-        if task.is_fully_claimed and not task.all_claims_verified():
-            _add_event(cal, task, request)
-            # Intentionally lacks ALARM
-    return _ical_response(cal)
+    return _ops_calendar_response(request, "ops-provisional")
 
 
 def ops_calendar_unstaffed(request) -> HttpResponse:
     """A calendar containing tasks that are not even provisionally staffed."""
-    cal = _new_calendar("{} Unstaffed Tasks".format(_ORG_NAME_POSSESSIVE))
-    for task in _gen_all_tasks():  # type: Task
-        if not task.is_fully_claimed:
-            _add_event(cal, task, request)
-            # Intentionally lacks ALARM
-    return _ical_response(cal)
+    return _ops_calendar_response(request, "ops-unstaffed")
 
 
 def resource_calendar(request):
@@ -585,7 +639,7 @@ def resource_calendar(request):
     #for task in Task.objects.all():
     #    if task.scheduled_date is None or task.work_start_time is None or task.work_duration is None:
     #        continue
-    #    _add_event(cal,task,request)
+    #    cal.add_component(_new_event(task, request))
     #    # Intentionally lacks ALARM
     return _ical_response(cal)
 
@@ -605,6 +659,47 @@ def ops_calendar_spa(request, year=date.today().year, month=date.today().month)
     return render(request, "tasks/ops-calendar-spa.html", props)
 
 
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+# SCHEDULED LOAD
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def scheduled_load(request) -> JsonResponse:
+    """Hours claimed per member for tasks scheduled in a window of days, for coordinators.
+    Query params are "start" and "end" (YYYY-MM-DD, inclusive, defaulting to the next two weeks)
+    and "status", which can be repeated (defaulting to CURRENT claims only).
+    """
+    try:
+        start = request.GET.get('start', None)
+        start = date.today() if start is None else datetime.strptime(start, "%Y-%m-%d").date()
+        end = request.GET.get('end', None)
+        end = start+timedelta(weeks=2) if end is None else datetime.strptime(end, "%Y-%m-%d").date()
+    except ValueError:
+        return JsonResponse(status=400, data={"error": "Dates must be formatted as YYYY-MM-DD."})
+
+    statuses = request.GET.getlist('status') or [Claim.STAT_CURRENT]
+    valid_statuses = [code for code, _ in Claim.CLAIM_STATUS_CHOICES]
+    if any(status not in valid_statuses for status in statuses):
+        return JsonResponse(status=400, data={"error": "Status must be one of "+", ".join(valid_statuses)})
+
+    load = Claim.sum_in_period(start, end, statuses)
+    return JsonResponse({
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "statuses": statuses,
+        "load": [
+            {
+                "member": member.pk,
+                "username": member.username,
+                "friendly_name": member.friendly_name,
+                "hours": duration.total_seconds()/3600.0,
+            }
+            for member, duration in sorted(load.items(), key=lambda item: item[1], reverse=True)
+        ],
+    })
+
+
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 
 def desktop_timesheet(request):
@@ -628,14 +723,15 @@ def render_time_acct_statement_as_html(user:User, range:str) -> str:
     if range == "recent":
         statement_start_datetime -= timedelta(days=90)  # The rollover limit.
         subtitle = "last 90 days"
-    lines = TimeAccountEntry.objects.filter(
-        worker=user.member.worker,
-        when__gte=statement_start_datetime
-    ).order_by('when')
-
-    if len(lines) > 0:
-        balance_forward = lines[0].balance - lines[0].change
-    else:
+    entries = TimeAccountEntry.objects.filter(worker=user.member.worker)
+    lines = entries.filter(when__gte=statement_start_datetime).order_by('when', 'pk')
+
+    # The running balance of the last entry before the statement period is the balance forward.
+    balance_forward = entries\
+        .filter(when__lt=statement_start_datetime)\
+        .order_by('-when', '-pk')\
+        .values_list('balance', flat=True).first()
+    if balance_forward is None:
         balance_forward = Decimal("0.00")
     balance = balance_forward
     for line in lines:  # type: TimeAccountEntry